@@ -12,6 +12,7 @@ __all__ = [
     'assembly_compare',
     'assembly_variants',
     'bam_parse',
+    'batch_runner',
     'best_seq_chooser',
     'card_record',
     'cdhit',
@@ -22,6 +23,7 @@ __all__ = [
     'faidx',
     'flag',
     'histogram',
+    'ksw_aligner',
     'link',
     'mapping',
     'mash',
@@ -37,11 +39,13 @@ __all__ = [
     'samtools_variants',
     'sequence_metadata',
     'sequence_variant',
+    'stage_timer',
     'summary',
     'summary_cluster',
     'summary_cluster_variant',
     'summary_sample',
     'tasks',
+    'thread_budget',
     'versions',
     'vfdb_parser',
 ]
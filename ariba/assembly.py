@@ -4,10 +4,14 @@ import shutil
 import pyfastaq
 import pymummer
 import fermilite_ariba
-from ariba import common, faidx, mapping, bam_parse, external_progs, mash
+from ariba import common, faidx, mapping, bam_parse, best_seq_chooser, external_progs, ksw_aligner, mash, stage_timer, thread_budget
 
 class Error (Exception): pass
 
+# ways of choosing the closest reference sequence: mash distance to the
+# assembly, or total alignment score of the reads (best_seq_chooser)
+ref_choosers = ['mash', 'alignment']
+
 class Assembly:
     def __init__(self,
       reads1,
@@ -33,7 +37,21 @@ class Assembly:
       reads_insert=500,
       extern_progs=None,
       clean=True,
+      timer=None,
+      threads=1,
+      ref_sketches=None,
+      final_assembly_coords=None,
+      contig_aligner='nucmer',
+      map_reads1=None,
+      map_reads2=None,
+      assembly_mapper='bowtie2',
+      ref_chooser='mash',
     ):
+        '''If map_reads1 and map_reads2 are given, they are mapped to the final
+           assembly to make final_assembly_bam, instead of reads1 and reads2.
+           The scaffold graph is still only made from reads1 and reads2.
+           assembly_mapper = bowtie2 or minimap (see mapping.mappers).
+           ref_chooser = mash or alignment (see ref_choosers)'''
         self.reads1 = os.path.abspath(reads1)
         self.reads2 = os.path.abspath(reads2)
         self.ref_fasta = os.path.abspath(ref_fasta)
@@ -58,12 +76,25 @@ class Assembly:
         self.sspace_sd = sspace_sd
         self.reads_insert = reads_insert
         self.clean = clean
+        self.threads = threads
+        self.ref_sketches = ref_sketches
+        self.final_assembly_coords = final_assembly_coords
+        self.contig_aligner = contig_aligner
+        self.map_reads1 = self.reads1 if map_reads1 is None else os.path.abspath(map_reads1)
+        self.map_reads2 = self.reads2 if map_reads2 is None else os.path.abspath(map_reads2)
+        self.assembly_mapper = assembly_mapper
+        self.ref_chooser = ref_chooser
 
         if extern_progs is None:
             self.extern_progs = external_progs.ExternalProgs()
         else:
             self.extern_progs = extern_progs
 
+        if timer is None:
+            self.stage_timer = stage_timer.StageTimer()
+        else:
+            self.stage_timer = timer
+
         try:
             os.mkdir(self.working_dir)
         except:
@@ -111,31 +142,57 @@ class Assembly:
 
 
     @staticmethod
-    def _run_fermilite(reads_in, fasta_out, log_out):
-        return fermilite_ariba.fermilite_ariba(reads_in, fasta_out, log_out)
+    def _run_fermilite(reads_in, fasta_out, log_out, threads=1):
+        return fermilite_ariba.fermilite_ariba(reads_in, fasta_out, log_out, threads)
 
 
-    def _assemble_with_fermilite(self):
-        cwd = os.getcwd()
+    @staticmethod
+    def _load_fermilite_reads(reads1, reads2):
+        '''Returns tuple (sequences, qualities) of the reads, as bytes with one
+           read per line, in the form needed by fermilite_ariba.assemble_reads.
+           Reads are interleaved, as in pyfastaq.tasks.interleave. Qualities
+           are empty if the reads are not fastq'''
+        seqs = []
+        quals = []
+        reader_2 = pyfastaq.sequences.file_reader(reads2)
+
+        for read_1 in pyfastaq.sequences.file_reader(reads1):
+            try:
+                read_2 = next(reader_2)
+            except StopIteration:
+                raise Error('Error getting mate for sequence ' + read_1.id + ' ... cannot continue')
+
+            for read in read_1, read_2:
+                seqs.append(read.seq)
+                quals.append(getattr(read, 'qual', None))
+
         try:
-            os.chdir(self.working_dir)
-        except:
-            raise Error('Error chdir ' + self.working_dir)
+            read_2 = next(reader_2)
+        except StopIteration:
+            read_2 = None
 
-        interleaved_reads = 'reads.fq'
-        pyfastaq.tasks.interleave(self.reads1, self.reads2, interleaved_reads)
-        fermilite_log = self.assembly_contigs + '.log'
-        got_from_fermilite = self._run_fermilite(interleaved_reads, self.assembly_contigs, fermilite_log)
-        os.unlink(interleaved_reads)
-        if os.path.exists(fermilite_log):
-            with open(fermilite_log) as f:
-                for line in f:
-                    print(line, end='', file=self.log_fh)
+        if read_2 is not None:
+            raise Error('Error getting mate for sequence ' + read_2.id + ' ... cannot continue')
 
-            os.unlink(fermilite_log)
+        if None in quals:
+            quals = []
 
-        self.assembled_ok = (got_from_fermilite == 0)
-        os.chdir(cwd)
+        to_bytes = lambda x: ''.join([y + '\n' for y in x]).encode()
+        return to_bytes(seqs), to_bytes(quals)
+
+
+    def _assemble_with_fermilite(self, threads=1):
+        '''threads = number of threads used to try the fermilite min counts'''
+        seqs, quals = self._load_fermilite_reads(self.reads1, self.reads2)
+        contigs, fermilite_log = fermilite_ariba.assemble_reads(seqs, quals, threads)
+        print(fermilite_log, end='', file=self.log_fh)
+
+        if len(contigs):
+            with open(self.assembly_contigs, 'w') as f:
+                for i, seq in enumerate(contigs):
+                    print('>contig.' + str(i), seq, sep='\n', file=f)
+
+        self.assembled_ok = len(contigs) > 0
 
 
     def _assemble_with_spades(self, unittest=False):
@@ -301,14 +358,43 @@ class Assembly:
 
 
     @staticmethod
-    def _fix_contig_orientation(contigs_fa, ref_fa, outfile, min_id=90, min_length=20, breaklen=200):
+    def _reverse_queries_in_nucmer_file(infile, outfile, qry_names, qry_fa):
+        '''Copies coords or snps file infile made by pymummer.nucmer.Runner to
+           outfile, changing it as if the query file was qry_fa, and each
+           sequence in qry_names in the query had been reverse complemented'''
+        with open(infile) as f_in, open(outfile, 'w') as f_out:
+            for i, line in enumerate(f_in):
+                fields = line.rstrip('\n').split('\t')
+
+                if i == 0:
+                    line = line.split()[0] + ' ' + qry_fa + '\n'
+                elif line.startswith('[P1]'):
+                    qry_name, qry_length, frame, qry_coords = -1, -5, -3, [3]
+                elif line.startswith('[S1]'):
+                    qry_name, qry_length, frame, qry_coords = 12, 8, 10, [2, 3]
+                elif len(fields) > 1 and fields[qry_name] in qry_names:
+                    for j in qry_coords:
+                        fields[j] = str(int(fields[qry_length]) - int(fields[j]) + 1)
+                    fields[frame] = str(-int(fields[frame]))
+                    line = '\t'.join(fields) + '\n'
+
+                print(line, end='', file=f_out)
+
+
+    @staticmethod
+    def _fix_contig_orientation(contigs_fa, ref_fa, outfile, min_id=90, min_length=20, breaklen=200, nucmer_coords_out=None, aligner='nucmer'):
         '''Changes orientation of each contig to match the reference, when possible.
-           Returns a set of names of contigs that had hits in both orientations to the reference'''
+           Returns a set of names of contigs that had hits in both orientations to the reference.
+           If nucmer_coords_out is given, the nucmer coords and snps of the
+           reference against outfile are written to nucmer_coords_out and
+           nucmer_coords_out.snps (derived from the nucmer run used to find
+           the orientations, instead of running nucmer again).
+           aligner = nucmer or ksw (see ksw_aligner.aligners)'''
         if not os.path.exists(contigs_fa):
             raise Error('Cannot fix orientation of assembly contigs because file not found: ' + contigs_fa)
 
         tmp_coords = os.path.join(outfile + '.tmp.rename.coords')
-        pymummer.nucmer.Runner(
+        ksw_aligner.runner(aligner)(
             ref_fa,
             contigs_fa,
             tmp_coords,
@@ -316,6 +402,7 @@ class Assembly:
             min_length=min_length,
             breaklen=breaklen,
             maxmatch=True,
+            show_snps=nucmer_coords_out is not None,
         ).run()
 
         to_revcomp = set()
@@ -327,9 +414,15 @@ class Assembly:
             else:
                 to_revcomp.add(hit.qry_name)
 
-        os.unlink(tmp_coords)
         in_both = to_revcomp.intersection(not_revcomp)
 
+        if nucmer_coords_out is None:
+            os.unlink(tmp_coords)
+        else:
+            for suffix in ['', '.snps']:
+                Assembly._reverse_queries_in_nucmer_file(tmp_coords + suffix, nucmer_coords_out + suffix, to_revcomp.difference(in_both), os.path.abspath(outfile))
+                os.unlink(tmp_coords + suffix)
+
         f = pyfastaq.utils.open_file_write(outfile)
         seq_reader = pyfastaq.sequences.file_reader(contigs_fa)
         for seq in seq_reader:
@@ -342,18 +435,44 @@ class Assembly:
 
 
     @staticmethod
-    def _parse_bam(sequences, bam, min_scaff_depth, max_insert):
+    def _read_names(reads_file):
+        '''Returns set of names of the reads in reads_file, as they are named
+           by bowtie2 (ie without /1 or /2 at the end)'''
+        names = set()
+        for read in pyfastaq.sequences.file_reader(reads_file):
+            name = read.id.split()[0]
+            if name.endswith('/1') or name.endswith('/2'):
+                name = name[:-2]
+            names.add(name)
+        return names
+
+
+    def _scaff_graph_read_names(self):
+        '''Returns set of names of the reads used to make the scaffold graph,
+           or None if that is all the reads in final_assembly_bam'''
+        if os.path.realpath(self.reads1) == os.path.realpath(self.map_reads1):
+            return None
+        return self._read_names(self.reads1)
+
+
+    @staticmethod
+    def _parse_bam(sequences, bam, min_scaff_depth, max_insert, read_names=None, write_files=True):
+        '''Returns whether or not the scaffold graph is consistent. If
+           write_files is True, also writes the files bam.soft_clipped,
+           bam.unmapped_mates and bam.scaff'''
         if not os.path.exists(bam):
             raise Error('File not found: ' + bam)
 
-        bam_parser = bam_parse.Parser(bam, sequences)
+        bam_parser = bam_parse.Parser(bam, sequences, read_names=read_names, diagnostics=write_files)
         bam_parser.parse()
-        bam_parser.write_files(bam)
+        if write_files:
+            bam_parser.write_files(bam)
         return bam_parser.scaff_graph_is_consistent(min_scaff_depth, max_insert)
 
 
     def run(self):
-        self._assemble_with_fermilite()
+        with self.stage_timer.stage('fermilite'), thread_budget.stage_threads(self.threads) as threads:
+            self._assemble_with_fermilite(threads)
         self.sequences = {}
 
         # double-check we got some contigs
@@ -377,42 +496,59 @@ class Assembly:
                 self.log_fh = None
                 return
 
-            masher = mash.Masher(self.ref_fastas, self.gapfilled_length_filtered, self.log_fh, self.extern_progs)
-            self.ref_seq_name = masher.run(self.mash_dist_file)
+            if self.ref_chooser == 'alignment':
+                with self.stage_timer.stage('choose_ref_by_alignment'), thread_budget.stage_threads(self.threads) as threads:
+                    chooser = best_seq_chooser.BestSeqChooser(self.reads1, self.reads2, self.ref_fastas, self.log_fh, threads=threads)
+                    self.ref_seq_name = chooser._get_best_seq_by_alignment_score()
+            else:
+                with self.stage_timer.stage('mash'):
+                    masher = mash.Masher(self.ref_fastas, self.gapfilled_length_filtered, self.log_fh, ref_sketches=self.ref_sketches)
+                    self.ref_seq_name = masher.run(self.mash_dist_file)
             if self.ref_seq_name is None:
                 print('Could not determine closest reference sequence', file=self.log_fh)
                 self.log_fh = None
                 return
 
             faidx.write_fa_subset({self.ref_seq_name}, self.ref_fastas, self.ref_fasta, samtools_exe=self.extern_progs.exe('samtools'), verbose=True, verbose_filehandle=self.log_fh)
-            print('Closest reference sequence according to mash: ', self.ref_seq_name, file=self.log_fh)
+            print('Closest reference sequence according to ' + self.ref_chooser + ': ', self.ref_seq_name, file=self.log_fh)
 
-            contigs_both_strands = self._fix_contig_orientation(self.gapfilled_length_filtered, self.ref_fasta, self.final_assembly_fa, min_id=self.nucmer_min_id, min_length=self.nucmer_min_len, breaklen=self.nucmer_breaklen)
+            with self.stage_timer.stage('nucmer_orientation'):
+                contigs_both_strands = self._fix_contig_orientation(self.gapfilled_length_filtered, self.ref_fasta, self.final_assembly_fa, min_id=self.nucmer_min_id, min_length=self.nucmer_min_len, breaklen=self.nucmer_breaklen, nucmer_coords_out=self.final_assembly_coords, aligner=self.contig_aligner)
             self.has_contigs_on_both_strands = len(contigs_both_strands) > 0
             pyfastaq.tasks.file_to_dict(self.final_assembly_fa, self.sequences)
 
-            mapping.run_bowtie2(
-                self.reads1,
-                self.reads2,
-                self.final_assembly_fa,
-                self.final_assembly_bam[:-4],
-                threads=1,
-                sort=True,
-                samtools=self.extern_progs.exe('samtools'),
-                bowtie2=self.extern_progs.exe('bowtie2'),
-                verbose=True,
-                verbose_filehandle=self.log_fh
-            )
-
-            self.scaff_graph_ok = self._parse_bam(self.sequences, self.final_assembly_bam, self.min_scaff_depth, self.max_insert)
+            # the stage is named after the mapper, so that the stage timings of
+            # each cluster can be compared between runs with different mappers
+            with self.stage_timer.stage(self.assembly_mapper), thread_budget.stage_threads(self.threads) as threads:
+                if self.assembly_mapper == 'minimap':
+                    mapping.run_minimap(
+                        self.map_reads1,
+                        self.map_reads2,
+                        self.final_assembly_fa,
+                        self.final_assembly_bam[:-4],
+                        threads=threads,
+                        max_insert=self.max_insert,
+                        verbose=True,
+                        verbose_filehandle=self.log_fh
+                    )
+                else:
+                    mapping.run_bowtie2(
+                        self.map_reads1,
+                        self.map_reads2,
+                        self.final_assembly_fa,
+                        self.final_assembly_bam[:-4],
+                        threads=threads,
+                        sort=True,
+                        samtools=self.extern_progs.exe('samtools'),
+                        bowtie2=self.extern_progs.exe('bowtie2'),
+                        verbose=True,
+                        verbose_filehandle=self.log_fh
+                    )
+
+            with self.stage_timer.stage('bam_parsing'):
+                self.scaff_graph_ok = self._parse_bam(self.sequences, self.final_assembly_bam, self.min_scaff_depth, self.max_insert, read_names=self._scaff_graph_read_names(), write_files=not self.clean)
             print('Scaffolding graph is OK:', self.scaff_graph_ok, file=self.log_fh)
 
-            if self.clean:
-                for suffix in ['soft_clipped', 'unmapped_mates', 'scaff']:
-                    filename = self.final_assembly_bam + '.' + suffix
-                    print('Deleting file', filename, file=self.log_fh)
-                    os.unlink(filename)
-
 
         # This is to make this object picklable, to keep multithreading happy
         self.log_fh = None
@@ -2,6 +2,7 @@ import os
 import copy
 import pyfastaq
 import pymummer
+from ariba import ksw_aligner
 
 class Error (Exception): pass
 
@@ -19,7 +20,13 @@ class AssemblyCompare:
       assembled_threshold=0.95,
       unique_threshold=0.03,
       max_gene_nt_extend=30,
+      run_nucmer=True,
+      contig_aligner='nucmer',
     ):
+        '''If run_nucmer is False, the nucmer coords and snps files of ref_fa
+           against assembly_fa must already exist (see nucmer_coords_file_from_prefix), eg
+           made by assembly.Assembly._fix_contig_orientation.
+           contig_aligner = nucmer or ksw (see ksw_aligner.aligners)'''
         self.assembly_fa = os.path.abspath(assembly_fa)
         self.assembly_sequences = assembly_sequences
         self.ref_fa = os.path.abspath(ref_fa)
@@ -33,18 +40,25 @@ class AssemblyCompare:
         self.assembled_threshold = assembled_threshold
         self.unique_threshold = unique_threshold
         self.max_gene_nt_extend = max_gene_nt_extend
+        self.run_nucmer = run_nucmer
+        self.contig_aligner = contig_aligner
         self.scaff_name_matching_ref = None
         self.gene_matching_ref = None
         self.gene_matching_ref_type = None
         self.gene_start_bases_added = None
         self.gene_end_bases_added = None
 
-        self.nucmer_coords_file = self.outprefix + '.nucmer.coords'
+        self.nucmer_coords_file = self.nucmer_coords_file_from_prefix(self.outprefix)
         self.nucmer_snps_file = self.nucmer_coords_file + '.snps'
 
 
+    @staticmethod
+    def nucmer_coords_file_from_prefix(outprefix):
+        return os.path.abspath(outprefix) + '.nucmer.coords'
+
+
     def _run_nucmer(self):
-        pymummer.nucmer.Runner(
+        ksw_aligner.runner(self.contig_aligner)(
             self.ref_fa,
             self.assembly_fa,
             self.nucmer_coords_file,
@@ -359,7 +373,8 @@ class AssemblyCompare:
 
 
     def run(self):
-        self._run_nucmer()
+        if self.run_nucmer:
+            self._run_nucmer()
         self.nucmer_hits = self._parse_nucmer_coords_file(self.nucmer_coords_file, self.ref_sequence.id)
         self.percent_identities = self._nucmer_hits_to_percent_identity(self.nucmer_hits)
         self.assembled_reference_sequences = self._get_assembled_reference_sequences(self.nucmer_hits, self.ref_sequence, self.assembly_sequences)
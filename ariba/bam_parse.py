@@ -1,16 +1,30 @@
 import pysam
 import pyfastaq
+import numpy
 import os
 from ariba import scaffold_graph
 
 class Error (Exception): pass
 
+# SAM flags
+reverse_flag = 0x10
+mate_unmapped_flag = 0x8
+read1_flag = 0x40
+
+# arrays returned by Parser._alignment_fields()
+alignment_fields = ['ref', 'mate_ref', 'flag', 'start', 'end', 'left_clip', 'right_clip', 'name']
+
 class Parser:
-    def __init__(self, bam, ref_seqs):
+    def __init__(self, bam, ref_seqs, read_names=None, diagnostics=True):
         '''Construct a Parser.
         bam: name of BAM file
-        ref_seqs: dictionary of sequence name => Fasta object'''
+        ref_seqs: dictionary of sequence name => Fasta object
+        read_names: if given, set of names of reads (as in the BAM file). All other reads are ignored
+        diagnostics: if False, only the scaffold graph is made. Soft-clipped
+          and unmapped mate counts are not made, and write_files() cannot be used'''
         self.bam = os.path.abspath(bam)
+        self.read_names = read_names
+        self.diagnostics = diagnostics
         self.soft_clipped = {}
         self.ref_lengths = {seq: len(ref_seqs[seq]) for seq in ref_seqs}
         self.scaff_graph = scaffold_graph.Graph(self.ref_lengths)
@@ -23,39 +37,94 @@ class Parser:
         if sam.is_unmapped:
             raise Error('Cannot get soft clip info from an unmapped read')
 
-        if sam.cigar is None or len(sam.cigar) == 0:
+        cigar = sam.cigartuples
+        if cigar is None or len(cigar) == 0:
             return False, False
-        return (sam.cigar[0][0] == 4, sam.cigar[-1][0] == 4)
+        return (cigar[0][0] == 4, cigar[-1][0] == 4)
+
+
+    def _alignment_fields(self):
+        '''Returns dict of field name -> numpy array, with one element per
+           mapped read in the BAM file (skipping reads not in self.read_names).
+           name is an integer ID of the read pair, only set (otherwise -1) for
+           reads whose mate is mapped to a different sequence. If
+           self.diagnostics is False, only those reads are returned, and
+           soft clipping is not looked at'''
+        rows = []
+        names = {}
+
+        for sam in self.sam_reader.fetch(until_eof=True):
+            if sam.is_unmapped:
+                continue
+
+            is_link = sam.next_reference_id != sam.reference_id and not sam.mate_is_unmapped
+            if not (is_link or self.diagnostics) or (self.read_names is not None and sam.query_name not in self.read_names):
+                continue
+
+            name = names.setdefault(sam.query_name, len(names)) if is_link else -1
+            clips = self._sam_to_soft_clipped(sam) if self.diagnostics else (False, False)
+            rows.append((sam.reference_id, sam.next_reference_id, sam.flag, sam.reference_start, sam.reference_end) + clips + (name,))
+
+        columns = numpy.array(rows, dtype=numpy.int64).reshape(len(rows), len(alignment_fields)).T
+        return {x: columns[i].astype(bool) if x.endswith('_clip') else columns[i] for i, x in enumerate(alignment_fields)}
 
 
-    def _update_soft_clipped_from_sam(self, sam):
-        ref_name = self.sam_reader.getrname(sam.tid)
-        left_clip, right_clip = self._sam_to_soft_clipped(sam)
+    @staticmethod
+    def _count_positions(refs, positions, columns):
+        '''Returns list of tuples (ref, position, column, count), counting each
+           distinct (ref, position, column) in the three arrays'''
+        rows, counts = numpy.unique(numpy.array([refs, positions, columns], dtype=numpy.int64).T, axis=0, return_counts=True)
+        return [(int(ref), int(position), int(column), int(count)) for (ref, position, column), count in zip(rows, counts)]
 
-        if left_clip or right_clip:
+
+    def _update_soft_clipped(self, fields):
+        '''Counts reads soft-clipped at each position, from the arrays returned
+           by _alignment_fields(). A left clip is counted at the start of the
+           read, and a right clip at the position after the end of the read'''
+        left, right = fields['left_clip'], fields['right_clip']
+        refs = numpy.concatenate([fields['ref'][left], fields['ref'][right]])
+        positions = numpy.concatenate([fields['start'][left], fields['end'][right]])
+        columns = numpy.concatenate([numpy.zeros(left.sum()), numpy.ones(right.sum())])
+
+        for ref, position, column, count in self._count_positions(refs, positions, columns):
+            ref_name = self.sam_reader.references[ref]
             if ref_name not in self.soft_clipped:
                 self.soft_clipped[ref_name] = {}
+            if position not in self.soft_clipped[ref_name]:
+                self.soft_clipped[ref_name][position] = [0, 0]
+            self.soft_clipped[ref_name][position][column] += count
 
-            if left_clip:
-                p = sam.pos
-                if p not in self.soft_clipped[ref_name]:
-                    self.soft_clipped[ref_name][p] = [0, 0]
-                self.soft_clipped[ref_name][p][0] += 1
-
-            if right_clip:
-                p = sam.aend
-                if p not in self.soft_clipped[ref_name]:
-                    self.soft_clipped[ref_name][p] = [0, 0]
-                self.soft_clipped[ref_name][p][1] += 1
 
+    def _update_unmapped_mates(self, fields):
+        '''Counts reads with an unmapped mate, at the start position of each
+           read, from the arrays returned by _alignment_fields()'''
+        keep = (fields['flag'] & mate_unmapped_flag) != 0
+        refs = fields['ref'][keep]
 
-    def _update_unmapped_mates_from_sam(self, sam):
-        if (not sam.is_unmapped) and sam.mate_is_unmapped:
-            ref_name = self.sam_reader.getrname(sam.tid)
+        for ref, position, column, count in self._count_positions(refs, fields['start'][keep], numpy.zeros(len(refs))):
+            ref_name = self.sam_reader.references[ref]
             if ref_name not in self.unmapped_mates:
                 self.unmapped_mates[ref_name] = {}
-            pos = sam.reference_start
-            self.unmapped_mates[ref_name][pos] = self.unmapped_mates[ref_name].get(pos, 0) + 1
+            self.unmapped_mates[ref_name][position] = self.unmapped_mates[ref_name].get(position, 0) + count
+
+
+    def _update_scaff_graph(self, fields):
+        '''Adds the reads with the mate mapped to a different sequence to the
+           scaffold graph, from the arrays returned by _alignment_fields()'''
+        keep = fields['name'] != -1
+        graph_refs = numpy.array([self.scaff_graph.ref_index.get(x, -1) for x in self.sam_reader.references], dtype=numpy.int64)
+        refs = graph_refs[fields['ref'][keep]]
+        if numpy.any(refs == -1) or numpy.any(graph_refs[fields['mate_ref'][keep]] == -1):
+            raise Error('Reads in BAM file ' + self.bam + ' mapped to sequences that are not in the reference sequences')
+
+        reverse = (fields['flag'][keep] & reverse_flag) != 0
+        self.scaff_graph.update_from_reads(
+            fields['name'][keep],
+            (fields['flag'][keep] & read1_flag) != 0,
+            refs,
+            reverse,
+            numpy.where(reverse, fields['end'][keep] - 1, fields['start'][keep]),
+        )
 
 
     def _write_soft_clipped_to_file(self, filename):
@@ -75,13 +144,11 @@ class Parser:
 
 
     def parse(self):
-        for sam in self.sam_reader.fetch(until_eof=True):
-            if sam.is_unmapped:
-                continue
-
-            self._update_soft_clipped_from_sam(sam)
-            self.scaff_graph.update_from_sam(sam, self.sam_reader)
-            self._update_unmapped_mates_from_sam(sam)
+        fields = self._alignment_fields()
+        self._update_scaff_graph(fields)
+        if self.diagnostics:
+            self._update_soft_clipped(fields)
+            self._update_unmapped_mates(fields)
 
 
     def scaff_graph_is_consistent(self, min_coverage, max_insert):
@@ -89,6 +156,9 @@ class Parser:
 
 
     def write_files(self, prefix):
+        if not self.diagnostics:
+            raise Error('Cannot write files from BAM parser made with diagnostics=False')
+
         self._write_soft_clipped_to_file(prefix + '.soft_clipped')
         self._write_unmapped_mates_to_file(prefix + '.unmapped_mates')
         self.scaff_graph.write_all_links_to_file(prefix + '.scaff')
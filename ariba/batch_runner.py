@@ -0,0 +1,278 @@
+import os
+import sys
+import time
+import contextlib
+import multiprocessing
+import minimap_ariba
+from ariba import clusters, thread_budget
+
+class Error (Exception): pass
+
+
+def load_samples_file(infile):
+    '''Returns list of tuples (sample name, reads_1, reads_2), from a
+       tab-delimited file with one sample per line. Blank lines and lines
+       starting with # are ignored'''
+    samples = []
+    names = set()
+
+    with open(infile) as f:
+        for line in f:
+            if line.startswith('#') or line.strip() == '':
+                continue
+
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 3:
+                raise Error('Error reading samples file ' + infile + '. Expected 3 columns (sample name, reads_1, reads_2). Got this line:\n' + line)
+
+            name, reads_1, reads_2 = fields
+            if name in {'', '.', '..'} or os.sep in name:
+                raise Error('Error reading samples file ' + infile + '. Sample name cannot be used as a directory name: "' + name + '"')
+            if name in names:
+                raise Error('Error reading samples file ' + infile + '. Sample name found more than once: "' + name + '"')
+
+            names.add(name)
+            samples.append((name, reads_1, reads_2))
+
+    return samples
+
+
+class BatchRunner:
+    def __init__(self,
+      refdata_dir,
+      samples,
+      outdir,
+      extern_progs,
+      version_report_lines=None,
+      threads=1,
+      verbose=False,
+      clean=True,
+      resume=False,
+      clusters_options=None,
+    ):
+        '''Runs ariba on many samples against the same reference data.
+           samples = list of (sample name, reads_1, reads_2), as returned by
+           load_samples_file(). The output of each sample is in
+           outdir/sample_name, and is the same as from ariba run. Whether
+           each sample finished or failed is written to outdir/batch_summary.tsv.
+           clusters_options = dict of other keyword arguments for
+           clusters.Clusters, used for every sample'''
+        self.refdata_dir = os.path.abspath(refdata_dir)
+        self.samples = samples
+        self.outdir = os.path.abspath(outdir)
+        self.extern_progs = extern_progs
+        self.version_report_lines = version_report_lines
+        self.threads = threads
+        self.verbose = verbose
+        self.clean = clean
+        self.resume = resume
+        self.clusters_options = {} if clusters_options is None else clusters_options
+        self.loaded_refdata = None
+        self.pool = None
+        self.thread_budget = None
+        self.running = [] # list of (sample name, Clusters object, list of results), in order started
+        self.failed_samples = []
+        self.sample_status = {} # sample name -> (status, error message)
+        self.summary_file = os.path.join(self.outdir, 'batch_summary.tsv')
+
+
+    def _stop_pool(self):
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.terminate()
+        while len(multiprocessing.active_children()) > 0:
+            time.sleep(1)
+        self.pool = None
+
+
+    def _receive_signal(self, signum, stack):
+        print('Stopping! Signal received:', signum, file=sys.stderr, flush=True)
+        self._stop_pool()
+        for sample_name, clusters_obj, results in self.running:
+            clusters_obj._emergency_stop()
+        sys.exit(1)
+
+
+    def _sample_outdir(self, sample_name):
+        return os.path.join(self.outdir, sample_name)
+
+
+    def _sample_finished(self, sample_name):
+        '''Returns True if the sample finished in an earlier run. Checkpoints
+           are deleted at the very end of a run, unless not cleaning'''
+        outdir = self._sample_outdir(sample_name)
+        return os.path.exists(os.path.join(outdir, 'report.tsv')) \
+            and not (self.clean and os.path.exists(os.path.join(outdir, 'checkpoints')))
+
+
+    def _sample_failed(self, sample_name, clusters_obj, err):
+        '''Records that the sample failed with the exception err. The other
+           samples carry on'''
+        message = type(err).__name__ + ': ' + str(err)
+        print('Sample ' + sample_name + ' failed. Error was:\n' + message, file=sys.stderr, flush=True)
+        self.failed_samples.append(sample_name)
+        self.sample_status[sample_name] = ('failed', message)
+        if clusters_obj is not None:
+            try:
+                clusters_obj._emergency_stop()
+            except:
+                pass
+
+
+    def _write_summary(self):
+        with open(self.summary_file, 'w') as f:
+            print('sample', 'status', 'error', sep='\t', file=f)
+            for sample_name, reads_1, reads_2 in self.samples:
+                status, message = self.sample_status.get(sample_name, ('not_run', '.'))
+                print(sample_name, status, message.replace('\n', ' ').replace('\t', ' '), sep='\t', file=f)
+
+
+    @contextlib.contextmanager
+    def _mapping_threads(self):
+        '''Threads for mapping the reads of a sample. These come from the
+           same budget as the pool, which may still be running the clusters
+           of earlier samples'''
+        if self.thread_budget is None:
+            yield self.threads
+        else:
+            with self.thread_budget.reserve_threads(self.threads) as threads:
+                yield threads
+
+
+    def _start_sample(self, sample_name, reads_1, reads_2):
+        '''Maps the reads of the sample and sends its clusters to the
+           pool (or runs them, if not using a pool)'''
+        if self.verbose:
+            print('{:=^79}'.format(' Sample ' + sample_name + ' '), flush=True)
+
+        cwd = os.getcwd()
+        clusters_obj = None
+        cluster_list = []
+
+        try:
+            with self._mapping_threads() as threads:
+                clusters_obj = clusters.Clusters(
+                    self.refdata_dir,
+                    reads_1,
+                    reads_2,
+                    self._sample_outdir(sample_name),
+                    self.extern_progs,
+                    version_report_lines=self.version_report_lines,
+                    threads=threads,
+                    verbose=self.verbose,
+                    clean=self.clean,
+                    resume=self.resume,
+                    loaded_refdata=self.loaded_refdata,
+                    keep_reference_index=True,
+                    **self.clusters_options
+                )
+                clusters.Clusters._set_signal_handlers(self._receive_signal)
+                os.chdir(clusters_obj.outdir)
+                clusters_obj.write_versions_file(cwd)
+                with clusters_obj.stage_timer.stage('map_reads_and_make_read_store'):
+                    clusters_obj._map_and_cluster_reads()
+            if clusters_obj._can_run_clusters():
+                cluster_list = clusters_obj._construct_clusters()
+        except Exception as err:
+            self._sample_failed(sample_name, clusters_obj, err)
+            return
+        finally:
+            os.chdir(cwd)
+
+        # Clusters are taken off the list as they are sent, so that each
+        # Cluster object can be freed when it has finished
+        cluster_list.reverse()
+        results = []
+        if self.thread_budget is not None:
+            self.thread_budget.add_pending(len(cluster_list))
+        while len(cluster_list):
+            args = (cluster_list.pop(), self.verbose, self.clean, clusters_obj.fails_dir)
+            if self.pool is None:
+                results.append(clusters._run_cluster(*args))
+            else:
+                results.append(self.pool.apply_async(clusters._run_cluster, args))
+
+        self.running.append((sample_name, clusters_obj, results))
+
+
+    def _finish_sample(self, sample_name, clusters_obj, results):
+        '''Collects the results of the clusters of the sample, and writes
+           the output files of the sample'''
+        for result in results:
+            try:
+                clusters_obj._store_cluster_result(result if self.pool is None else result.get())
+            except:
+                clusters_obj.clusters_all_ran_ok = False
+
+        cwd = os.getcwd()
+        os.chdir(clusters_obj.outdir)
+
+        try:
+            if clusters_obj.log_files is not None:
+                clusters_obj._finish_running_clusters()
+            clusters_obj._write_outputs()
+            self.sample_status[sample_name] = ('finished', '.')
+        except Exception as err:
+            self._sample_failed(sample_name, clusters_obj, err)
+        finally:
+            os.chdir(cwd)
+
+
+    def _finish_samples(self, wait=False):
+        '''Finishes the samples whose clusters have all finished. If wait
+           is True, waits for all samples to finish'''
+        still_running = []
+
+        for sample_name, clusters_obj, results in self.running:
+            if wait or self.pool is None or all([x.ready() for x in results]):
+                self._finish_sample(sample_name, clusters_obj, results)
+            else:
+                still_running.append((sample_name, clusters_obj, results))
+
+        self.running = still_running
+
+
+    def run(self):
+        '''Raises Error if any samples failed, after running all the samples'''
+        self.loaded_refdata = clusters.Clusters._load_reference_data_from_dir(self.refdata_dir)
+
+        if not (self.resume and os.path.exists(self.outdir)):
+            try:
+                os.mkdir(self.outdir)
+            except:
+                raise Error('Error mkdir ' + self.outdir)
+
+        clusters.Clusters._set_signal_handlers(self._receive_signal)
+        if self.threads > 1:
+            self.thread_budget = thread_budget.ThreadBudget(self.threads)
+            self.pool = multiprocessing.Pool(self.threads, thread_budget.use_budget, (self.thread_budget,))
+
+        try:
+            # Reads of the next sample are mapped while the pool is running
+            # the clusters of the samples before it
+            for sample_name, reads_1, reads_2 in self.samples:
+                if self.resume and self._sample_finished(sample_name):
+                    if self.verbose:
+                        print('Sample', sample_name, 'finished in earlier run. Skipping', flush=True)
+                    self.sample_status[sample_name] = ('finished_earlier', '.')
+                    continue
+
+                self._start_sample(sample_name, reads_1, reads_2)
+                self._finish_samples()
+
+            self._finish_samples(wait=True)
+        except:
+            self._stop_pool()
+            raise
+        finally:
+            minimap_ariba.clear_reference_cache()
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        self._write_summary()
+        if len(self.failed_samples):
+            raise Error('These samples failed (see ' + self.summary_file + '):\n' + '\n'.join(self.failed_samples))
@@ -6,6 +6,8 @@ from ariba import mapping, faidx
 
 class Error (Exception): pass
 
+scorers = ['minimap', 'bowtie2']
+
 class BestSeqChooser:
     def __init__(self,
         reads1,
@@ -16,7 +18,15 @@ class BestSeqChooser:
         bowtie2_exe='bowtie2',
         bowtie2_preset='very-sensitive-local',
         threads=1,
+        scorer='minimap',
     ):
+        '''scorer = how to get the total alignment score of the reads against
+           each sequence. "minimap" maps the reads once, to all the sequences
+           (see mapping.get_total_alignment_scores). "bowtie2" runs bowtie2
+           against each sequence in turn'''
+        if scorer not in scorers:
+            raise Error('Unknown scorer "' + str(scorer) + '". Must be one of: ' + ', '.join(scorers))
+
         self.reads1 = reads1
         self.reads2 = reads2
         self.references_fa = references_fa
@@ -25,6 +35,7 @@ class BestSeqChooser:
         self.bowtie2_exe = bowtie2_exe
         self.bowtie2_preset = bowtie2_preset
         self.threads = threads
+        self.scorer = scorer
 
 
     def _total_alignment_score(self, seq_name):
@@ -70,15 +81,20 @@ class BestSeqChooser:
             return seq_name
 
         print('\nChoosing best sequence from cluster of', total_sequences, 'sequences...', file=self.log_fh)
-        file_reader = pyfastaq.sequences.file_reader(self.references_fa)
+        if self.scorer == 'minimap':
+            scores = mapping.get_total_alignment_scores(self.reads1, self.reads2, self.references_fa, threads=self.threads)
+        else:
+            scores = {}
+            for seq in pyfastaq.sequences.file_reader(self.references_fa):
+                scores[seq.id] = self._total_alignment_score(seq.id)
+
         best_score = 0
         best_seq_name = None
-        for seq in file_reader:
-            score = self._total_alignment_score(seq.id)
-            print('Total alignment score for sequence', seq.id, 'is', score, file=self.log_fh)
+        for seq_name, score in scores.items():
+            print('Total alignment score for sequence', seq_name, 'is', score, file=self.log_fh)
             if score > best_score:
                 best_score = score
-                best_seq_name = seq.id
+                best_seq_name = seq_name
 
         print('\nBest sequence is', best_seq_name, 'with total alignment score of', best_score, file=self.log_fh)
         print(file=self.log_fh)
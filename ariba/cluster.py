@@ -6,7 +6,7 @@ import math
 import shutil
 import sys
 import pyfastaq
-from ariba import assembly, assembly_compare, assembly_variants, external_progs, flag, mapping, read_filter, report, samtools_variants
+from ariba import assembly, assembly_compare, assembly_variants, external_progs, flag, read_filter, report, samtools_variants, stage_timer
 
 class Error (Exception): pass
 
@@ -19,9 +19,11 @@ class Cluster:
       refdata,
       total_reads=None,
       total_reads_bases=None,
+      total_reads_before_cap=None,
       fail_file=None,
       read_store=None,
       reference_names=None,
+      ref_sketches=None,
       logfile=None,
       assembly_coverage=50,
       assembly_kmer=21,
@@ -46,6 +48,10 @@ class Cluster:
       clean=True,
       extern_progs=None,
       random_seed=42,
+      read_filter_engine='cdhit',
+      contig_aligner='nucmer',
+      assembly_mapper='bowtie2',
+      ref_chooser='mash',
     ):
         self.root_dir = os.path.abspath(root_dir)
         self.read_store = read_store
@@ -54,6 +60,7 @@ class Cluster:
         self.fail_file = fail_file
         self.reference_fa = os.path.join(self.root_dir, 'reference.fa')
         self.reference_names = reference_names
+        self.ref_sketches = ref_sketches
         self.all_reads1 = os.path.join(self.root_dir, 'reads_1.fq')
         self.all_reads2 = os.path.join(self.root_dir, 'reads_2.fq')
         self.references_fa = os.path.join(self.root_dir, 'references.fa')
@@ -63,6 +70,11 @@ class Cluster:
 
         self.total_reads = total_reads
         self.total_reads_bases = total_reads_bases
+        # Number of reads that minimap mapped to the cluster. Can be more than
+        # were in the read store, if the number of reads per cluster was capped.
+        # In which case, uncapped_total_reads is an estimate of total_reads without the cap
+        self.total_reads_before_cap = total_reads_before_cap
+        self.uncapped_total_reads = total_reads
         self.logfile = logfile
         self.assembly_coverage = assembly_coverage
         self.assembly_kmer = assembly_kmer
@@ -71,6 +83,10 @@ class Cluster:
         self.sspace_sd = sspace_sd
         self.reads_insert = reads_insert
         self.spades_other_options = spades_other_options
+        self.read_filter_engine = read_filter_engine
+        self.contig_aligner = contig_aligner
+        self.assembly_mapper = assembly_mapper
+        self.ref_chooser = ref_chooser
 
         self.reads_for_assembly1 = os.path.join(self.root_dir, 'reads_for_assembly_1.fq')
         self.reads_for_assembly2 = os.path.join(self.root_dir, 'reads_for_assembly_2.fq')
@@ -95,6 +111,8 @@ class Cluster:
         self.max_gene_nt_extend = max_gene_nt_extend
         self.status_flag = flag.Flag()
         self.clean = clean
+        self.run_seconds = None # set by clusters._run_cluster()
+        self.stage_timer = stage_timer.StageTimer()
 
         self.assembly_dir = os.path.join(self.root_dir, 'Assembly')
         self.final_assembly_fa = os.path.join(self.root_dir, 'assembly.fa')
@@ -176,9 +194,15 @@ class Cluster:
 
             self.refdata.write_seqs_to_fasta(self.references_fa, self.reference_names)
             self.log_fh = pyfastaq.utils.open_file_write(self.logfile)
-            self.read_store.get_reads(self.name, self.all_reads1, self.all_reads2)
-            rfilter = read_filter.ReadFilter(self.read_store, self.references_fa, self.name, self.log_fh, self.extern_progs)
-            self.total_reads, self.total_reads_bases = rfilter.run(self.all_reads1, self.all_reads2)
+            with self.stage_timer.stage('read_extraction'):
+                read_batch = self.read_store.get_batch(self.name, log_fh=self.log_fh)
+            with self.stage_timer.stage('read_filter'):
+                rfilter = read_filter.ReadFilter(self.read_store, self.references_fa, self.name, self.log_fh, self.extern_progs, engine=self.read_filter_engine)
+                self.total_reads, self.total_reads_bases = rfilter.run(self.all_reads1, self.all_reads2, batch=read_batch)
+            self.uncapped_total_reads = self._uncapped_read_count(self.total_reads, len(read_batch), self.total_reads_before_cap)
+            if self.uncapped_total_reads != self.total_reads:
+                print('Reads for this cluster were capped at', len(read_batch), 'out of', self.total_reads_before_cap, file=self.log_fh)
+                print('Estimated total reads after filtering, without the cap:', self.uncapped_total_reads, file=self.log_fh, flush=True)
             self.refdata.write_seqs_to_fasta(self.references_fa, self.reference_names)
 
         self.longest_ref_length = max([len(self.refdata.sequence(name)) for name in self.reference_names])
@@ -218,6 +242,16 @@ class Cluster:
                 self._clean_file(filename)
 
 
+    @staticmethod
+    def _uncapped_read_count(filtered_reads, stored_reads, reads_before_cap):
+        '''Returns estimate of number of reads after filtering, had all reads before the cap been stored'''
+        if reads_before_cap is None or stored_reads == 0 or reads_before_cap <= stored_reads:
+            return filtered_reads
+
+        uncapped = int(round(filtered_reads * reads_before_cap / stored_reads))
+        return uncapped + uncapped % 2
+
+
     @staticmethod
     def _number_of_reads_for_assembly(ref_length, insert_size, total_bases, total_reads, coverage):
         assert ref_length > 0
@@ -302,8 +336,9 @@ class Cluster:
             print('No reads left after filtering with cdhit', file=self.log_fh, flush=True)
             self.assembled_ok = False
         else:
-            wanted_reads = self._number_of_reads_for_assembly(self.longest_ref_length, self.reads_insert, self.total_reads_bases, self.total_reads, self.assembly_coverage)
-            made_reads = self._make_reads_for_assembly(wanted_reads, self.total_reads, self.all_reads1, self.all_reads2, self.reads_for_assembly1, self.reads_for_assembly2, random_seed=self.random_seed)
+            with self.stage_timer.stage('subsampling'):
+                wanted_reads = self._number_of_reads_for_assembly(self.longest_ref_length, self.reads_insert, self.total_reads_bases, self.total_reads, self.assembly_coverage)
+                made_reads = self._make_reads_for_assembly(wanted_reads, self.total_reads, self.all_reads1, self.all_reads2, self.reads_for_assembly1, self.reads_for_assembly2, random_seed=self.random_seed)
             print('\nUsing', made_reads, 'from a total of', self.total_reads, 'for assembly.', file=self.log_fh, flush=True)
             print('Assembling reads:', file=self.log_fh, flush=True)
 
@@ -324,7 +359,16 @@ class Cluster:
               sspace_sd=self.sspace_sd,
               reads_insert=self.reads_insert,
               extern_progs=self.extern_progs,
-              clean=self.clean
+              clean=self.clean,
+              timer=self.stage_timer,
+              threads=self.threads,
+              ref_sketches=self.ref_sketches,
+              final_assembly_coords=assembly_compare.AssemblyCompare.nucmer_coords_file_from_prefix(self.assembly_compare_prefix),
+              contig_aligner=self.contig_aligner,
+              map_reads1=self.all_reads1,
+              map_reads2=self.all_reads2,
+              assembly_mapper=self.assembly_mapper,
+              ref_chooser=self.ref_chooser,
             )
 
             self.assembly.run()
@@ -342,21 +386,7 @@ class Cluster:
             self.is_gene = '1' if is_gene == 'p' else '0'
             self.is_variant_only = '1' if is_variant_only else '0'
 
-            print('\nAssembly was successful\n\nMapping reads to assembly:', file=self.log_fh, flush=True)
-
-            mapping.run_bowtie2(
-                self.all_reads1,
-                self.all_reads2,
-                self.final_assembly_fa,
-                self.final_assembly_bam[:-4],
-                threads=1,
-                sort=True,
-                samtools=self.extern_progs.exe('samtools'),
-                bowtie2=self.extern_progs.exe('bowtie2'),
-                bowtie2_preset='very-sensitive-local',
-                verbose=True,
-                verbose_filehandle=self.log_fh
-            )
+            print('\nAssembly was successful', file=self.log_fh, flush=True)
 
             if self.assembly.has_contigs_on_both_strands:
                 self.status_flag.add('hit_both_strands')
@@ -380,13 +410,16 @@ class Cluster:
               assembled_threshold=self.assembled_threshold,
               unique_threshold=self.unique_threshold,
               max_gene_nt_extend=self.max_gene_nt_extend,
+              run_nucmer=False,
+              contig_aligner=self.contig_aligner,
             )
-            self.assembly_compare.run()
-            self.status_flag = self.assembly_compare.update_flag(self.status_flag)
+            with self.stage_timer.stage('nucmer_compare'):
+                self.assembly_compare.run()
+                self.status_flag = self.assembly_compare.update_flag(self.status_flag)
 
-            nucmer_hits_to_ref = assembly_compare.AssemblyCompare.nucmer_hits_to_ref_coords(self.assembly_compare.nucmer_hits)
-            assembly_variants_obj = assembly_variants.AssemblyVariants(self.refdata, self.assembly_compare.nucmer_snps_file)
-            self.assembly_variants = assembly_variants_obj.get_variants(self.ref_sequence.id, nucmer_hits_to_ref)
+                nucmer_hits_to_ref = assembly_compare.AssemblyCompare.nucmer_hits_to_ref_coords(self.assembly_compare.nucmer_hits)
+                assembly_variants_obj = assembly_variants.AssemblyVariants(self.refdata, self.assembly_compare.nucmer_snps_file)
+                self.assembly_variants = assembly_variants_obj.get_variants(self.ref_sequence.id, nucmer_hits_to_ref)
 
             for var_list in self.assembly_variants.values():
                 for var in var_list:
@@ -412,9 +445,10 @@ class Cluster:
                 bcf_min_dv_over_dp=self.bcf_min_dv_over_dp,
                 bcf_min_qual=self.bcf_min_qual,
             )
-            self.samtools_vars.run()
+            with self.stage_timer.stage('mpileup_bcftools'):
+                self.samtools_vars.run()
 
-            self.total_contig_depths = self.samtools_vars.total_depth_per_contig(self.samtools_vars.read_depths_file)
+            self.total_contig_depths = self.samtools_vars.read_depths_lookup().total_depth_per_contig()
 
             self.variants_from_samtools =  self.samtools_vars.variants_in_coords(self.assembly_compare.assembly_match_coords(), self.samtools_vars.vcf_file)
             if len(self.variants_from_samtools):
@@ -428,6 +462,7 @@ class Cluster:
 
 
         print('\nMaking report lines', file=self.log_fh, flush=True)
-        self.report_lines = report.report_lines(self)
+        with self.stage_timer.stage('report_lines'):
+            self.report_lines = report.report_lines(self)
         self._clean()
         atexit.unregister(self._atexit)
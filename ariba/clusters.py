@@ -10,26 +10,78 @@ import shutil
 import multiprocessing
 import pyfastaq
 import minimap_ariba
-from ariba import cluster, common, histogram, read_store, report, report_filter, reference_data
+from ariba import assembly, cluster, common, histogram, ksw_aligner, mapping, mash, read_filter, read_store, report, report_filter, reference_data, stage_timer, thread_budget
 
 class Error (Exception): pass
 
+# Weights of the model used to predict how long each cluster takes to run,
+# in units of one read base. The predicted and actual run times are written
+# to log.cluster_costs.tsv, so these can be tuned
+cluster_cost_per_cluster = 1000000
+cluster_cost_per_reference_base = 1000
+
+
+def _predicted_cluster_cost(bases, reference_lengths, read_cap_coverage=0):
+    '''Returns predicted cost of running a cluster, given the number of read
+       bases mapped to it, and list of lengths of its reference sequences.
+       read_cap_coverage is the cap on read coverage (over the longest
+       reference) of reads kept for the cluster, or zero for no cap'''
+    if read_cap_coverage > 0 and len(reference_lengths) > 0:
+        bases = min(bases, read_cap_coverage * max(reference_lengths))
+    return cluster_cost_per_cluster + bases + cluster_cost_per_reference_base * sum(reference_lengths)
+
+
+class ClusterResult:
+    def __init__(self, cluster_obj, ran_ok=False):
+        '''The parts of a cluster.Cluster that are needed after it has run.
+           This is much smaller than the Cluster, so is what gets sent back
+           from the worker processes'''
+        self.name = cluster_obj.name
+        self.ran_ok = ran_ok
+        self.logfile = cluster_obj.logfile
+        self.run_seconds = cluster_obj.run_seconds
+        timer = getattr(cluster_obj, 'stage_timer', None)
+        self.stage_timings = [] if timer is None else timer.stages
+        self.report_lines = getattr(cluster_obj, 'report_lines', None)
+        assembly = getattr(cluster_obj, 'assembly', None)
+        self.assembly_sequences = getattr(assembly, 'sequences', None)
+        self.assembled_reference_sequences = None
+        self.gene_matching_ref = None
+        self.gene_matching_ref_type = None
+        self.gene_start_bases_added = None
+        self.gene_end_bases_added = None
+
+        if cluster_obj.assembly_compare is not None:
+            compare = cluster_obj.assembly_compare
+            self.assembled_reference_sequences = getattr(compare, 'assembled_reference_sequences', None)
+            self.gene_matching_ref = compare.gene_matching_ref
+            self.gene_matching_ref_type = compare.gene_matching_ref_type
+            self.gene_start_bases_added = compare.gene_start_bases_added
+            self.gene_end_bases_added = compare.gene_end_bases_added
+
 
 def _run_cluster(obj, verbose, clean, fails_dir):
+    '''Runs the cluster and returns a ClusterResult'''
     failed_clusters = os.listdir(fails_dir)
 
     if len(failed_clusters) > 0:
         print('Other clusters failed. Will not start cluster', obj.name, file=sys.stderr)
-        return obj
+        thread_budget.cluster_skipped()
+        return ClusterResult(obj)
 
     if verbose:
         print('Start running cluster', obj.name, 'in directory', obj.root_dir, flush=True)
+    start_time = time.time()
+    ran_ok = True
     try:
-        obj.run()
+        with thread_budget.cluster_running():
+            obj.run()
     except:
+        ran_ok = False
         print('Failed cluster:', obj.name, file=sys.stderr)
         with open(os.path.join(fails_dir, obj.name), 'w'):
             pass
+    obj.run_seconds = time.time() - start_time
 
     if verbose:
         print('Finished running cluster', obj.name, 'in directory', obj.root_dir, flush=True)
@@ -40,7 +92,11 @@ def _run_cluster(obj, verbose, clean, fails_dir):
         if os.path.exists(obj.root_dir):
             shutil.rmtree(obj.root_dir)
 
-    return obj
+    return ClusterResult(obj, ran_ok=ran_ok)
+
+
+def _run_cluster_star(args):
+    return _run_cluster(*args)
 
 
 class Clusters:
@@ -67,15 +123,46 @@ class Clusters:
       max_gene_nt_extend=30,
       clean=True,
       tmp_dir=None,
+      read_store_format='native',
+      kmer_prescreen=True,
+      cluster_read_cap=0,
+      read_filter_engine='cdhit',
+      contig_aligner='nucmer',
+      assembly_mapper='bowtie2',
+      ref_chooser='mash',
+      resume=False,
+      loaded_refdata=None,
+      keep_reference_index=False,
     ):
+        '''loaded_refdata = tuple (refdata, cluster_ids, ref_sketches) returned by
+           _load_reference_data_from_dir(refdata_dir), so that it is not
+           loaded again. If keep_reference_index is True, the minimap index of
+           the reference sequences is kept in memory after mapping, for the
+           next Clusters object that uses the same refdata_dir'''
         self.refdata_dir = os.path.abspath(refdata_dir)
-        self.refdata, self.cluster_ids = self._load_reference_data_from_dir(refdata_dir)
+        if loaded_refdata is None:
+            self.refdata, self.cluster_ids, self.ref_sketches = self._load_reference_data_from_dir(refdata_dir)
+        else:
+            self.refdata, self.cluster_ids, self.ref_sketches = loaded_refdata
         self.reads_1 = os.path.abspath(reads_1)
         self.reads_2 = os.path.abspath(reads_2)
         self.outdir = os.path.abspath(outdir)
         self.extern_progs = extern_progs
         self.clusters_tsv = os.path.abspath(os.path.join(refdata_dir, '02.cdhit.clusters.tsv'))
         self.all_ref_seqs_fasta = os.path.abspath(os.path.join(refdata_dir, '02.cdhit.all.fa'))
+        self.all_ref_seqs_minimap_index = os.path.abspath(os.path.join(refdata_dir, '02.cdhit.all.mmi'))
+        self.all_ref_seqs_kmer_filter = os.path.abspath(os.path.join(refdata_dir, '02.cdhit.all.kmers'))
+        self.kmer_prescreen = kmer_prescreen
+        self.cluster_read_cap = cluster_read_cap
+        self.keep_reference_index = keep_reference_index
+        self.read_filter_engine = read_filter_engine
+        assert self.read_filter_engine in read_filter.filter_engines
+        self.contig_aligner = contig_aligner
+        assert self.contig_aligner in ksw_aligner.aligners
+        self.assembly_mapper = assembly_mapper
+        assert self.assembly_mapper in mapping.mappers
+        self.ref_chooser = ref_chooser
+        assert self.ref_chooser in assembly.ref_choosers
 
         if version_report_lines is None:
             self.version_report_lines = []
@@ -83,6 +170,8 @@ class Clusters:
             self.version_report_lines = version_report_lines
 
         self.clean = clean
+        self.read_store_format = read_store_format
+        assert self.read_store_format in read_store.store_formats
         self.logs_dir = os.path.join(self.outdir, 'Logs')
 
         self.assembler = assembler
@@ -122,19 +211,34 @@ class Clusters:
         self.max_gene_nt_extend = max_gene_nt_extend
 
         self.cluster_to_dir = {}  # gene name -> abs path of cluster directory
-        self.clusters = {}        # gene name -> Cluster object
+        self.clusters = {}        # gene name -> ClusterResult object
         self.cluster_read_counts = {} # gene name -> number of reads
         self.cluster_base_counts = {} # gene name -> number of bases
+        self.cluster_costs = {} # gene name -> predicted cost of running the cluster
+        self.cluster_costs_file = os.path.join(self.outdir, 'log.cluster_costs.tsv')
+        self.stage_timer = stage_timer.StageTimer()
+        self.stage_timings_file = os.path.join(self.outdir, 'stage_timings.tsv')
         self.pool = None
         self.fails_dir = os.path.join(self.outdir ,'.fails')
         self.clusters_all_ran_ok = True
+        self.resume = resume
+        self.checkpoint_dir = os.path.join(self.outdir, 'checkpoints')
+        self.mapping_checkpoint = os.path.join(self.checkpoint_dir, 'mapping.pickle')
 
-        for d in [self.outdir, self.logs_dir, self.fails_dir]:
+        # Checkpoints are always written, so that any run that is stopped can be resumed
+        for d in [self.outdir, self.logs_dir, self.fails_dir, self.checkpoint_dir]:
+            if self.resume and os.path.exists(d):
+                continue
             try:
                 os.mkdir(d)
             except:
                 raise Error('Error mkdir ' + d)
 
+        if self.resume:
+            # Failed clusters from the earlier run get another go
+            for filename in os.listdir(self.fails_dir):
+                os.unlink(os.path.join(self.fails_dir, filename))
+
         if tmp_dir is None:
             if 'ARIBA_TMPDIR' in os.environ:
                 tmp_dir = os.path.abspath(os.environ['ARIBA_TMPDIR'])
@@ -145,23 +249,34 @@ class Clusters:
             raise Error('Temporary directory ' + tmp_dir + ' not found. Cannot continue')
 
         if self.clean:
+            if self.resume and os.path.samefile(tmp_dir, self.outdir):
+                for filename in os.listdir(self.outdir):
+                    if filename.startswith('ariba.tmp.'):
+                        shutil.rmtree(os.path.join(self.outdir, filename), ignore_errors=True)
+
             self.tmp_dir_obj = tempfile.TemporaryDirectory(prefix='ariba.tmp.', dir=os.path.abspath(tmp_dir))
             self.tmp_dir = self.tmp_dir_obj.name
         else:
             self.tmp_dir_obj = None
             self.tmp_dir = os.path.join(self.outdir, 'clusters')
-            try:
-                os.mkdir(self.tmp_dir)
-            except:
-                raise Error('Error making directory ' + self.tmp_dir)
+            if not (self.resume and os.path.exists(self.tmp_dir)):
+                try:
+                    os.mkdir(self.tmp_dir)
+                except:
+                    raise Error('Error making directory ' + self.tmp_dir)
 
         if self.verbose:
             print('Temporary directory:', self.tmp_dir)
 
+        self._set_signal_handlers(self._receive_signal)
+
+
+    @staticmethod
+    def _set_signal_handlers(handler):
         for i in [x for x in dir(signal) if x.startswith("SIG") and x not in {'SIGCHLD', 'SIGCLD'}]:
             try:
                 signum = getattr(signal, i)
-                signal.signal(signum, self._receive_signal)
+                signal.signal(signum, handler)
             except:
                 pass
 
@@ -219,6 +334,7 @@ class Clusters:
         metadata_file = os.path.join(indir, '01.filter.check_metadata.tsv')
         info_file = os.path.join(indir, '00.info.txt')
         clusters_pickle_file = os.path.join(indir, '02.cdhit.clusters.pickle')
+        sketches_file = os.path.join(indir, '02.cdhit.all.sketches.pickle')
         params = Clusters._load_reference_data_info_file(info_file)
         refdata = reference_data.ReferenceData(
             [fasta_file],
@@ -229,7 +345,81 @@ class Clusters:
         with open(clusters_pickle_file, 'rb') as f:
             cluster_ids = pickle.load(f)
 
-        return refdata, cluster_ids
+        # Reference data made by older versions of ariba do not have sketches
+        ref_sketches = mash.load_sketches(sketches_file)
+        return refdata, cluster_ids, ref_sketches
+
+
+    @staticmethod
+    def _write_checkpoint(obj, outfile):
+        '''Pickles obj to outfile, so that outfile is either complete or
+           does not exist, even if the process is killed'''
+        tmp_file = outfile + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, outfile)
+
+
+    @staticmethod
+    def _load_checkpoint(infile):
+        with open(infile, 'rb') as f:
+            return pickle.load(f)
+
+
+    @staticmethod
+    def _load_cluster_checkpoints(indir):
+        '''Returns dict of cluster name -> ClusterResult, of the clusters
+           that finished in an earlier run'''
+        results = {}
+
+        for filename in os.listdir(indir):
+            if filename.startswith('cluster.') and filename.endswith('.pickle'):
+                result = Clusters._load_checkpoint(os.path.join(indir, filename))
+                results[result.name] = result
+
+        return results
+
+
+    def _cluster_checkpoint_file(self, cluster_name):
+        return os.path.join(self.checkpoint_dir, 'cluster.' + cluster_name + '.pickle')
+
+
+    def _checkpoint_options(self):
+        '''Options that change the read mapping, read store or output of any
+           cluster. These must be the same to resume a run'''
+        return {
+            'refdata_dir': self.refdata_dir,
+            'reads_1': self.reads_1,
+            'reads_2': self.reads_2,
+            'read_store_format': self.read_store_format,
+            'kmer_prescreen': self.kmer_prescreen,
+            'read_cap_coverage': self.cluster_read_cap * self.assembly_coverage,
+            'assembly_kmer': self.assembly_kmer,
+            'assembly_coverage': self.assembly_coverage,
+            'assembler': self.assembler,
+            'spades_other': self.spades_other,
+            'max_insert': self.max_insert,
+            'min_scaff_depth': self.min_scaff_depth,
+            'nucmer_min_id': self.nucmer_min_id,
+            'nucmer_min_len': self.nucmer_min_len,
+            'nucmer_breaklen': self.nucmer_breaklen,
+            'assembled_threshold': self.assembled_threshold,
+            'unique_threshold': self.unique_threshold,
+            'max_gene_nt_extend': self.max_gene_nt_extend,
+            'read_filter_engine': self.read_filter_engine,
+            'contig_aligner': self.contig_aligner,
+            'assembly_mapper': self.assembly_mapper,
+            'ref_chooser': self.ref_chooser,
+        }
+
+
+    @staticmethod
+    def _different_options(earlier_options, options):
+        '''Returns sorted list of names of options that are different between
+           the two dicts made by _checkpoint_options()'''
+        return sorted([x for x in set(earlier_options).union(options) if earlier_options.get(x) != options.get(x)])
 
 
     def _map_and_cluster_reads(self):
@@ -237,15 +427,20 @@ class Clusters:
             print('{:_^79}'.format(' Mapping reads to clustered genes '), flush=True)
 
         minimap_prefix = 'minimap'
+        reuse_mapping = self.resume and os.path.exists(self.mapping_checkpoint)
 
-        self._minimap_reads_to_all_ref_seqs(
-            self.clusters_tsv,
-            self.all_ref_seqs_fasta,
-            self.reads_1,
-            self.reads_2,
-            minimap_prefix,
-            verbose=self.verbose
-        )
+        if reuse_mapping:
+            different = self._different_options(self._load_checkpoint(self.mapping_checkpoint), self._checkpoint_options())
+            if len(different):
+                raise Error('Cannot resume, because these options are different from the earlier run: ' + ', '.join(different))
+            if self.verbose:
+                print('Using read mapping from earlier run', flush=True)
+        else:
+            if self.resume:
+                for filename in [os.path.join(self.outdir, 'read_store' + x) for x in ['.bin', '.gz', '.gz.tbi']]:
+                    if os.path.exists(filename):
+                        os.unlink(filename)
+            self._map_reads_to_all_ref_seqs(minimap_prefix)
 
         if self.verbose:
             print('Finished mapping\n')
@@ -253,7 +448,7 @@ class Clusters:
 
         self.cluster_to_rep, self.cluster_read_counts, self.cluster_base_counts, self.insert_hist, self.proper_pairs = self._load_minimap_files(minimap_prefix, self.insert_hist_bin)
         self.cluster_to_dir = {x: os.path.join(self.tmp_dir, x) for x in self.cluster_to_rep}
-        reads_file_for_read_store = minimap_prefix + '.reads'
+        reads_file_for_read_store = minimap_prefix + ('.readStore' if self.read_store_format == 'native' else '.reads')
 
         if len(self.cluster_read_counts):
             if self.verbose:
@@ -262,20 +457,19 @@ class Clusters:
                 filehandle = None
 
             self.read_store = read_store.ReadStore(
-              reads_file_for_read_store,
+              None if reuse_mapping else reads_file_for_read_store,
               os.path.join(self.outdir, 'read_store'),
-              log_fh=filehandle
+              log_fh=filehandle,
+              store_format=self.read_store_format,
             )
 
-        os.unlink(reads_file_for_read_store)
+        if os.path.exists(reads_file_for_read_store):
+            os.unlink(reads_file_for_read_store)
 
-        if self.clean:
-            for suffix in ['cluster2representative', 'clusterCounts', 'insertHistogram', 'properPairs']:
-                filename = minimap_prefix + '.' + suffix
-                try:
-                    os.unlink(filename)
-                except:
-                    pass
+        # The minimap files are kept until the end of the run, so that it can be resumed.
+        # The mapping checkpoint is only written once mapping has finished
+        if not reuse_mapping:
+            self._write_checkpoint(self._checkpoint_options(), self.mapping_checkpoint)
 
         if self.verbose:
             print('Found', self.proper_pairs, 'proper read pairs from minimap')
@@ -283,10 +477,59 @@ class Clusters:
 
 
     @staticmethod
-    def _minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, outprefix, verbose=False):
-        got = minimap_ariba.minimap_ariba(clusters_tsv, ref_fasta, reads_1, reads_2, outprefix)
-        if (got != 0):
-            raise Error('Error running minimap. Cannot continue')
+    def _delete_minimap_files(minimap_prefix):
+        for suffix in ['cluster2representative', 'clusterCounts', 'insertHistogram', 'prescreen', 'properPairs']:
+            filename = minimap_prefix + '.' + suffix
+            try:
+                os.unlink(filename)
+            except:
+                pass
+
+
+    def _map_reads_to_all_ref_seqs(self, minimap_prefix):
+        self._minimap_reads_to_all_ref_seqs(
+            self.clusters_tsv,
+            self.all_ref_seqs_fasta,
+            self.reads_1,
+            self.reads_2,
+            minimap_prefix,
+            threads=self.threads,
+            index_file=self.all_ref_seqs_minimap_index,
+            native_read_store=self.read_store_format == 'native',
+            kmer_prescreen=self.kmer_prescreen,
+            kmer_filter_file=self.all_ref_seqs_kmer_filter,
+            read_cap_coverage=self.cluster_read_cap * self.assembly_coverage,
+            keep_index=self.keep_reference_index,
+            verbose=self.verbose
+        )
+
+        if self.kmer_prescreen and self.verbose:
+            prescreen_stats = self._load_minimap_prescreen_stats(minimap_prefix + '.prescreen')
+            print('K-mer prescreen removed', prescreen_stats['read_pairs_screened_out'], 'of', prescreen_stats['read_pairs'], 'read pairs before mapping')
+            print('Time taken by prescreen:', round(prescreen_stats['prescreen_seconds'], 2), 'seconds. Estimated time saved:', round(prescreen_stats['estimated_seconds_saved'], 2), 'seconds')
+
+
+    @staticmethod
+    def _minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, outprefix, threads=1, index_file=None, native_read_store=False, kmer_prescreen=False, kmer_filter_file=None, read_cap_coverage=0, keep_index=False, verbose=False):
+        '''If read_cap_coverage > 0 and using the native read store, the read pairs stored for each cluster
+           are a random sample, capped at this coverage of the longest reference sequence in the cluster.
+           The read counts output by minimap are always of all reads, before the cap.
+           If keep_index is True, the index and k-mer filter are kept in memory and used
+           by the next call with the same ref_fasta. Free them with minimap_ariba.clear_reference_cache()'''
+        if index_file is None or not os.path.exists(index_file):
+            if verbose and index_file is not None:
+                print('Minimap index file', index_file, 'not found. Will index reference sequences instead', flush=True)
+            index_file = ''
+
+        if kmer_filter_file is None or not os.path.exists(kmer_filter_file):
+            if verbose and kmer_prescreen and kmer_filter_file is not None:
+                print('K-mer prescreen filter file', kmer_filter_file, 'not found. Will make filter from reference sequences instead', flush=True)
+            kmer_filter_file = ''
+
+        try:
+            minimap_ariba.minimap_ariba(clusters_tsv, ref_fasta, reads_1, reads_2, outprefix, threads, index_file, int(native_read_store), int(kmer_prescreen), kmer_filter_file, read_cap_coverage, int(keep_index))
+        except ValueError as error:
+            raise Error('Error running minimap. Cannot continue. ' + str(error))
 
 
     @classmethod
@@ -337,6 +580,18 @@ class Clusters:
         return pairs
 
 
+    @classmethod
+    def _load_minimap_prescreen_stats(cls, infile):
+        stats = {}
+
+        with open(infile) as f:
+            for line in f:
+                name, value = line.rstrip().split('\t')
+                stats[name] = int(value) if name.startswith('read_pairs') else float(value)
+
+        return stats
+
+
     @staticmethod
     def _load_minimap_files(inprefix, hist_bin_size):
         cluster2rep = Clusters._load_minimap_out_cluster2representative(inprefix + '.cluster2representative')
@@ -362,20 +617,39 @@ class Clusters:
             return True
 
 
-    def _init_and_run_clusters(self):
+    def _construct_clusters(self):
+        '''Returns list of Cluster objects that need running, most expensive first'''
         if len(self.cluster_to_dir) == 0:
             raise Error('Did not get any reads mapped to genes. Cannot continue')
 
         counter = 0
         cluster_list = []
-        self.log_files = []
+        self.log_files = [os.path.join(self.logs_dir, x + '.log') for x in sorted(self.cluster_to_dir)]
+        self.clusters = {}
 
-        for cluster_name in sorted(self.cluster_to_dir):
+        if self.resume:
+            self.clusters = {x: y for x, y in self._load_cluster_checkpoints(self.checkpoint_dir).items() if x in self.cluster_to_dir}
+            if self.verbose:
+                print('Found', len(self.clusters), 'clusters that finished in earlier run. These will not be run again', flush=True)
+
+        self.cluster_costs = {}
+        for cluster_name in self.cluster_to_dir:
+            self.cluster_costs[cluster_name] = _predicted_cluster_cost(
+                self.cluster_base_counts.get(cluster_name, 0),
+                [len(self.refdata.sequence(x)) for x in self.cluster_ids[cluster_name]],
+                read_cap_coverage=self.cluster_read_cap * self.assembly_coverage,
+            )
+
+        # Start the most expensive clusters first, so that a big cluster does
+        # not start near the end of the run while the other cores are idle
+        clusters_to_run = [x for x in self.cluster_to_dir if x not in self.clusters]
+        for cluster_name in sorted(clusters_to_run, key=lambda x: (-self.cluster_costs[x], x)):
             counter += 1
             if self.verbose:
-                print('Constructing cluster ', cluster_name, ' (', counter, ' of ', len(self.cluster_to_dir), ')', sep='')
+                print('Constructing cluster ', cluster_name, ' (', counter, ' of ', len(clusters_to_run), ', predicted cost ', self.cluster_costs[cluster_name], ')', sep='')
             new_dir = self.cluster_to_dir[cluster_name]
-            self.log_files.append(os.path.join(self.logs_dir, cluster_name + '.log'))
+            if self.resume and os.path.exists(new_dir):
+                shutil.rmtree(new_dir)
 
             cluster_list.append(cluster.Cluster(
                 new_dir,
@@ -383,8 +657,10 @@ class Clusters:
                 self.refdata,
                 fail_file=os.path.join(self.fails_dir, cluster_name),
                 read_store=self.read_store,
+                total_reads_before_cap=self.cluster_read_counts.get(cluster_name),
                 reference_names=self.cluster_ids[cluster_name],
-                logfile=self.log_files[-1],
+                ref_sketches=None if self.ref_sketches is None else {x: self.ref_sketches[x] for x in self.cluster_ids[cluster_name] if x in self.ref_sketches},
+                logfile=os.path.join(self.logs_dir, cluster_name + '.log'),
                 assembly_coverage=self.assembly_coverage,
                 assembly_kmer=self.assembly_kmer,
                 assembler=self.assembler,
@@ -396,7 +672,7 @@ class Clusters:
                 reads_insert=self.insert_size,
                 sspace_k=self.min_scaff_depth,
                 sspace_sd=self.insert_sspace_sd,
-                threads=1, # clusters now run in parallel, so this should always be 1!
+                threads=1, # clusters run in parallel, so this should always be 1! Spare threads are lent by thread_budget
                 bcf_min_dp=10,            # let the user change this in a future version?
                 bcf_min_dv=5,             # let the user change this in a future version?
                 bcf_min_dv_over_dp=0.3,   # let the user change this in a future version?
@@ -407,22 +683,68 @@ class Clusters:
                 spades_other_options=self.spades_other,
                 clean=self.clean,
                 extern_progs=self.extern_progs,
+                read_filter_engine=self.read_filter_engine,
+                contig_aligner=self.contig_aligner,
+                assembly_mapper=self.assembly_mapper,
+                ref_chooser=self.ref_chooser,
             ))
 
+        return cluster_list
+
+
+    def _store_cluster_result(self, result):
+        self.clusters[result.name] = result
+        if result.ran_ok:
+            self._write_checkpoint(result, self._cluster_checkpoint_file(result.name))
+
+
+    def _finish_running_clusters(self):
+        if len(os.listdir(self.fails_dir)) > 0:
+            self.clusters_all_ran_ok = False
+
+        self._write_cluster_costs(self.clusters, self.cluster_costs, self.cluster_costs_file)
+        if self.verbose:
+            print('Predicted and actual run times of clusters written to', self.cluster_costs_file, flush=True)
+
+
+    def _init_and_run_clusters(self):
+        cluster_list = self._construct_clusters()
+
+        # Clusters are taken off the list as they are started, so that each
+        # Cluster object can be freed when it has finished
+        cluster_list.reverse()
+        cluster_args = ((cluster_list.pop(), self.verbose, self.clean, self.fails_dir) for i in range(len(cluster_list)))
+
         try:
             if self.threads > 1:
-                self.pool = multiprocessing.Pool(self.threads)
-                cluster_list = self.pool.starmap(_run_cluster, zip(cluster_list, itertools.repeat(self.verbose), itertools.repeat(self.clean), itertools.repeat(self.fails_dir)))
+                budget = thread_budget.ThreadBudget(self.threads)
+                budget.add_pending(len(cluster_list))
+                self.pool = multiprocessing.Pool(self.threads, thread_budget.use_budget, (budget,))
+                results = self.pool.imap_unordered(_run_cluster_star, cluster_args, chunksize=1)
             else:
-                for c in cluster_list:
-                    _run_cluster(c, self.verbose, self.clean, self.fails_dir)
+                results = map(_run_cluster_star, cluster_args)
+
+            # Only the small results are kept, not the Cluster objects
+            for result in results:
+                self._store_cluster_result(result)
         except:
             self.clusters_all_ran_ok = False
 
-        if len(os.listdir(self.fails_dir)) > 0:
-            self.clusters_all_ran_ok = False
+        self._finish_running_clusters()
 
-        self.clusters = {c.name: c for c in cluster_list}
+
+    @staticmethod
+    def _write_cluster_costs(clusters_in, predicted_costs, outfile):
+        '''Writes predicted cost and actual run time of each cluster, in the
+           order that they were started'''
+        with open(outfile, 'w') as f:
+            print('#cluster', 'predicted_cost', 'run_seconds', 'seconds_per_million_cost', sep='\t', file=f)
+            for name in sorted(clusters_in, key=lambda x: (-predicted_costs[x], x)):
+                seconds = clusters_in[name].run_seconds
+                if seconds is None:
+                    print(name, predicted_costs[name], 'NA', 'NA', sep='\t', file=f)
+                else:
+                    print(name, predicted_costs[name], round(seconds, 3), round(1000000 * seconds / predicted_costs[name], 4), sep='\t', file=f)
 
 
     @staticmethod
@@ -448,9 +770,8 @@ class Clusters:
         f = pyfastaq.utils.open_file_write(outfile)
 
         for gene in sorted(self.clusters):
-            try:
-                seq_dict = self.clusters[gene].assembly.sequences
-            except:
+            seq_dict = self.clusters[gene].assembly_sequences
+            if seq_dict is None:
                 continue
 
             for seq_name in sorted(seq_dict):
@@ -463,9 +784,8 @@ class Clusters:
         f = pyfastaq.utils.open_file_write(outfile)
 
         for gene in sorted(self.clusters):
-            try:
-                seq_dict = self.clusters[gene].assembly_compare.assembled_reference_sequences
-            except:
+            seq_dict = self.clusters[gene].assembled_reference_sequences
+            if seq_dict is None:
                 continue
 
             for seq_name in sorted(seq_dict):
@@ -478,12 +798,13 @@ class Clusters:
         f = pyfastaq.utils.open_file_write(outfile)
 
         for gene in sorted(self.clusters):
-            if self.clusters[gene].assembly_compare is not None and self.clusters[gene].assembly_compare.gene_matching_ref is not None:
-                seq = copy.copy(self.clusters[gene].assembly_compare.gene_matching_ref)
+            result = self.clusters[gene]
+            if result.gene_matching_ref is not None:
+                seq = copy.copy(result.gene_matching_ref)
                 seq.id += '.' + '.'.join([
-                    self.clusters[gene].assembly_compare.gene_matching_ref_type,
-                    str(self.clusters[gene].assembly_compare.gene_start_bases_added),
-                    str(self.clusters[gene].assembly_compare.gene_end_bases_added)
+                    result.gene_matching_ref_type,
+                    str(result.gene_start_bases_added),
+                    str(result.gene_end_bases_added)
                 ])
                 print(seq, file=f)
 
@@ -508,10 +829,15 @@ class Clusters:
 
             try:
                 if self.verbose:
-                    print('Deleting reads store files', self.read_store.outfile + '[.tbi]')
+                    print('Deleting reads store files', self.read_store.outfile + ('[.tbi]' if self.read_store_format == 'tabix' else ''))
                 self.read_store.clean()
             except:
                 pass
+
+            if self.verbose:
+                print('Deleting checkpoints directory', self.checkpoint_dir)
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+            self._delete_minimap_files('minimap')
         else:
             if self.verbose:
                 print('Not deleting anything because --noclean used')
@@ -538,7 +864,25 @@ class Clusters:
         cwd = os.getcwd()
         os.chdir(self.outdir)
         self.write_versions_file(cwd)
-        self._map_and_cluster_reads()
+        with self.stage_timer.stage('map_reads_and_make_read_store'):
+            self._map_and_cluster_reads()
+
+        if self._can_run_clusters():
+            if self.verbose:
+                print('{:_^79}'.format(' Assembling each cluster '))
+                print('Will run', self.threads, 'cluster(s) in parallel', flush=True)
+            with self.stage_timer.stage('run_clusters'):
+                self._init_and_run_clusters()
+            if self.verbose:
+                print('Finished assembling clusters\n')
+
+        self._write_outputs()
+        os.chdir(cwd)
+
+
+    def _can_run_clusters(self):
+        '''Returns True if any reads were mapped and the insert size could be
+           worked out, otherwise warns why no local assemblies will be run'''
         self.log_files = None
 
         if len(self.cluster_to_dir) > 0:
@@ -548,38 +892,42 @@ class Clusters:
                 print('This probably means that very few reads were mapped at all. No local assemblies will be run', file=sys.stderr)
                 if self.verbose:
                     print('Not enough proper read pairs mapped to determine insert size. Skipping all assemblies.', flush=True)
-            else:
-                if self.verbose:
-                    print('{:_^79}'.format(' Assembling each cluster '))
-                    print('Will run', self.threads, 'cluster(s) in parallel', flush=True)
-                self._init_and_run_clusters()
-                if self.verbose:
-                    print('Finished assembling clusters\n')
+            return got_insert_data_ok
         else:
             if self.verbose:
                 print('No reads mapped. Skipping all assemblies', flush=True)
             print('WARNING: no reads mapped to reference genes. Therefore no local assemblies will be run', file=sys.stderr)
+            return False
+
 
+    def _write_outputs(self):
+        '''Writes the reports and other output files, and cleans up.
+           Raises Error if any cluster failed'''
         if not self.clusters_all_ran_ok:
             raise Error('At least one cluster failed! Stopping...')
 
-        if self.verbose:
-            print('{:_^79}'.format(' Writing reports '), flush=True)
-            print('Making', self.report_file_all_tsv)
-        self._write_report(self.clusters, self.report_file_all_tsv)
+        with self.stage_timer.stage('write_reports'):
+            if self.verbose:
+                print('{:_^79}'.format(' Writing reports '), flush=True)
+                print('Making', self.report_file_all_tsv)
+            self._write_report(self.clusters, self.report_file_all_tsv)
 
-        if self.verbose:
-            print('Making', self.report_file_filtered)
-        rf = report_filter.ReportFilter(infile=self.report_file_all_tsv)
-        rf.run(self.report_file_filtered)
+            if self.verbose:
+                print('Making', self.report_file_filtered)
+            rf = report_filter.ReportFilter(infile=self.report_file_all_tsv)
+            rf.run(self.report_file_filtered)
+
+            if self.verbose:
+                print()
+                print('{:_^79}'.format(' Writing fasta of assembled sequences '), flush=True)
+                print(self.catted_assembled_seqs_fasta, 'and', self.catted_genes_matching_refs_fasta, flush=True)
+            self._write_catted_assembled_seqs_fasta(self.catted_assembled_seqs_fasta)
+            self._write_catted_genes_matching_refs_fasta(self.catted_genes_matching_refs_fasta)
+            self._write_catted_assemblies_fasta(self.catted_assemblies_fasta)
 
+        stage_timer.write_tsv({x: self.clusters[x].stage_timings for x in self.clusters}, self.stage_timer.stages, self.stage_timings_file)
         if self.verbose:
-            print()
-            print('{:_^79}'.format(' Writing fasta of assembled sequences '), flush=True)
-            print(self.catted_assembled_seqs_fasta, 'and', self.catted_genes_matching_refs_fasta, flush=True)
-        self._write_catted_assembled_seqs_fasta(self.catted_assembled_seqs_fasta)
-        self._write_catted_genes_matching_refs_fasta(self.catted_genes_matching_refs_fasta)
-        self._write_catted_assemblies_fasta(self.catted_assemblies_fasta)
+            print('Time and resources used by each stage written to', self.stage_timings_file)
 
         if self.log_files is not None:
             clusters_log_file = os.path.join(self.outdir, 'log.clusters.gz')
@@ -596,5 +944,3 @@ class Clusters:
 
         if self.clusters_all_ran_ok and self.verbose:
             print('\nAll done!\n')
-
-        os.chdir(cwd)
@@ -1,21 +1,26 @@
 #include <unistd.h>
 #include <stdlib.h>
 #include <stdio.h>
+#include <string.h>
 #include <iostream>
 #include <fstream>
+#include <sstream>
 #include <vector>
 #include <string>
 #include <algorithm>
 #include "Python.h"
 #include "fml.h"
 
+// from fermi-lite's kthread.c
+extern "C" void kt_for(int n_threads, void (*func)(void*,long,int), void *data, long n);
+
 
 class Assembly
 {
 public:
     Assembly(int numberOfUnitigs, fml_utg_t *unitigs, unsigned short minCountIn);
     void printStats(std::ostream& outStream) const;
-    void toFile(std::string filename) const;
+    static void toFile(const std::vector<std::string>& sequences, std::string filename);
 
     uint32_t numberOfContigs;
     unsigned short minCount;
@@ -56,7 +61,7 @@ void Assembly::printStats(std::ostream& outStream) const
 }
 
 
-void Assembly::toFile(std::string filename) const
+void Assembly::toFile(const std::vector<std::string>& sequences, std::string filename)
 {
     std::ofstream ofs(filename.c_str());
     if (!ofs.good())
@@ -93,7 +98,96 @@ bool assemblyCompare(const Assembly&  lhs, const Assembly& rhs) {
 }
 
 
-int assemble(char *readsFile, char *fastaOut, char* logfileOut);
+// Reads to be assembled. Does not own the sequences and qualities, which
+// must exist until the ReadSet is finished with. fml_assemble() frees the
+// reads it is given, so each assembly needs its own copy, from copy()
+class ReadSet
+{
+public:
+    void add(const char *seq, const char *qual, int32_t length);
+    bool addFromBuffers(const char *seqsBuf, size_t seqsLength, const char *qualsBuf, size_t qualsLength);
+    bseq1_t *copy() const;
+    int size() const {return lengths.size();}
+
+private:
+    std::vector<const char *> seqs;
+    std::vector<const char *> quals; // NULL if no qualities
+    std::vector<int32_t> lengths;
+};
+
+
+void ReadSet::add(const char *seq, const char *qual, int32_t length)
+{
+    seqs.push_back(seq);
+    quals.push_back(qual);
+    lengths.push_back(length);
+}
+
+
+// seqsBuf has one sequence per line. qualsBuf is empty, or has the
+// qualities of each sequence, one per line. Returns false if the
+// qualities do not match the sequences
+bool ReadSet::addFromBuffers(const char *seqsBuf, size_t seqsLength, const char *qualsBuf, size_t qualsLength)
+{
+    size_t seqStart = 0;
+    size_t qualStart = 0;
+
+    while (seqStart < seqsLength)
+    {
+        const char *seqEnd = (const char *) memchr(seqsBuf + seqStart, '\n', seqsLength - seqStart);
+        size_t length = seqEnd == NULL ? seqsLength - seqStart : seqEnd - seqsBuf - seqStart;
+        const char *qual = NULL;
+
+        if (qualsLength > 0)
+        {
+            if (qualStart >= qualsLength)
+            {
+                return false;
+            }
+            const char *qualEnd = (const char *) memchr(qualsBuf + qualStart, '\n', qualsLength - qualStart);
+            size_t qualLength = qualEnd == NULL ? qualsLength - qualStart : qualEnd - qualsBuf - qualStart;
+            if (qualLength != length)
+            {
+                return false;
+            }
+            qual = qualsBuf + qualStart;
+            qualStart += length + 1;
+        }
+
+        add(seqsBuf + seqStart, qual, length);
+        seqStart += length + 1;
+    }
+
+    return qualStart >= qualsLength;
+}
+
+
+static char *copyString(const char *s, int32_t length)
+{
+    char *copied = (char *) malloc(length + 1);
+    memcpy(copied, s, length);
+    copied[length] = 0;
+    return copied;
+}
+
+
+bseq1_t *ReadSet::copy() const
+{
+    bseq1_t *reads = (bseq1_t *) malloc(size() * sizeof(bseq1_t));
+
+    for (int i = 0; i < size(); i++)
+    {
+        reads[i].l_seq = lengths[i];
+        reads[i].seq = copyString(seqs[i], lengths[i]);
+        reads[i].qual = quals[i] == NULL ? NULL : copyString(quals[i], lengths[i]);
+    }
+
+    return reads;
+}
+
+
+bool assembleReadSet(const ReadSet& reads, int threads, std::ostream& logStream, std::vector<std::string>& contigs);
+int assemble(char *readsFile, char *fastaOut, char* logfileOut, int threads);
 
 
 static PyObject * main_wrapper(PyObject * self, PyObject * args)
@@ -101,20 +195,72 @@ static PyObject * main_wrapper(PyObject * self, PyObject * args)
   char *readsFile;
   char *fastaOut;
   char *logOut;
+  int threads = 1;
   int gotFromMain = 1;
 
   // parse arguments
-  if (!PyArg_ParseTuple(args, "sss", &readsFile, &fastaOut, &logOut)) {
+  if (!PyArg_ParseTuple(args, "sss|i", &readsFile, &fastaOut, &logOut, &threads)) {
       return NULL;
   }
 
-  gotFromMain = assemble(readsFile, fastaOut, logOut);
+  gotFromMain = assemble(readsFile, fastaOut, logOut, threads);
   return PyLong_FromLong((long) gotFromMain);
 }
 
 
+// Takes sequences and qualities of the reads as bytes-like objects, one
+// read per line (qualities can be empty), and optionally the number of
+// threads. Returns tuple (list of contig sequences, log text). The list is
+// empty if the assembly failed
+static PyObject * assemble_reads_wrapper(PyObject * self, PyObject * args)
+{
+  Py_buffer seqsBuf;
+  Py_buffer qualsBuf;
+  ReadSet reads;
+  std::vector<std::string> contigs;
+  std::ostringstream logStream;
+  int threads = 1;
+
+  if (!PyArg_ParseTuple(args, "y*y*|i", &seqsBuf, &qualsBuf, &threads)) {
+      return NULL;
+  }
+
+  bool readsOk = reads.addFromBuffers((const char *) seqsBuf.buf, seqsBuf.len, (const char *) qualsBuf.buf, qualsBuf.len);
+  if (readsOk) {
+      Py_BEGIN_ALLOW_THREADS
+      assembleReadSet(reads, threads, logStream, contigs);
+      Py_END_ALLOW_THREADS
+  }
+
+  PyBuffer_Release(&seqsBuf);
+  PyBuffer_Release(&qualsBuf);
+
+  if (!readsOk) {
+      PyErr_SetString(PyExc_ValueError, "Qualities do not match sequences");
+      return NULL;
+  }
+
+  PyObject *contigList = PyList_New(contigs.size());
+  if (contigList == NULL) {
+      return NULL;
+  }
+
+  for (size_t i = 0; i < contigs.size(); i++) {
+      PyObject *contig = PyUnicode_FromStringAndSize(contigs[i].c_str(), contigs[i].size());
+      if (contig == NULL) {
+          Py_DECREF(contigList);
+          return NULL;
+      }
+      PyList_SET_ITEM(contigList, i, contig);
+  }
+
+  return Py_BuildValue("(Ns)", contigList, logStream.str().c_str());
+}
+
+
 static PyMethodDef fermiliteMethods[] = {
    { "fermilite_ariba", main_wrapper, METH_VARARGS, "fermilite ariba" },
+   { "assemble_reads", assemble_reads_wrapper, METH_VARARGS, "fermilite ariba, with reads and contigs in memory" },
    { NULL, NULL, 0, NULL }
 };
 
@@ -136,24 +282,93 @@ PyInit_fermilite_ariba(void)
 }
 
 
-int assemble(char *readsFile, char *fastaOut, char* logfileOut)
+// The assemblies made with each min count, run by kt_for()
+struct MinCountSweep
+{
+    const ReadSet *reads;
+    const fml_opt_t *opt;
+    std::vector<unsigned short> minCounts;
+    std::vector<Assembly *> assemblies; // NULL if not made (there were no reads)
+};
+
+
+static void sweepWorker(void *data, long i, int threadId)
+{
+    MinCountSweep *sweep = (MinCountSweep *) data;
+    fml_opt_t opt = *sweep->opt;
+    opt.min_cnt = sweep->minCounts[i];
+    int n_utg;
+    fml_utg_t *utg = fml_assemble(&opt, sweep->reads->size(), sweep->reads->copy(), &n_utg);
+    sweep->assemblies[i] = new Assembly(n_utg, utg, sweep->minCounts[i]);
+    fml_utg_destroy(n_utg, utg);
+}
+
+
+// Makes an assembly with each min count, using up to the given number of
+// threads, and writes their stats to logStream. Puts the contigs of the
+// best one in contigs. Returns false if there was no assembly
+bool assembleReadSet(const ReadSet& reads, int threads, std::ostream& logStream, std::vector<std::string>& contigs)
 {
     fml_opt_t opt;
-    int n_seqs, n_utg;
-    bseq1_t *seqs;
     fml_opt_init(&opt);
     opt.max_cnt = 10000;
     opt.min_asm_ovlp = 15;
     opt.mag_opt.flag |= MAG_F_AGGRESSIVE;
-    std::vector<unsigned short> minCounts;
-    minCounts.push_back(4);
-    minCounts.push_back(8);
-    minCounts.push_back(12);
-    minCounts.push_back(16);
-    minCounts.push_back(20);
-    minCounts.push_back(25);
-    minCounts.push_back(30);
+    MinCountSweep sweep;
+    sweep.reads = &reads;
+    sweep.opt = &opt;
+    sweep.minCounts.push_back(4);
+    sweep.minCounts.push_back(8);
+    sweep.minCounts.push_back(12);
+    sweep.minCounts.push_back(16);
+    sweep.minCounts.push_back(20);
+    sweep.minCounts.push_back(25);
+    sweep.minCounts.push_back(30);
+    sweep.assemblies.assign(sweep.minCounts.size(), NULL);
+
+    if (reads.size() > 0)
+    {
+        threads = std::max(1, std::min(threads, (int) sweep.minCounts.size()));
+        kt_for(threads, sweepWorker, &sweep, sweep.minCounts.size());
+    }
+
+    // Every min count is always assembled and logged. There is no rule
+    // for stopping the sweep early that gives the same best assembly,
+    // because a later min count can always give a better one
     std::vector<Assembly> assemblies;
+    for (unsigned int i = 0; i < sweep.assemblies.size(); i++)
+    {
+        if (sweep.assemblies[i] != NULL)
+        {
+            assemblies.push_back(*sweep.assemblies[i]);
+            delete sweep.assemblies[i];
+        }
+    }
+
+    logStream << "Fermilite assembly stats:\n"
+        << "Min_count\tContig_number\tMean_length\tLongest" << std::endl;
+
+    for (std::vector<Assembly>::const_iterator iter = assemblies.begin(); iter != assemblies.end(); iter++)
+    {
+        iter->printStats(logStream);
+    }
+
+    if (assemblies.size() == 0 || assemblies[0].numberOfContigs == 0)
+    {
+        logStream << "Didn't get any assemblies!\n";
+        return false;
+    }
+
+    std::sort(assemblies.begin(), assemblies.end(), &assemblyCompare);
+    logStream << "Best assembly is from min_count " << assemblies[0].minCount << '\n';
+    contigs = assemblies[0].sequences;
+    return true;
+}
+
+
+int assemble(char *readsFile, char *fastaOut, char* logfileOut, int threads)
+{
+    int n_seqs;
     std::ofstream ofs(logfileOut);
 
     if (!ofs.good())
@@ -162,35 +377,31 @@ int assemble(char *readsFile, char *fastaOut, char* logfileOut)
         return 1;
     }
 
-    ofs << "Fermilite assembly stats:\n"
-        << "Min_count\tContig_number\tMean_length\tLongest" << std::endl;
-
-    for (std::vector<unsigned short>::iterator minCountIter = minCounts.begin(); minCountIter != minCounts.end(); minCountIter++)
+    // the reads are read from the file once. assembleReadSet() copies
+    // them for each assembly
+    bseq1_t *seqs = bseq_read(readsFile, &n_seqs);
+    ReadSet reads;
+    for (int i = 0; seqs && i < n_seqs; i++)
     {
-        opt.min_cnt = *minCountIter;
+        reads.add(seqs[i].seq, seqs[i].qual, seqs[i].l_seq);
+    }
 
-        // need to get the reads from the file every time, instead of before
-        // the loop because fml_assemble() destroys them :(
-        seqs = bseq_read(readsFile, &n_seqs);
-        if (seqs && n_seqs > 0) {
-            fml_utg_t *utg;
-            utg = fml_assemble(&opt, n_seqs, seqs, &n_utg);
-            Assembly a(n_utg, utg, *minCountIter);
-            assemblies.push_back(a);
-            a.printStats(ofs);
-            fml_utg_destroy(n_utg, utg);
-        }
+    std::vector<std::string> contigs;
+    bool gotAssembly = assembleReadSet(reads, threads, ofs, contigs);
+
+    for (int i = 0; seqs && i < n_seqs; i++)
+    {
+        free(seqs[i].seq);
+        free(seqs[i].qual);
     }
+    free(seqs);
 
-    if (assemblies.size() == 0 || assemblies[0].numberOfContigs == 0)
+    if (!gotAssembly)
     {
-        ofs << "Didn't get any assemblies!\n";
         return 1;
     }
 
-    std::sort(assemblies.begin(), assemblies.end(), &assemblyCompare);
-    ofs << "Best assembly is from min_count " << assemblies[0].minCount << '\n';
-    assemblies[0].toFile(fastaOut);
+    Assembly::toFile(contigs, fastaOut);
     ofs.close();
     return 0;
 }
@@ -0,0 +1,193 @@
+// Local alignment with ksw, plus a banded global alignment of the local
+// region to get the CIGAR, because ksw_align() does not do traceback.
+// Used by ksw_ariba and minimap_ariba
+#ifndef KSW_ALIGN_ARIBA_H
+#define KSW_ALIGN_ARIBA_H
+
+#include <stdlib.h>
+#include <stdint.h>
+#include <vector>
+#include <algorithm>
+#include "ksw.h"
+
+// Scores used to align contigs to reference sequences. A gap of length l
+// scores l * gapScore. The ratios are like nucmer's (3, -7, -7), but smaller
+// so that ksw's 16 bit scores do not overflow for long genes
+const int8_t matchScore = 1;
+const int8_t mismatchScore = -3;
+const int gapScore = -3;
+const int alphabetSize = 5; // ACGT, then everything else is N
+const int bandPadding = 100; // default width of the band each side of the diagonal
+
+
+static void encodeSequence(const char *seq, int length, std::vector<uint8_t>& encoded)
+{
+    encoded.resize(length);
+    for (int i = 0; i < length; i++)
+    {
+        switch (seq[i])
+        {
+            case 'A': case 'a': encoded[i] = 0; break;
+            case 'C': case 'c': encoded[i] = 1; break;
+            case 'G': case 'g': encoded[i] = 2; break;
+            case 'T': case 't': encoded[i] = 3; break;
+            default: encoded[i] = 4;
+        }
+    }
+}
+
+
+static int8_t score(uint8_t a, uint8_t b)
+{
+    if (a == 4 || b == 4)
+    {
+        return -1;
+    }
+    return a == b ? matchScore : mismatchScore;
+}
+
+
+struct Hit
+{
+    int refStart, refEnd, qryStart, qryEnd; // zero-based, inclusive
+    int score;
+    std::vector<char> ops;   // 'M' (match or mismatch), 'I' (base in query only), 'D' (base in ref only)
+    std::vector<int> opLengths;
+
+    void addOp(char op)
+    {
+        if (ops.size() > 0 && ops.back() == op)
+        {
+            opLengths.back()++;
+        }
+        else
+        {
+            ops.push_back(op);
+            opLengths.push_back(1);
+        }
+    }
+};
+
+
+// Global alignment of ref[refStart..refEnd] with qry[qryStart..qryEnd],
+// restricted to a band around the diagonal. Fills in the ops of hit.
+// When there is a choice, gaps are put as far left as possible
+static void globalAlign(const uint8_t *ref, const uint8_t *qry, Hit& hit, int padding)
+{
+    const int n = hit.refEnd - hit.refStart + 1;
+    const int m = hit.qryEnd - hit.qryStart + 1;
+    const int minDiag = std::min(0, m - n) - padding;
+    const int maxDiag = std::max(0, m - n) + padding;
+    const int width = maxDiag - minDiag + 1;
+    const int minusInfinity = -1000000000;
+    std::vector<int> scores((size_t) (n + 1) * width, minusInfinity);
+    std::vector<char> traceback((size_t) (n + 1) * width, 0);
+
+    // cell (i, j) = ref[0..i), qry[0..j) aligned
+    #define CELL(i, j) ((size_t) (i) * width + (j) - (i) - minDiag)
+    #define IN_BAND(i, j) ((j) >= 0 && (j) <= m && (j) - (i) >= minDiag && (j) - (i) <= maxDiag)
+
+    for (int i = 0; i <= n; i++)
+    {
+        int jStart = std::max(0, i + minDiag);
+        int jEnd = std::min(m, i + maxDiag);
+
+        for (int j = jStart; j <= jEnd; j++)
+        {
+            if (i == 0 && j == 0)
+            {
+                scores[CELL(0, 0)] = 0;
+                continue;
+            }
+
+            int best = minusInfinity;
+            char op = 0;
+
+            if (i > 0 && j > 0 && IN_BAND(i - 1, j - 1))
+            {
+                best = scores[CELL(i - 1, j - 1)] + score(ref[hit.refStart + i - 1], qry[hit.qryStart + j - 1]);
+                op = 'M';
+            }
+            if (i > 0 && IN_BAND(i - 1, j) && scores[CELL(i - 1, j)] + gapScore > best)
+            {
+                best = scores[CELL(i - 1, j)] + gapScore;
+                op = 'D';
+            }
+            if (j > 0 && IN_BAND(i, j - 1) && scores[CELL(i, j - 1)] + gapScore > best)
+            {
+                best = scores[CELL(i, j - 1)] + gapScore;
+                op = 'I';
+            }
+
+            scores[CELL(i, j)] = best;
+            traceback[CELL(i, j)] = op;
+        }
+    }
+
+    std::vector<char> reversedOps;
+    int i = n;
+    int j = m;
+    while (i > 0 || j > 0)
+    {
+        char op = traceback[CELL(i, j)];
+        reversedOps.push_back(op);
+        if (op == 'M')
+        {
+            i--;
+            j--;
+        }
+        else if (op == 'D')
+        {
+            i--;
+        }
+        else
+        {
+            j--;
+        }
+    }
+
+    #undef CELL
+    #undef IN_BAND
+
+    for (std::vector<char>::reverse_iterator iter = reversedOps.rbegin(); iter != reversedOps.rend(); iter++)
+    {
+        hit.addOp(*iter);
+    }
+}
+
+
+// Finds the best local alignment of qry to ref. Returns false if there
+// is no alignment with a positive score. Sets hit.score to the score of the
+// local alignment
+static bool align(uint8_t *ref, int refLength, uint8_t *qry, int qryLength, Hit& hit, int padding = bandPadding)
+{
+    int8_t matrix[alphabetSize * alphabetSize];
+    for (int i = 0; i < alphabetSize; i++)
+    {
+        for (int j = 0; j < alphabetSize; j++)
+        {
+            matrix[i * alphabetSize + j] = score(i, j);
+        }
+    }
+
+    if (refLength == 0 || qryLength == 0)
+    {
+        return false;
+    }
+
+    kswr_t result = ksw_align(qryLength, qry, refLength, ref, alphabetSize, matrix, 0, -gapScore, KSW_XSTART, NULL);
+    if (result.score <= 0 || result.tb < 0 || result.qb < 0)
+    {
+        return false;
+    }
+
+    hit.refStart = result.tb;
+    hit.refEnd = result.te;
+    hit.qryStart = result.qb;
+    hit.qryEnd = result.qe;
+    hit.score = result.score;
+    globalAlign(ref, qry, hit, padding);
+    return true;
+}
+
+#endif
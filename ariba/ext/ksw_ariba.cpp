@@ -0,0 +1,74 @@
+#define PY_SSIZE_T_CLEAN
+#include "Python.h"
+#include "ksw_align_ariba.h"
+
+
+// Takes reference and query sequences as strings. Returns None if there is
+// no local alignment, or tuple (ref start, ref end, query start, query end,
+// list of (op, length)), where coords are zero-based and ops are as in
+// Hit::ops
+static PyObject * align_wrapper(PyObject * self, PyObject * args)
+{
+    const char *refSeq;
+    const char *qrySeq;
+    Py_ssize_t refLength;
+    Py_ssize_t qryLength;
+    std::vector<uint8_t> ref;
+    std::vector<uint8_t> qry;
+    Hit hit;
+    bool gotHit;
+
+    if (!PyArg_ParseTuple(args, "s#s#", &refSeq, &refLength, &qrySeq, &qryLength)) {
+        return NULL;
+    }
+
+    encodeSequence(refSeq, refLength, ref);
+    encodeSequence(qrySeq, qryLength, qry);
+
+    Py_BEGIN_ALLOW_THREADS
+    gotHit = align(ref.data(), ref.size(), qry.data(), qry.size(), hit);
+    Py_END_ALLOW_THREADS
+
+    if (!gotHit) {
+        Py_RETURN_NONE;
+    }
+
+    PyObject *ops = PyList_New(hit.ops.size());
+    if (ops == NULL) {
+        return NULL;
+    }
+
+    for (size_t i = 0; i < hit.ops.size(); i++) {
+        PyObject *op = Py_BuildValue("(Ci)", hit.ops[i], hit.opLengths[i]);
+        if (op == NULL) {
+            Py_DECREF(ops);
+            return NULL;
+        }
+        PyList_SET_ITEM(ops, i, op);
+    }
+
+    return Py_BuildValue("(iiiiN)", hit.refStart, hit.refEnd, hit.qryStart, hit.qryEnd, ops);
+}
+
+
+static PyMethodDef kswMethods[] = {
+   { "align", align_wrapper, METH_VARARGS, "Align query to reference sequence" },
+   { NULL, NULL, 0, NULL }
+};
+
+
+static struct PyModuleDef kswModule = {
+   PyModuleDef_HEAD_INIT,
+   "ksw_ariba",   /* name of module */
+   NULL, /* module documentation, may be NULL */
+   -1,       /* size of per-interpreter state of the module,
+                or -1 if the module keeps state in global variables. */
+   kswMethods
+};
+
+
+PyMODINIT_FUNC
+PyInit_ksw_ariba(void)
+{
+    return PyModule_Create(&kswModule);
+}
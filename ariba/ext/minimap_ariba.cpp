@@ -3,28 +3,318 @@
 #include <sstream>
 #include <fstream>
 #include <stdlib.h>
-#include <stdlib.h>
+#include <string.h>
 #include <assert.h>
 #include <stdio.h>
+#include <math.h>
 #include <zlib.h>
 #include <map>
 #include <vector>
 #include <algorithm>
+#include <unistd.h>
+#include <sys/stat.h>
+#include <time.h>
 #include "minimap.h"
 #include "kseq.h"
 #include "Python.h"
+#include "ksw_align_ariba.h"
 KSEQ_INIT(gzFile, gzread)
 
 
-typedef std::vector<std::pair<uint32_t, bool> > MapPositionVector;
+// position of a read hit (coordinate, is reverse strand)
+typedef std::pair<uint32_t, bool> MapPosition;
+
+extern "C" void kt_for(int n_threads, void (*func)(void*,long,int), void *data, long n);
+extern "C" unsigned char seq_nt4_table[256];
+
+// minimizer window size and k-mer length used to index the reference sequences
+const int MINIMAP_W = 10;
+const int MINIMAP_K = 15;
+
+// Identifies the contents of a reference fasta file, so that an index
+// or k-mer filter made from it is only reused if the file is unchanged.
+// The size alone would miss a file that was rewritten in place with the
+// same size, so the crc32 of the whole file is also checked. The
+// modification time is not used, so that a copy of the prepareref
+// directory that does not keep timestamps (eg cp -r) still matches
+struct RefFileKey
+{
+    uint64_t size;
+    uint64_t checksum;
+    RefFileKey() : size(0), checksum(0) {}
+    bool operator==(const RefFileKey& other) const
+    {
+        return size == other.size && checksum == other.checksum;
+    }
+    bool operator!=(const RefFileKey& other) const { return !(*this == other); }
+};
+
+// start of an index file made by buildIndex(). The header is followed
+// by the index itself, in the format written by mm_idx_dump()
+const char INDEX_MAGIC[8] = {'A', 'R', 'I', 'B', 'A', 'M', 'I', '3'};
+
+struct IndexFileHeader
+{
+    char magic[8];
+    uint32_t w;
+    uint32_t k;
+    RefFileKey refFileKey;
+};
+
+// k-mer prescreen: a Bloom filter of the canonical k-mers of the
+// reference sequences. minimap only reports a hit when a read shares a
+// minimizer with a reference, and minimizers are canonical k-mers, so a
+// read pair with no k-mer in the filter cannot map and is skipped
+// without calling mm_map. The filter has no false negatives, so using
+// it does not change the output.
+const char KMER_FILTER_MAGIC[8] = {'A', 'R', 'I', 'B', 'A', 'K', 'F', '3'};
+const uint32_t KMER_FILTER_HASHES = 4;
+const uint64_t KMER_FILTER_BITS_PER_KMER = 64;
+const uint64_t KMER_FILTER_MIN_BITS = 65536;
 
-void loadClusters(std::string& filename, std::map<std::string, std::string>& refnameToCluster);
-void chooseCluster(std::string outfile, std::map<std::string, uint64_t>& refnameToScore, std::map<std::string, std::string>& refnameToCluster);
-void writeClusterCountsFile(std::string outfile, const std::map<std::string, uint64_t>& readCounters, const std::map<std::string, uint64_t>& baseCounters);
-void writeInsertHistogramFile(std::string outfile, const std::map<uint32_t, uint32_t>& insertHist);
-void writeProperPairsFile(std::string outfile, uint32_t properPairs);
+struct KmerFilterFileHeader
+{
+    char magic[8];
+    uint32_t k;
+    uint32_t hashes;
+    uint64_t bits;
+    RefFileKey refFileKey;
+};
 
-int run_minimap(char *clustersFileIn, char *refFileIn, char *readsFile1In, char *readsFile2In, char *outprefixIn);
+class KmerFilter
+{
+public:
+    KmerFilter() : mask(0) {}
+    bool build(const char *refFile);
+    bool save(const char *filename, const RefFileKey& refFileKey) const;
+    bool load(const char *filename, const RefFileKey& refFileKey);
+    bool sharesKmer(const std::string& seq) const;
+
+private:
+    static uint64_t hashKmer(uint64_t kmer);
+    void addKmer(uint64_t kmer);
+    bool hasKmer(uint64_t kmer) const;
+
+    uint64_t mask; // number of bits - 1. Number of bits is a power of 2
+    std::vector<uint64_t> bits;
+};
+
+// To estimate the time saved by the prescreen, one in every
+// PRESCREEN_SAMPLE_EVERY runs of PRESCREEN_SAMPLE_RUN read pairs is mapped
+// even if screened out, and timed. Screened out pairs cannot have any
+// hits, so this does not change the output. Runs of pairs are used
+// instead of single pairs so that the timings are not of a cold cache
+const long PRESCREEN_SAMPLE_EVERY = 100;
+const long PRESCREEN_SAMPLE_RUN = 256;
+
+// Running totals of time spent by one thread, in seconds
+struct PrescreenTimes
+{
+    double prescreen;
+    double sampledMapping;
+    uint64_t pairsSampled;
+    PrescreenTimes() : prescreen(0), sampledMapping(0), pairsSampled(0) {}
+};
+
+// Reads for the native read store are collected per cluster, and each
+// cluster's buffer is compressed and written to a temporary file when
+// it reaches this size (or when all buffers together use too much memory)
+const size_t READ_STORE_BLOCK_SIZE = 65536;
+const size_t READ_STORE_MAX_BUFFERED = 268435456;
+const char READ_STORE_MAGIC[8] = {'A', 'R', 'I', 'B', 'A', 'R', 'S', '1'};
+
+
+// Writes the native read store file, which has all reads of each cluster
+// in one contiguous run of zlib-compressed blocks, so that one cluster
+// can be read with a single seek. File layout:
+//   magic (8 bytes)
+//   per cluster, sorted by name: blocks of
+//     uncompressed length (uint32), compressed length (uint32), data.
+//     Uncompressed data is lines of: read number TAB seq TAB qual
+//   offset table: lines of cluster TAB offset TAB length TAB reads TAB bases
+//   footer: table offset (uint64), table length (uint64), magic (8 bytes)
+// All integers are little-endian.
+class ReadStoreWriter
+{
+public:
+    ReadStoreWriter(const std::string& filename);
+    ~ReadStoreWriter();
+    bool good() const;
+    void add(uint32_t cluster, uint64_t number, const std::string& seq, const std::string& qual);
+    bool finish(const std::vector<std::string>& clusterNames, const std::vector<std::vector<uint64_t> >& keptPairs);
+
+private:
+    struct ClusterReads
+    {
+        std::string buffer;
+        std::vector<std::pair<uint64_t, uint32_t> > blocks; // (offset, length) in temporary file
+        uint64_t reads;
+        uint64_t bases;
+        ClusterReads() : reads(0), bases(0) {}
+    };
+
+    static bool compressBlock(const std::string& data, std::string& block);
+    bool flushBlock(ClusterReads& clusterReads);
+    bool flushAll();
+    bool writeFilteredBlocks(const ClusterReads& clusterReads, const std::vector<uint64_t>& keptPairs, FILE *out, uint64_t& length, uint64_t& reads, uint64_t& bases);
+
+    std::string filename;
+    std::string tmpFilename;
+    FILE *tmpFile;
+    uint64_t tmpFileSize;
+    size_t buffered;
+    bool failed;  // an error writing the temporary file, reported by finish()
+    std::vector<ClusterReads> clusters; // indexed by cluster number
+};
+
+// Depth cap. When used, each cluster keeps a random sample of at most
+// cap read pairs, chosen by reservoir sampling (algorithm R) as the pairs
+// arrive. The cap is made from the wanted coverage, the length of the
+// longest reference sequence in the cluster and the mean read pair length.
+// Pairs are only written to the read store if they are in the reservoir
+// when they arrive, and pairs that are later evicted from the reservoir
+// are removed when the read store is finished. Kept reads keep their
+// original read numbers. Read and base counts in the .clusterCounts file
+// are of all reads, before the cap
+class ClusterReservoir
+{
+public:
+    ClusterReservoir() : cap(0), seen(0) {}
+    bool add(uint64_t pairNumber, uint64_t& rngState);
+    uint64_t cap;  // 0 means no cap
+    uint64_t seen;
+    std::vector<uint64_t> pairNumbers;
+};
+
+// number of read pairs loaded and mapped (in parallel) before writing output
+const long PAIRS_PER_BATCH = 50000;
+
+struct ReadPair
+{
+    std::string seq1;
+    std::string qual1;
+    std::string seq2;
+    std::string qual2;
+    std::vector<mm_reg1_t> hits1;
+    std::vector<mm_reg1_t> hits2;
+    bool screenedOut;
+};
+
+struct MappingBatch
+{
+    const mm_idx_t *mi;
+    const mm_mapopt_t *opt;
+    std::vector<mm_tbuf_t *> *tbufs;
+    std::vector<ReadPair> *pairs;
+    const KmerFilter *kmerFilter;          // NULL if not prescreening
+    std::vector<PrescreenTimes> *times;    // one per thread
+};
+
+// The mapping loop refers to reference sequences by their minimap rid and
+// to clusters by number, instead of by name. Clusters are numbered in
+// name order, so that looping over numbers gives output sorted by name.
+// Reference sequences are also ranked by name, because the hits of a read
+// pair are processed in name order
+struct ClusterIndexes
+{
+    std::vector<std::string> clusterNames; // cluster number -> name
+    std::vector<std::string> refnames;     // rid -> name
+    std::vector<uint32_t> ridToCluster;    // rid -> cluster number
+    std::vector<uint32_t> rankToRid;       // rank of name -> rid
+    std::vector<uint32_t> ridToRank;       // rid -> rank of name
+};
+
+// hits of one read pair to one reference sequence
+struct RefHits
+{
+    uint32_t hits1;
+    uint32_t hits2;
+    MapPosition firstPosition1;
+    MapPosition firstPosition2;
+    RefHits() : hits1(0), hits2(0) {}
+};
+
+// When run_minimap is called with keepReference, the index and k-mer
+// filter of the reference sequences are kept here, so that later calls
+// with the same reference file (eg one per sample in ariba run-batch) do
+// not load or build them again. Not thread safe: only one call to
+// run_minimap with keepReference can run at a time
+struct ReferenceCache
+{
+    std::string refFile;
+    RefFileKey refFileKey;
+    mm_idx_t *mi;
+    bool haveKmerFilter;
+    KmerFilter kmerFilter;
+    ReferenceCache() : mi(NULL), haveKmerFilter(false) {}
+    void clear();
+};
+
+ReferenceCache referenceCache;
+
+// Base-level mapping of read pairs to a few sequences (eg the contigs of
+// one cluster's assembly), used instead of bowtie2. Each read is seeded
+// with minimap, and the region of each minimap hit is aligned with ksw.
+// Reads with no minimap hit are aligned to the whole of every sequence,
+// so that reads that only overlap the end of a contig are still found.
+// By default, at most this many minimap hits of each read are aligned
+const int MAX_READ_CANDIDATES = 10;
+// Band padding for aligning reads. Much less than for contigs, because
+// reads are short and the local alignment ends are already known
+const int READ_BAND_PADDING = 15;
+
+// alignment of a read to one of the sequences
+struct ReadAlignment
+{
+    int rid;
+    bool reverse;
+    int pos;                      // zero-based leftmost position in the sequence
+    int score;
+    std::vector<char> ops;        // M, I, D, S
+    std::vector<int> opLengths;
+};
+
+struct MappedRead
+{
+    std::string name;
+    std::string seq;
+    std::string qual;
+    std::vector<ReadAlignment> alignments; // best score first
+};
+
+struct ReadMappingBatch
+{
+    const mm_idx_t *mi;
+    const mm_mapopt_t *opt;
+    std::vector<mm_tbuf_t *> *tbufs;
+    std::vector<std::vector<uint8_t> > *refs;  // encoded as in ksw_align_ariba.h
+    std::vector<MappedRead> *reads;
+    int maxCandidates;   // 0 means no limit
+};
+
+bool loadClusters(std::string& filename, std::map<std::string, std::string>& refnameToCluster);
+void makeClusterIndexes(const mm_idx_t *mi, const std::map<std::string, std::string>& refnameToCluster, ClusterIndexes& indexes);
+bool chooseCluster(std::string outfile, const std::vector<uint64_t>& refScores, const ClusterIndexes& indexes);
+bool writeClusterCountsFile(std::string outfile, const std::vector<std::string>& clusterNames, const std::vector<uint64_t>& readCounters, const std::vector<uint64_t>& baseCounters);
+bool writeInsertHistogramFile(std::string outfile, const std::map<uint32_t, uint32_t>& insertHist);
+bool writeProperPairsFile(std::string outfile, uint32_t properPairs);
+bool writePrescreenFile(std::string outfile, uint64_t readPairs, uint64_t screenedOut, const std::vector<PrescreenTimes>& times);
+uint64_t splitmix64(uint64_t& state);
+void setReadCaps(const mm_idx_t *mi, const std::vector<uint32_t>& ridToCluster, const std::vector<ReadPair>& pairs, long numberOfPairs, int capCoverage, std::vector<ClusterReservoir>& reservoirs);
+
+void writeLittleEndian(std::string& out, uint64_t value, int bytes);
+bool getRefFileKey(const char *filename, RefFileKey& key);
+int buildIndex(char *refFileIn, char *indexFileIn, int threads);
+int buildKmerFilter(char *refFileIn, char *filterFileIn);
+bool loadOrBuildKmerFilter(const char *refFile, const std::string& filterFile, KmerFilter& kmerFilter);
+double secondsNow();
+mm_idx_t *loadIndex(const char *refFile, const std::string& indexFile);
+void mapReadPair(void *data, long i, int threadId);
+long loadReadPairs(kseq_t *ks1, kseq_t *ks2, std::vector<ReadPair>& pairs);
+void alignRead(void *data, long i, int threadId);
+int mapReads(const char *refFile, const char *readsFile1, const char *readsFile2, int threads, int maxCandidates, std::vector<std::string>& refNames, std::vector<std::vector<uint8_t> >& refs, std::vector<MappedRead>& reads);
+
+int run_minimap(char *clustersFileIn, char *refFileIn, char *readsFile1In, char *readsFile2In, char *outprefixIn, int threads, char *indexFileIn, int nativeReadStore, int kmerPrescreen, char *kmerFilterFileIn, int readCapCoverage, int keepReference);
 
 static PyObject * main_wrapper(PyObject * self, PyObject * args)
 {
@@ -33,59 +323,1007 @@ static PyObject * main_wrapper(PyObject * self, PyObject * args)
   char *readsFile1;
   char *readsFile2;
   char *outprefix;
+  int threads = 1;
+  char *indexFile = (char *) "";
+  int nativeReadStore = 0;
+  int kmerPrescreen = 0;
+  char *kmerFilterFile = (char *) "";
+  int readCapCoverage = 0;
+  int keepReference = 0;
+  int gotFromMain = 1;
+
+  // parse arguments
+  if (!PyArg_ParseTuple(args, "sssss|isiisii", &clustersFile, &refFile, &readsFile1, &readsFile2, &outprefix, &threads, &indexFile, &nativeReadStore, &kmerPrescreen, &kmerFilterFile, &readCapCoverage, &keepReference)) {
+      return NULL;
+  }
+
+  // no python objects are used while mapping, so other python threads
+  // (eg those feeding a multiprocessing pool) can run at the same time
+  Py_BEGIN_ALLOW_THREADS
+  gotFromMain = run_minimap(clustersFile, refFile, readsFile1, readsFile2, outprefix, threads, indexFile, nativeReadStore, kmerPrescreen, kmerFilterFile, readCapCoverage, keepReference);
+  Py_END_ALLOW_THREADS
+
+  if (gotFromMain != 0) {
+      PyErr_Format(PyExc_ValueError, "Error mapping reads %s and %s to %s", readsFile1, readsFile2, refFile);
+      return NULL;
+  }
+
+  return PyLong_FromLong((long) gotFromMain);
+}
+
+
+static PyObject * clear_reference_cache_wrapper(PyObject * self, PyObject * args)
+{
+  referenceCache.clear();
+  Py_RETURN_NONE;
+}
+
+
+static PyObject * build_index_wrapper(PyObject * self, PyObject * args)
+{
+  char *refFile;
+  char *indexFile;
+  int threads = 1;
+  int gotFromMain = 1;
+
+  // parse arguments
+  if (!PyArg_ParseTuple(args, "ss|i", &refFile, &indexFile, &threads)) {
+      return NULL;
+  }
+
+  gotFromMain = buildIndex(refFile, indexFile, threads);
+  return PyLong_FromLong((long) gotFromMain);
+}
+
+
+static PyObject * build_kmer_filter_wrapper(PyObject * self, PyObject * args)
+{
+  char *refFile;
+  char *filterFile;
   int gotFromMain = 1;
 
   // parse arguments
-  if (!PyArg_ParseTuple(args, "sssss", &clustersFile, &refFile, &readsFile1, &readsFile2, &outprefix)) {
+  if (!PyArg_ParseTuple(args, "ss", &refFile, &filterFile)) {
       return NULL;
   }
 
-  gotFromMain = run_minimap(clustersFile, refFile, readsFile1, readsFile2, outprefix);
-  return PyLong_FromLong((long) gotFromMain);
+  gotFromMain = buildKmerFilter(refFile, filterFile);
+  return PyLong_FromLong((long) gotFromMain);
+}
+
+
+// Returns tuple (name, sequence, qualities, alignments) of one read for
+// map_reads(), or NULL with a python exception set if it cannot be made
+static PyObject * readToPython(const MappedRead& read)
+{
+  PyObject *alignments = PyList_New(read.alignments.size());
+  if (alignments == NULL) {
+      return NULL;
+  }
+
+  for (size_t j = 0; j < read.alignments.size(); j++) {
+      const ReadAlignment& alignment = read.alignments[j];
+      PyObject *cigar = PyList_New(alignment.ops.size());
+      if (cigar == NULL) {
+          Py_DECREF(alignments);
+          return NULL;
+      }
+
+      for (size_t k = 0; k < alignment.ops.size(); k++) {
+          PyObject *op = Py_BuildValue("(Ci)", alignment.ops[k], alignment.opLengths[k]);
+          if (op == NULL) {
+              Py_DECREF(cigar);
+              Py_DECREF(alignments);
+              return NULL;
+          }
+          PyList_SET_ITEM(cigar, k, op);
+      }
+
+      // N steals the reference to cigar, even if Py_BuildValue fails
+      PyObject *item = Py_BuildValue("(iNiiN)", alignment.rid, PyBool_FromLong(alignment.reverse), alignment.pos, alignment.score, cigar);
+      if (item == NULL) {
+          Py_DECREF(alignments);
+          return NULL;
+      }
+      PyList_SET_ITEM(alignments, j, item);
+  }
+
+  return Py_BuildValue("(sssN)", read.name.c_str(), read.seq.c_str(), read.qual.c_str(), alignments);
+}
+
+
+// Maps read pairs to the sequences in refFile. Returns tuple (list of
+// (name, length) of the sequences, list of reads). The reads are in the
+// same order as the input files, alternating first and second of each
+// pair. Each read is a tuple (name, sequence, qualities, alignments),
+// where alignments = list of (sequence index, is reverse, zero-based
+// position, score, cigar), best score first, and cigar = list of
+// (op, length). Read names have any /1 or /2 at the end removed.
+// maxCandidates = maximum number of minimap hits of each read to align,
+// or 0 for all of them (eg to score a read against every sequence)
+static PyObject * map_reads_wrapper(PyObject * self, PyObject * args)
+{
+  char *refFile;
+  char *readsFile1;
+  char *readsFile2;
+  int threads = 1;
+  int maxCandidates = MAX_READ_CANDIDATES;
+  int gotFromMain = 1;
+  std::vector<std::string> refNames;
+  std::vector<std::vector<uint8_t> > refs;
+  std::vector<MappedRead> reads;
+
+  // parse arguments
+  if (!PyArg_ParseTuple(args, "sss|ii", &refFile, &readsFile1, &readsFile2, &threads, &maxCandidates)) {
+      return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  gotFromMain = mapReads(refFile, readsFile1, readsFile2, threads, maxCandidates, refNames, refs, reads);
+  Py_END_ALLOW_THREADS
+
+  if (gotFromMain != 0) {
+      PyErr_Format(PyExc_ValueError, "Error mapping reads %s and %s to %s", readsFile1, readsFile2, refFile);
+      return NULL;
+  }
+
+  PyObject *refList = PyList_New(refNames.size());
+  if (refList == NULL) {
+      return NULL;
+  }
+
+  for (size_t i = 0; i < refNames.size(); i++) {
+      PyObject *ref = Py_BuildValue("(sn)", refNames[i].c_str(), (Py_ssize_t) refs[i].size());
+      if (ref == NULL) {
+          Py_DECREF(refList);
+          return NULL;
+      }
+      PyList_SET_ITEM(refList, i, ref);
+  }
+
+  PyObject *readList = PyList_New(reads.size());
+  if (readList == NULL) {
+      Py_DECREF(refList);
+      return NULL;
+  }
+
+  for (size_t i = 0; i < reads.size(); i++) {
+      PyObject *read = readToPython(reads[i]);
+      if (read == NULL) {
+          Py_DECREF(refList);
+          Py_DECREF(readList);
+          return NULL;
+      }
+      PyList_SET_ITEM(readList, i, read);
+  }
+
+  return Py_BuildValue("(NN)", refList, readList);
+}
+
+
+static PyMethodDef minimapMethods[] = {
+   { "minimap_ariba", main_wrapper, METH_VARARGS, "minimap ariba" },
+   { "build_index", build_index_wrapper, METH_VARARGS, "write minimap index of reference sequences to a file" },
+   { "build_kmer_filter", build_kmer_filter_wrapper, METH_VARARGS, "write k-mer prescreen filter of reference sequences to a file" },
+   { "map_reads", map_reads_wrapper, METH_VARARGS, "base-level mapping of read pairs to a few reference sequences" },
+   { "clear_reference_cache", clear_reference_cache_wrapper, METH_NOARGS, "free the reference index and k-mer filter kept by minimap_ariba with keepReference" },
+   { NULL, NULL, 0, NULL }
+};
+
+
+static struct PyModuleDef minimapModule = {
+   PyModuleDef_HEAD_INIT,
+   "minimap_ariba",   /* name of module */
+   NULL, /* module documentation, may be NULL */
+   -1,       /* size of per-interpreter state of the module,
+                or -1 if the module keeps state in global variables. */
+   minimapMethods
+};
+
+PyMODINIT_FUNC
+PyInit_minimap_ariba(void)
+{
+    return PyModule_Create(&minimapModule);
+}
+
+
+
+void writeLittleEndian(std::string& out, uint64_t value, int bytes)
+{
+    for (int i = 0; i < bytes; i++)
+    {
+        out.push_back((char) ((value >> (8 * i)) & 0xff));
+    }
+}
+
+
+ReadStoreWriter::ReadStoreWriter(const std::string& filenameIn) : filename(filenameIn), tmpFileSize(0), buffered(0), failed(false)
+{
+    tmpFilename = filename + ".tmp";
+    tmpFile = fopen(tmpFilename.c_str(), "w+b");
+}
+
+
+// Removes the temporary file, if finish() was not called
+ReadStoreWriter::~ReadStoreWriter()
+{
+    if (tmpFile)
+    {
+        fclose(tmpFile);
+        unlink(tmpFilename.c_str());
+    }
+}
+
+
+bool ReadStoreWriter::good() const
+{
+    return tmpFile != NULL;
+}
+
+
+// After an error writing the temporary file, reads are not added. The
+// error is returned by finish()
+void ReadStoreWriter::add(uint32_t cluster, uint64_t number, const std::string& seq, const std::string& qual)
+{
+    if (failed)
+    {
+        return;
+    }
+
+    if (cluster >= clusters.size())
+    {
+        clusters.resize(cluster + 1);
+    }
+
+    ClusterReads& clusterReads = clusters[cluster];
+    size_t oldSize = clusterReads.buffer.size();
+    char numberString[24];
+    int numberLength = snprintf(numberString, sizeof(numberString), "%llu", (unsigned long long) number);
+    clusterReads.buffer.append(numberString, numberLength);
+    clusterReads.buffer.push_back('\t');
+    clusterReads.buffer.append(seq);
+    clusterReads.buffer.push_back('\t');
+    clusterReads.buffer.append(qual);
+    clusterReads.buffer.push_back('\n');
+    clusterReads.reads++;
+    clusterReads.bases += seq.size();
+    buffered += clusterReads.buffer.size() - oldSize;
+
+    if (clusterReads.buffer.size() >= READ_STORE_BLOCK_SIZE)
+    {
+        flushBlock(clusterReads);
+    }
+    else if (buffered >= READ_STORE_MAX_BUFFERED)
+    {
+        flushAll();
+    }
+}
+
+
+// Makes one block of the read store file from data.
+// Returns true iff all went ok
+bool ReadStoreWriter::compressBlock(const std::string& data, std::string& block)
+{
+    uLongf compressedLength = compressBound(data.size());
+    block.assign(8 + compressedLength, '\0');
+    if (compress2((Bytef *) &block[8], &compressedLength, (const Bytef *) data.data(), data.size(), Z_BEST_SPEED) != Z_OK)
+    {
+        return false;
+    }
+
+    std::string lengths;
+    writeLittleEndian(lengths, data.size(), 4);
+    writeLittleEndian(lengths, compressedLength, 4);
+    block.replace(0, 8, lengths);
+    block.resize(8 + compressedLength);
+    return true;
+}
+
+
+// Returns true iff all went ok
+bool ReadStoreWriter::flushBlock(ClusterReads& clusterReads)
+{
+    if (failed || clusterReads.buffer.size() == 0)
+    {
+        return !failed;
+    }
+
+    std::string block;
+    if (!compressBlock(clusterReads.buffer, block))
+    {
+        std::cerr << "[ariba_minimap] Error compressing reads for read store. Cannot continue" << std::endl;
+        failed = true;
+        return false;
+    }
+
+    if (fwrite(block.data(), 1, block.size(), tmpFile) != block.size())
+    {
+        std::cerr << "[ariba_minimap] Error writing temporary read store file '" << tmpFilename << "'. Cannot continue" << std::endl;
+        failed = true;
+        return false;
+    }
+
+    clusterReads.blocks.push_back(std::make_pair(tmpFileSize, (uint32_t) block.size()));
+    tmpFileSize += block.size();
+    buffered -= clusterReads.buffer.size();
+    clusterReads.buffer.clear();
+    return true;
+}
+
+
+// Returns true iff all went ok
+bool ReadStoreWriter::flushAll()
+{
+    for (std::vector<ClusterReads>::iterator iter = clusters.begin(); iter != clusters.end(); iter++)
+    {
+        if (!flushBlock(*iter))
+        {
+            return false;
+        }
+    }
+
+    return true;
+}
+
+
+// Copies the blocks of one cluster from the temporary file to out, only
+// keeping read pairs whose number is in keptPairs (which must be sorted).
+// Updates the length written and the counts of reads and bases kept.
+// Returns true iff all went ok
+bool ReadStoreWriter::writeFilteredBlocks(const ClusterReads& clusterReads, const std::vector<uint64_t>& keptPairs, FILE *out, uint64_t& length, uint64_t& reads, uint64_t& bases)
+{
+    std::vector<char> block;
+    std::string data;
+    std::string kept;
+    std::string outBlock;
+
+    for (std::vector<std::pair<uint64_t, uint32_t> >::const_iterator b = clusterReads.blocks.begin(); b != clusterReads.blocks.end(); b++)
+    {
+        block.resize(b->second);
+        if (b->second < 8 || fseeko(tmpFile, b->first, SEEK_SET) != 0 || fread(&block[0], 1, b->second, tmpFile) != b->second)
+        {
+            return false;
+        }
+
+        uLongf uncompressedLength = 0;
+        for (int i = 3; i >= 0; i--)
+        {
+            uncompressedLength = (uncompressedLength << 8) | (unsigned char) block[i];
+        }
+        data.resize(uncompressedLength);
+        if (uncompress((Bytef *) &data[0], &uncompressedLength, (const Bytef *) &block[8], b->second - 8) != Z_OK || uncompressedLength != data.size())
+        {
+            return false;
+        }
+
+        size_t lineStart = 0;
+        while (lineStart < data.size())
+        {
+            size_t lineEnd = data.find('\n', lineStart);
+            if (lineEnd == std::string::npos)
+            {
+                return false;
+            }
+
+            uint64_t readNumber = strtoull(data.c_str() + lineStart, NULL, 10);
+            if (std::binary_search(keptPairs.begin(), keptPairs.end(), (readNumber + 1) / 2))
+            {
+                kept.append(data, lineStart, lineEnd + 1 - lineStart);
+                reads++;
+                bases += lineEnd - data.rfind('\t', lineEnd) - 1;
+            }
+            lineStart = lineEnd + 1;
+
+            if (kept.size() >= READ_STORE_BLOCK_SIZE)
+            {
+                if (!compressBlock(kept, outBlock) || fwrite(outBlock.data(), 1, outBlock.size(), out) != outBlock.size())
+                {
+                    return false;
+                }
+                length += outBlock.size();
+                kept.clear();
+            }
+        }
+    }
+
+    if (kept.size() > 0)
+    {
+        if (!compressBlock(kept, outBlock) || fwrite(outBlock.data(), 1, outBlock.size(), out) != outBlock.size())
+        {
+            return false;
+        }
+        length += outBlock.size();
+    }
+
+    return true;
+}
+
+
+// Writes the final file, with each cluster's blocks made contiguous.
+// clusterNames must be sorted. If keptPairs of a cluster is not
+// empty, only those read pairs are written for the cluster.
+// Returns true iff all went ok
+bool ReadStoreWriter::finish(const std::vector<std::string>& clusterNames, const std::vector<std::vector<uint64_t> >& keptPairs)
+{
+    if (!flushAll())
+    {
+        return false;
+    }
+
+    FILE *out = fopen(filename.c_str(), "wb");
+    if (!out)
+    {
+        std::cerr << "[ariba_minimap] Error opening read store file '" << filename << "'. Cannot continue" << std::endl;
+        return false;
+    }
+
+    bool ok = fwrite(READ_STORE_MAGIC, 1, sizeof(READ_STORE_MAGIC), out) == sizeof(READ_STORE_MAGIC);
+    uint64_t offset = sizeof(READ_STORE_MAGIC);
+    std::ostringstream table;
+    std::vector<char> block;
+
+    for (size_t i = 0; ok && i < clusters.size(); i++)
+    {
+        if (clusters[i].reads == 0)
+        {
+            continue;
+        }
+
+        uint64_t clusterLength = 0;
+        if (i < keptPairs.size() && keptPairs[i].size() > 0)
+        {
+            clusters[i].reads = 0;
+            clusters[i].bases = 0;
+            ok = writeFilteredBlocks(clusters[i], keptPairs[i], out, clusterLength, clusters[i].reads, clusters[i].bases);
+        }
+        else
+        {
+            for (std::vector<std::pair<uint64_t, uint32_t> >::iterator b = clusters[i].blocks.begin(); b != clusters[i].blocks.end(); b++)
+            {
+                block.resize(b->second);
+                ok = fseeko(tmpFile, b->first, SEEK_SET) == 0
+                     && fread(&block[0], 1, b->second, tmpFile) == b->second
+                     && fwrite(&block[0], 1, b->second, out) == b->second;
+                if (!ok)
+                {
+                    break;
+                }
+                clusterLength += b->second;
+            }
+        }
+
+        table << clusterNames[i] << '\t' << offset << '\t' << clusterLength << '\t' << clusters[i].reads << '\t' << clusters[i].bases << '\n';
+        offset += clusterLength;
+    }
+
+    std::string footer = table.str();
+    uint64_t tableLength = footer.size();
+    writeLittleEndian(footer, offset, 8);
+    writeLittleEndian(footer, tableLength, 8);
+    footer.append(READ_STORE_MAGIC, sizeof(READ_STORE_MAGIC));
+    ok = ok && fwrite(footer.data(), 1, footer.size(), out) == footer.size();
+    ok = (fclose(out) == 0) && ok;
+    fclose(tmpFile);
+    tmpFile = NULL;
+    unlink(tmpFilename.c_str());
+
+    if (!ok)
+    {
+        std::cerr << "[ariba_minimap] Error writing read store file '" << filename << "'. Cannot continue" << std::endl;
+    }
+
+    return ok;
+}
+
+
+// Returns false if the file cannot be read
+bool getRefFileKey(const char *filename, RefFileKey& key)
+{
+    struct stat st;
+    if (stat(filename, &st) != 0)
+    {
+        return false;
+    }
+
+    FILE *fp = fopen(filename, "rb");
+    if (!fp)
+    {
+        return false;
+    }
+
+    std::vector<unsigned char> buffer(1048576);
+    uLong crc = crc32(0L, Z_NULL, 0);
+    size_t got;
+    while ((got = fread(&buffer[0], 1, buffer.size(), fp)) > 0)
+    {
+        crc = crc32(crc, &buffer[0], got);
+    }
+    bool ok = !ferror(fp);
+    fclose(fp);
+
+    key.size = st.st_size;
+    key.checksum = crc;
+    return ok;
+}
+
+
+int buildIndex(char *refFileIn, char *indexFileIn, int threads)
+{
+    mm_verbose = 0;
+    IndexFileHeader header;
+    memcpy(header.magic, INDEX_MAGIC, sizeof(INDEX_MAGIC));
+    header.w = MINIMAP_W;
+    header.k = MINIMAP_K;
+    if (!getRefFileKey(refFileIn, header.refFileKey))
+    {
+        std::cerr << "[ariba_minimap] Error opening file " << refFileIn << std::endl;
+        return 1;
+    }
+
+    mm_idx_t *mi = mm_idx_build(refFileIn, MINIMAP_W, MINIMAP_K, std::max(1, threads));
+    if (!mi)
+    {
+        std::cerr << "[ariba_minimap] Error indexing" << std::endl;
+        return 1;
+    }
+
+    FILE *fp = fopen(indexFileIn, "wb");
+    if (!fp)
+    {
+        std::cerr << "[ariba_minimap] Error opening index output file '" << indexFileIn << "'. Cannot continue" << std::endl;
+        mm_idx_destroy(mi);
+        return 1;
+    }
+
+    fwrite(&header, sizeof(header), 1, fp);
+    mm_idx_dump(fp, mi);
+    int closedOk = fclose(fp) == 0;
+    mm_idx_destroy(mi);
+    return closedOk ? 0 : 1;
+}
+
+
+// Loads an index file made by buildIndex() and returns the index.
+// Returns NULL if the file is missing, or does not match the reference
+// fasta file or the indexing parameters, in which case the caller
+// should build the index instead
+mm_idx_t *loadIndex(const char *refFile, const std::string& indexFile)
+{
+    RefFileKey refFileKey;
+    if (indexFile.size() == 0 || !getRefFileKey(refFile, refFileKey))
+    {
+        return NULL;
+    }
+
+    FILE *fp = fopen(indexFile.c_str(), "rb");
+    if (!fp)
+    {
+        return NULL;
+    }
+
+    mm_idx_t *mi = NULL;
+    IndexFileHeader header;
+    if (fread(&header, sizeof(header), 1, fp) == 1
+          && memcmp(header.magic, INDEX_MAGIC, sizeof(INDEX_MAGIC)) == 0
+          && header.w == (uint32_t) MINIMAP_W
+          && header.k == (uint32_t) MINIMAP_K
+          && header.refFileKey == refFileKey)
+    {
+        mi = mm_idx_load(fp);
+    }
+
+    fclose(fp);
+
+    if (mi == NULL || mi->w != MINIMAP_W || mi->k != MINIMAP_K)
+    {
+        std::cerr << "[ariba_minimap] Index file '" << indexFile << "' does not match the reference sequences or indexing parameters. Building index instead" << std::endl;
+        mm_idx_destroy(mi);
+        return NULL;
+    }
+
+    return mi;
+}
+
+
+uint64_t KmerFilter::hashKmer(uint64_t kmer)
+{
+    // finalizer of MurmurHash3
+    kmer ^= kmer >> 33;
+    kmer *= 0xff51afd7ed558ccdULL;
+    kmer ^= kmer >> 33;
+    kmer *= 0xc4ceb9fe1a85ec53ULL;
+    kmer ^= kmer >> 33;
+    return kmer;
+}
+
+
+void KmerFilter::addKmer(uint64_t kmer)
+{
+    uint64_t hash = hashKmer(kmer);
+    uint64_t step = (hash >> 32) | 1;
+    for (uint32_t i = 0; i < KMER_FILTER_HASHES; i++, hash += step)
+    {
+        bits[(hash & mask) >> 6] |= 1ULL << (hash & 63);
+    }
+}
+
+
+bool KmerFilter::hasKmer(uint64_t kmer) const
+{
+    uint64_t hash = hashKmer(kmer);
+    uint64_t step = (hash >> 32) | 1;
+    for (uint32_t i = 0; i < KMER_FILTER_HASHES; i++, hash += step)
+    {
+        if ((bits[(hash & mask) >> 6] & (1ULL << (hash & 63))) == 0)
+        {
+            return false;
+        }
+    }
+    return true;
+}
+
+
+// Returns true iff seq has a canonical k-mer that is in the filter.
+// k-mers are made the same way as minimap does, skipping ambiguous bases
+bool KmerFilter::sharesKmer(const std::string& seq) const
+{
+    const uint64_t shift = 2 * (MINIMAP_K - 1);
+    const uint64_t kmerMask = (1ULL << 2 * MINIMAP_K) - 1;
+    uint64_t kmer[2] = {0, 0};
+    int length = 0;
+
+    for (size_t i = 0; i < seq.size(); i++)
+    {
+        int c = seq_nt4_table[(uint8_t) seq[i]];
+        if (c < 4)
+        {
+            kmer[0] = (kmer[0] << 2 | c) & kmerMask;
+            kmer[1] = (kmer[1] >> 2) | (3ULL ^ c) << shift;
+            if (++length >= MINIMAP_K && hasKmer(std::min(kmer[0], kmer[1])))
+            {
+                return true;
+            }
+        }
+        else
+        {
+            length = 0;
+        }
+    }
+
+    return false;
+}
+
+
+// The filter size is chosen from the number of distinct k-mers, so that
+// few read pairs that do not map get through
+bool KmerFilter::build(const char *refFile)
+{
+    gzFile infile = gzopen(refFile, "r");
+    if (!infile)
+    {
+        return false;
+    }
+
+    const uint64_t shift = 2 * (MINIMAP_K - 1);
+    const uint64_t kmerMask = (1ULL << 2 * MINIMAP_K) - 1;
+    std::vector<uint64_t> kmers;
+    kseq_t *ks = kseq_init(infile);
+    while (kseq_read(ks) >= 0)
+    {
+        uint64_t kmer[2] = {0, 0};
+        int length = 0;
+        for (size_t i = 0; i < ks->seq.l; i++)
+        {
+            int c = seq_nt4_table[(uint8_t) ks->seq.s[i]];
+            if (c < 4)
+            {
+                kmer[0] = (kmer[0] << 2 | c) & kmerMask;
+                kmer[1] = (kmer[1] >> 2) | (3ULL ^ c) << shift;
+                if (++length >= MINIMAP_K)
+                {
+                    kmers.push_back(std::min(kmer[0], kmer[1]));
+                }
+            }
+            else
+            {
+                length = 0;
+            }
+        }
+    }
+
+    kseq_destroy(ks);
+    gzclose(infile);
+
+    std::sort(kmers.begin(), kmers.end());
+    kmers.erase(std::unique(kmers.begin(), kmers.end()), kmers.end());
+    uint64_t nBits = KMER_FILTER_MIN_BITS;
+    while (nBits < KMER_FILTER_BITS_PER_KMER * kmers.size())
+    {
+        nBits <<= 1;
+    }
+    mask = nBits - 1;
+    bits.assign(nBits / 64, 0);
+
+    for (std::vector<uint64_t>::const_iterator iter = kmers.begin(); iter != kmers.end(); iter++)
+    {
+        addKmer(*iter);
+    }
+
+    return true;
+}
+
+
+bool KmerFilter::save(const char *filename, const RefFileKey& refFileKey) const
+{
+    KmerFilterFileHeader header;
+    memcpy(header.magic, KMER_FILTER_MAGIC, sizeof(KMER_FILTER_MAGIC));
+    header.k = MINIMAP_K;
+    header.hashes = KMER_FILTER_HASHES;
+    header.bits = mask + 1;
+    header.refFileKey = refFileKey;
+
+    FILE *fp = fopen(filename, "wb");
+    if (!fp)
+    {
+        return false;
+    }
+
+    bool ok = fwrite(&header, sizeof(header), 1, fp) == 1
+              && fwrite(&bits[0], sizeof(uint64_t), bits.size(), fp) == bits.size();
+    return (fclose(fp) == 0) && ok;
+}
+
+
+// Returns false if the file is missing, or does not match the reference
+// fasta file or the filter parameters
+bool KmerFilter::load(const char *filename, const RefFileKey& refFileKey)
+{
+    FILE *fp = fopen(filename, "rb");
+    if (!fp)
+    {
+        return false;
+    }
+
+    KmerFilterFileHeader header;
+    bool ok = fread(&header, sizeof(header), 1, fp) == 1
+              && memcmp(header.magic, KMER_FILTER_MAGIC, sizeof(KMER_FILTER_MAGIC)) == 0
+              && header.k == (uint32_t) MINIMAP_K
+              && header.hashes == KMER_FILTER_HASHES
+              && header.refFileKey == refFileKey
+              && header.bits >= KMER_FILTER_MIN_BITS
+              && (header.bits & (header.bits - 1)) == 0;
+
+    if (ok)
+    {
+        mask = header.bits - 1;
+        bits.resize(header.bits / 64);
+        ok = fread(&bits[0], sizeof(uint64_t), bits.size(), fp) == bits.size();
+    }
+
+    fclose(fp);
+    return ok;
+}
+
+
+int buildKmerFilter(char *refFileIn, char *filterFileIn)
+{
+    RefFileKey refFileKey;
+    KmerFilter kmerFilter;
+    if (!getRefFileKey(refFileIn, refFileKey) || !kmerFilter.build(refFileIn))
+    {
+        std::cerr << "[ariba_minimap] Error opening file " << refFileIn << std::endl;
+        return 1;
+    }
+
+    if (!kmerFilter.save(filterFileIn, refFileKey))
+    {
+        std::cerr << "[ariba_minimap] Error writing k-mer filter file '" << filterFileIn << "'. Cannot continue" << std::endl;
+        return 1;
+    }
+
+    return 0;
+}
+
+
+// Frees the cached index and filter, and forgets the reference file
+void ReferenceCache::clear()
+{
+    if (mi)
+    {
+        mm_idx_destroy(mi);
+    }
+    refFile.clear();
+    refFileKey = RefFileKey();
+    mi = NULL;
+    haveKmerFilter = false;
+    kmerFilter = KmerFilter();
+}
+
+
+// Loads the filter made by buildKmerFilter() if the file exists and
+// matches the reference sequences, otherwise builds it.
+// Returns true iff all went ok
+bool loadOrBuildKmerFilter(const char *refFile, const std::string& filterFile, KmerFilter& kmerFilter)
+{
+    RefFileKey refFileKey;
+    if (!getRefFileKey(refFile, refFileKey))
+    {
+        return false;
+    }
+
+    if (filterFile.size() > 0)
+    {
+        if (kmerFilter.load(filterFile.c_str(), refFileKey))
+        {
+            return true;
+        }
+        std::cerr << "[ariba_minimap] K-mer filter file '" << filterFile << "' does not match the reference sequences or filter parameters. Building filter instead" << std::endl;
+    }
+
+    return kmerFilter.build(refFile);
+}
+
+
+// Returns true iff the pair is in the reservoir after adding it
+bool ClusterReservoir::add(uint64_t pairNumber, uint64_t& rngState)
+{
+    seen++;
+    if (cap == 0)
+    {
+        return true;
+    }
+    else if (pairNumbers.size() < cap)
+    {
+        pairNumbers.push_back(pairNumber);
+        return true;
+    }
+
+    uint64_t i = splitmix64(rngState) % seen;
+    if (i < cap)
+    {
+        pairNumbers[i] = pairNumber;
+        return true;
+    }
+
+    return false;
+}
+
+
+uint64_t splitmix64(uint64_t& state)
+{
+    uint64_t z = (state += 0x9e3779b97f4a7c15ULL);
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    return z ^ (z >> 31);
+}
+
+
+// Sets the cap of each cluster to the number of read pairs needed to give
+// capCoverage over the longest reference sequence in the cluster, using
+// the mean length of the given read pairs
+void setReadCaps(const mm_idx_t *mi, const std::vector<uint32_t>& ridToCluster, const std::vector<ReadPair>& pairs, long numberOfPairs, int capCoverage, std::vector<ClusterReservoir>& reservoirs)
+{
+    uint64_t pairBases = 0;
+    for (long i = 0; i < numberOfPairs; i++)
+    {
+        pairBases += pairs[i].seq1.size() + pairs[i].seq2.size();
+    }
+    double meanPairLength = std::max(1.0, (double) pairBases / std::max(1L, numberOfPairs));
+
+    std::vector<uint32_t> longestRef(reservoirs.size(), 0);
+    for (uint32_t rid = 0; rid < mi->n; rid++)
+    {
+        longestRef[ridToCluster[rid]] = std::max(longestRef[ridToCluster[rid]], (uint32_t) mi->len[rid]);
+    }
+
+    for (size_t i = 0; i < reservoirs.size(); i++)
+    {
+        reservoirs[i].cap = std::max(1.0, ceil(capCoverage * (double) longestRef[i] / meanPairLength));
+    }
+}
+
+
+double secondsNow()
+{
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return now.tv_sec + 1e-9 * now.tv_nsec;
+}
+
+
+void mapReadPair(void *data, long i, int threadId)
+{
+    MappingBatch *batch = (MappingBatch *) data;
+    ReadPair& pair = (*batch->pairs)[i];
+    mm_tbuf_t *tbuf = (*batch->tbufs)[threadId];
+    const mm_reg1_t *reg;
+    int n_reg;
+    pair.screenedOut = false;
+
+    if (batch->kmerFilter != NULL)
+    {
+        PrescreenTimes& times = (*batch->times)[threadId];
+        double startTime = secondsNow();
+        pair.screenedOut = !batch->kmerFilter->sharesKmer(pair.seq1) && !batch->kmerFilter->sharesKmer(pair.seq2);
+        times.prescreen += secondsNow() - startTime;
+
+        if (pair.screenedOut)
+        {
+            pair.hits1.clear();
+            pair.hits2.clear();
+            if ((i / PRESCREEN_SAMPLE_RUN) % PRESCREEN_SAMPLE_EVERY == 0)
+            {
+                startTime = secondsNow();
+                mm_map(batch->mi, pair.seq1.size(), pair.seq1.c_str(), &n_reg, tbuf, batch->opt, 0);
+                mm_map(batch->mi, pair.seq2.size(), pair.seq2.c_str(), &n_reg, tbuf, batch->opt, 0);
+                times.sampledMapping += secondsNow() - startTime;
+                times.pairsSampled++;
+            }
+            return;
+        }
+    }
+
+    // the hits live in the thread buffer, so need copying before it is reused
+    reg = mm_map(batch->mi, pair.seq1.size(), pair.seq1.c_str(), &n_reg, tbuf, batch->opt, 0);
+    pair.hits1.assign(reg, reg + n_reg);
+    reg = mm_map(batch->mi, pair.seq2.size(), pair.seq2.c_str(), &n_reg, tbuf, batch->opt, 0);
+    pair.hits2.assign(reg, reg + n_reg);
 }
 
 
-static PyMethodDef minimapMethods[] = {
-   { "minimap_ariba", main_wrapper, METH_VARARGS, "minimap ariba" },
-   { NULL, NULL, 0, NULL }
-};
+// Fills pairs with up to PAIRS_PER_BATCH read pairs. Returns the number
+// loaded, or -1 if the second reads file ran out before the first one
+long loadReadPairs(kseq_t *ks1, kseq_t *ks2, std::vector<ReadPair>& pairs)
+{
+    long n = 0;
 
+    while (n < PAIRS_PER_BATCH && kseq_read(ks1) >= 0)
+    {
+        if (kseq_read(ks2) < 0)
+        {
+            return -1;
+        }
 
-static struct PyModuleDef minimapModule = {
-   PyModuleDef_HEAD_INIT,
-   "minimap_ariba",   /* name of module */
-   NULL, /* module documentation, may be NULL */
-   -1,       /* size of per-interpreter state of the module,
-                or -1 if the module keeps state in global variables. */
-   minimapMethods
-};
+        ReadPair& pair = pairs[n];
+        pair.seq1.assign(ks1->seq.s, ks1->seq.l);
+        pair.qual1.assign(ks1->qual.l ? ks1->qual.s : "", ks1->qual.l);
+        pair.seq2.assign(ks2->seq.s, ks2->seq.l);
+        pair.qual2.assign(ks2->qual.l ? ks2->qual.s : "", ks2->qual.l);
+        n++;
+    }
 
-PyMODINIT_FUNC
-PyInit_minimap_ariba(void)
-{
-    return PyModule_Create(&minimapModule);
+    return n;
 }
 
 
-
-int run_minimap(char *clustersFileIn, char *refFileIn, char *readsFile1In, char *readsFile2In, char *outprefixIn)
+int run_minimap(char *clustersFileIn, char *refFileIn, char *readsFile1In, char *readsFile2In, char *outprefixIn, int threads, char *indexFileIn, int nativeReadStore, int kmerPrescreen, char *kmerFilterFileIn, int readCapCoverage, int keepReference)
 {
     mm_verbose = 0;
-    std::map<std::string, uint64_t> refnameToScore;
     std::map<std::string, std::string> refnameToCluster;
     std::string clustersFile(clustersFileIn);
-    loadClusters(clustersFile, refnameToCluster);
-    std::map<std::string, uint64_t> readCounters;
-    std::map<std::string, uint64_t> baseCounters;
+    if (!loadClusters(clustersFile, refnameToCluster))
+    {
+        return 1;
+    }
     std::map<uint32_t, uint32_t> insertHist;
     uint32_t properPairs = 0;
     std::string outprefix(outprefixIn);
-    std::string readsOutfile = outprefix + ".reads";
+    std::string readsOutfile = outprefix + (nativeReadStore ? ".readStore" : ".reads");
     std::ofstream ofs;
-    ofs.open(readsOutfile.c_str());
-    if (!ofs.good())
+    ReadStoreWriter *readStoreWriter = NULL;
+    if (nativeReadStore)
+    {
+        readStoreWriter = new ReadStoreWriter(readsOutfile);
+    }
+    else
+    {
+        ofs.open(readsOutfile.c_str());
+    }
+
+    if (nativeReadStore ? !readStoreWriter->good() : !ofs.good())
     {
         std::cerr << "[ariba_minimap] Error opening reads output file '" << readsOutfile << "'. Cannot continue" << std::endl;
+        delete readStoreWriter;
         return 1;
     }
 
@@ -94,141 +1332,308 @@ int run_minimap(char *clustersFileIn, char *refFileIn, char *readsFile1In, char
     if (!infile1)
     {
         std::cerr << "[ariba_minimap] Error opening file " << readsFile1In << std::endl;
+        delete readStoreWriter;
         return 1;
     }
     gzFile infile2 = gzopen(readsFile2In, "r");
     if (!infile2)
     {
         std::cerr << "[ariba_minimap] Error opening file " << readsFile2In << std::endl;
+        gzclose(infile1);
+        delete readStoreWriter;
         return 1;
     }
     kseq_t *ks1 = kseq_init(infile1);
     kseq_t *ks2 = kseq_init(infile2);
 
+    // use the index kept from an earlier call if there is one, or the
+    // index made by prepareref if there is one, otherwise
     // create index for target; we are creating one index for all target sequence
-    int n_threads = 1;
-    int w = 10, k = 15;
-    mm_idx_t *mi = mm_idx_build(refFileIn, w, k, n_threads);
+    int n_threads = std::max(1, threads);
+    int w = MINIMAP_W, k = MINIMAP_K;
+    RefFileKey refFileKey;
+    bool useCache = keepReference && getRefFileKey(refFileIn, refFileKey);
+    if (useCache && (referenceCache.refFile != refFileIn || referenceCache.refFileKey != refFileKey))
+    {
+        referenceCache.clear();
+    }
+    mm_idx_t *mi = useCache ? referenceCache.mi : NULL;
+    if (!mi)
+    {
+        mi = loadIndex(refFileIn, std::string(indexFileIn));
+    }
+    if (!mi)
+    {
+        mi = mm_idx_build(refFileIn, w, k, n_threads);
+    }
     if (!mi)
     {
         std::cerr << "[ariba_minimap] Error indexing" << std::endl;
+        kseq_destroy(ks1);
+        kseq_destroy(ks2);
+        gzclose(infile1);
+        gzclose(infile2);
+        delete readStoreWriter;
         return 1;
     }
+    if (useCache)
+    {
+        referenceCache.refFile = refFileIn;
+        referenceCache.refFileKey = refFileKey;
+        referenceCache.mi = mi;
+    }
 
-    // mapping
-    mm_mapopt_t opt;
-    mm_mapopt_init(&opt); // initialize mapping parameters
-    mm_tbuf_t *tbuf1 = mm_tbuf_init(); // thread buffer; for multi-threading, allocate one tbuf for each thread
-    mm_tbuf_t *tbuf2 = mm_tbuf_init(); // thread buffer; for multi-threading, allocate one tbuf for each thread
-    while (kseq_read(ks1) >= 0) { // each kseq_read() call reads one query sequence
-        const mm_reg1_t *reg1, *reg2;
-        int j, n_reg1, n_reg2;
-        int ks2ok = kseq_read(ks2);
-        if (ks2ok == 0)
+    KmerFilter localKmerFilter;
+    KmerFilter& kmerFilter = useCache ? referenceCache.kmerFilter : localKmerFilter;
+    if (kmerPrescreen && !(useCache && referenceCache.haveKmerFilter))
+    {
+        if (!loadOrBuildKmerFilter(refFileIn, std::string(kmerFilterFileIn), kmerFilter))
         {
-            std::cerr << "Error getting mate of read. Cannot continue" << std::endl;
+            std::cerr << "[ariba_minimap] Error making k-mer filter from file " << refFileIn << std::endl;
+            if (!useCache)
+            {
+                mm_idx_destroy(mi);
+            }
+            kseq_destroy(ks1);
+            kseq_destroy(ks2);
+            gzclose(infile1);
+            gzclose(infile2);
+            delete readStoreWriter;
             return 1;
         }
+        if (useCache)
+        {
+            referenceCache.haveKmerFilter = true;
+        }
+    }
 
-        // get all hits for the forward and reverse reads
-        reg1 = mm_map(mi, ks1->seq.l, ks1->seq.s, &n_reg1, tbuf1, &opt, 0);
-        reg2 = mm_map(mi, ks2->seq.l, ks2->seq.s, &n_reg2, tbuf2, &opt, 0);
+    ClusterIndexes indexes;
+    makeClusterIndexes(mi, refnameToCluster, indexes);
+    std::vector<uint64_t> refScores(mi->n, 0);
+    std::vector<RefHits> refHits(mi->n);
+    std::vector<uint32_t> pairRanks; // ranks of the reference sequences hit by the current pair
+    std::vector<uint64_t> readCounters(indexes.clusterNames.size(), 0);
+    std::vector<uint64_t> baseCounters(indexes.clusterNames.size(), 0);
+    std::vector<uint64_t> clusterLastPair(indexes.clusterNames.size(), 0); // stops writing a pair to a cluster twice
+    uint64_t pairNumber = 0;
+    std::vector<ClusterReservoir> reservoirs(indexes.clusterNames.size());
+    uint64_t rngState = 42;
+    bool readCapsSet = false;
 
-        if (n_reg1 > 0 || n_reg2 > 0)
+    // mapping. Read pairs are mapped in batches, one thread buffer per thread.
+    // The hits are then processed in the same order as the input reads,
+    // so that the output does not depend on the number of threads
+    mm_mapopt_t opt;
+    mm_mapopt_init(&opt); // initialize mapping parameters
+    std::vector<mm_tbuf_t *> tbufs;
+    for (int i = 0; i < n_threads; i++)
+    {
+        tbufs.push_back(mm_tbuf_init());
+    }
+    std::vector<ReadPair> pairs(PAIRS_PER_BATCH);
+    std::vector<PrescreenTimes> prescreenTimes(n_threads);
+    MappingBatch batch = {mi, &opt, &tbufs, &pairs, kmerPrescreen ? &kmerFilter : NULL, &prescreenTimes};
+    long pairsInBatch;
+    uint64_t pairsScreenedOut = 0;
+
+    while ((pairsInBatch = loadReadPairs(ks1, ks2, pairs)) > 0)
+    {
+        kt_for(n_threads, mapReadPair, &batch, pairsInBatch);
+
+        // the cap is only applied to the native read store, which is
+        // able to remove pairs that are evicted from the reservoir
+        if (nativeReadStore && readCapCoverage > 0 && !readCapsSet)
         {
-            std::map<std::string, MapPositionVector> positions1;
-            std::map<std::string, MapPositionVector> positions2;
-            std::set<std::string> refnames;
+            setReadCaps(mi, indexes.ridToCluster, pairs, pairsInBatch, readCapCoverage, reservoirs);
+            readCapsSet = true;
+        }
 
-            for (j  =0; j < n_reg1; ++j)
-            {
-                const mm_reg1_t *r = &reg1[j];
-                refnames.insert(mi->name[r->rid]);
-                refnameToScore[mi->name[r->rid]] += r->cnt;
-                uint32_t coord = r->rev ? std::max(r->rs, r->re) : std::min(r->rs, r->re);
-                positions1[mi->name[r->rid]].push_back(std::make_pair(coord, r->rev));
-            }
-            for (j  =0; j < n_reg2; ++j)
+        for (long p = 0; p < pairsInBatch; p++)
+        {
+            const ReadPair& pair = pairs[p];
+            int j;
+            int n_reg1 = pair.hits1.size();
+            int n_reg2 = pair.hits2.size();
+            pairNumber++;
+            if (pair.screenedOut)
             {
-                const mm_reg1_t *r = &reg2[j];
-                refnames.insert(mi->name[r->rid]);
-                refnameToScore[mi->name[r->rid]] += r->cnt;
-                uint32_t coord = r->rev ? std::max(r->rs, r->re) : std::min(r->rs, r->re);
-                positions2[mi->name[r->rid]].push_back(std::make_pair(coord, r->rev));
+                pairsScreenedOut++;
+                continue;
             }
 
-            bool foundProperPair = false;
-            std::set<std::string> usedClusters;
-            for (std::set<std::string>::const_iterator iter = refnames.begin(); iter != refnames.end(); iter++)
+            if (n_reg1 > 0 || n_reg2 > 0)
             {
-                std::string cluster = refnameToCluster[*iter];
-
-                // do not write a read pair to the same cluster more than once
-                if (usedClusters.find(cluster) != usedClusters.end())
+                for (j  =0; j < n_reg1; ++j)
                 {
-                    continue;
+                    const mm_reg1_t *r = &pair.hits1[j];
+                    RefHits& hits = refHits[r->rid];
+                    if (hits.hits1 == 0 && hits.hits2 == 0)
+                    {
+                        pairRanks.push_back(indexes.ridToRank[r->rid]);
+                    }
+                    if (hits.hits1 == 0)
+                    {
+                        uint32_t coord = r->rev ? std::max(r->rs, r->re) : std::min(r->rs, r->re);
+                        hits.firstPosition1 = std::make_pair(coord, (bool) r->rev);
+                    }
+                    hits.hits1++;
+                    refScores[r->rid] += r->cnt;
                 }
-
-                usedClusters.insert(cluster);
-                readCounters[cluster]++;
-                ofs << cluster << '\t' << readCounters[cluster] << '\t' << ks1->seq.s << '\t' << ks1->qual.s << '\n';
-                readCounters[cluster]++;
-                ofs << cluster << '\t' << readCounters[cluster] << '\t' << ks2->seq.s << '\t' << ks2->qual.s << '\n';
-                baseCounters[cluster] += ks1->seq.l + ks2->seq.l;
-
-                // get insert size info, if reads mapped as proper pair
-                if (positions1.find(*iter) != positions1.end() && positions2.find(*iter) != positions2.end())
+                for (j  =0; j < n_reg2; ++j)
                 {
-                    if (positions1[*iter].size() != 1 || positions2[*iter].size() != 1 || positions1[*iter][0].second == positions2[*iter][0].second)
+                    const mm_reg1_t *r = &pair.hits2[j];
+                    RefHits& hits = refHits[r->rid];
+                    if (hits.hits1 == 0 && hits.hits2 == 0)
                     {
-                        continue;
+                        pairRanks.push_back(indexes.ridToRank[r->rid]);
+                    }
+                    if (hits.hits2 == 0)
+                    {
+                        uint32_t coord = r->rev ? std::max(r->rs, r->re) : std::min(r->rs, r->re);
+                        hits.firstPosition2 = std::make_pair(coord, (bool) r->rev);
                     }
+                    hits.hits2++;
+                    refScores[r->rid] += r->cnt;
+                }
 
-                    uint32_t insertSize;
+                std::sort(pairRanks.begin(), pairRanks.end());
+                bool foundProperPair = false;
+                for (std::vector<uint32_t>::const_iterator iter = pairRanks.begin(); iter != pairRanks.end(); iter++)
+                {
+                    uint32_t rid = indexes.rankToRid[*iter];
+                    uint32_t cluster = indexes.ridToCluster[rid];
 
-                    if (positions1[*iter][0].second && positions1[*iter][0].first > positions2[*iter][0].first)
+                    // do not write a read pair to the same cluster more than once
+                    if (clusterLastPair[cluster] == pairNumber)
                     {
-                        insertSize = positions1[*iter][0].first - positions2[*iter][0].first + 1;
+                        continue;
                     }
-                    else if (positions2[*iter][0].second && positions2[*iter][0].first > positions1[*iter][0].first)
+
+                    clusterLastPair[cluster] = pairNumber;
+                    if (nativeReadStore)
                     {
-                        insertSize = positions2[*iter][0].first - positions1[*iter][0].first + 1;
+                        bool keepPair = reservoirs[cluster].add(readCounters[cluster] / 2 + 1, rngState);
+                        readCounters[cluster]++;
+                        if (keepPair)
+                        {
+                            readStoreWriter->add(cluster, readCounters[cluster], pair.seq1, pair.qual1);
+                        }
+                        readCounters[cluster]++;
+                        if (keepPair)
+                        {
+                            readStoreWriter->add(cluster, readCounters[cluster], pair.seq2, pair.qual2);
+                        }
                     }
                     else
                     {
-                        continue;
+                        const std::string& clusterName = indexes.clusterNames[cluster];
+                        readCounters[cluster]++;
+                        ofs << clusterName << '\t' << readCounters[cluster] << '\t' << pair.seq1 << '\t' << pair.qual1 << '\n';
+                        readCounters[cluster]++;
+                        ofs << clusterName << '\t' << readCounters[cluster] << '\t' << pair.seq2 << '\t' << pair.qual2 << '\n';
                     }
+                    baseCounters[cluster] += pair.seq1.size() + pair.seq2.size();
+
+                    // get insert size info, if reads mapped as proper pair
+                    const RefHits& hits = refHits[rid];
+                    if (hits.hits1 > 0 && hits.hits2 > 0)
+                    {
+                        if (hits.hits1 != 1 || hits.hits2 != 1 || hits.firstPosition1.second == hits.firstPosition2.second)
+                        {
+                            continue;
+                        }
 
-                    insertHist[insertSize + 2*k]++;
-                    foundProperPair = true;
+                        uint32_t insertSize;
+
+                        if (hits.firstPosition1.second && hits.firstPosition1.first > hits.firstPosition2.first)
+                        {
+                            insertSize = hits.firstPosition1.first - hits.firstPosition2.first + 1;
+                        }
+                        else if (hits.firstPosition2.second && hits.firstPosition2.first > hits.firstPosition1.first)
+                        {
+                            insertSize = hits.firstPosition2.first - hits.firstPosition1.first + 1;
+                        }
+                        else
+                        {
+                            continue;
+                        }
+
+                        insertHist[insertSize + 2*k]++;
+                        foundProperPair = true;
+                    }
                 }
-            }
 
-            if (foundProperPair)
-            {
-                properPairs++;
+                if (foundProperPair)
+                {
+                    properPairs++;
+                }
+
+                for (std::vector<uint32_t>::const_iterator iter = pairRanks.begin(); iter != pairRanks.end(); iter++)
+                {
+                    refHits[indexes.rankToRid[*iter]] = RefHits();
+                }
+                pairRanks.clear();
             }
         }
     }
-    mm_tbuf_destroy(tbuf1);
-    mm_tbuf_destroy(tbuf2);
 
-    // deallocate index and close the query file
-    mm_idx_destroy(mi);
+    for (std::vector<mm_tbuf_t *>::iterator iter = tbufs.begin(); iter != tbufs.end(); iter++)
+    {
+        mm_tbuf_destroy(*iter);
+    }
+
+    // deallocate index (unless it is being kept) and close the query file
+    if (!useCache)
+    {
+        mm_idx_destroy(mi);
+    }
     kseq_destroy(ks1);
     kseq_destroy(ks2);
     gzclose(infile1);
     gzclose(infile2);
-    ofs.close();
-    chooseCluster(outprefix + ".cluster2representative", refnameToScore, refnameToCluster);
-    writeClusterCountsFile(outprefix + ".clusterCounts", readCounters, baseCounters);
-    writeInsertHistogramFile(outprefix + ".insertHistogram", insertHist);
-    writeProperPairsFile(outprefix + ".properPairs", properPairs);
-    return 0;
+    bool readsWrittenOk = true;
+    if (nativeReadStore)
+    {
+        // pairs only need removing from clusters that went over their cap
+        std::vector<std::vector<uint64_t> > keptPairs(reservoirs.size());
+        for (size_t i = 0; i < reservoirs.size(); i++)
+        {
+            if (reservoirs[i].cap > 0 && reservoirs[i].seen > reservoirs[i].cap)
+            {
+                keptPairs[i].swap(reservoirs[i].pairNumbers);
+                std::sort(keptPairs[i].begin(), keptPairs[i].end());
+            }
+        }
+        readsWrittenOk = readStoreWriter->finish(indexes.clusterNames, keptPairs);
+        delete readStoreWriter;
+    }
+    else
+    {
+        ofs.close();
+    }
+
+    if (pairsInBatch < 0)
+    {
+        std::cerr << "Error getting mate of read. Cannot continue" << std::endl;
+        return 1;
+    }
+
+    if (!readsWrittenOk)
+    {
+        return 1;
+    }
+
+    bool ok = chooseCluster(outprefix + ".cluster2representative", refScores, indexes)
+              && writeClusterCountsFile(outprefix + ".clusterCounts", indexes.clusterNames, readCounters, baseCounters)
+              && writeInsertHistogramFile(outprefix + ".insertHistogram", insertHist)
+              && writeProperPairsFile(outprefix + ".properPairs", properPairs)
+              && (!kmerPrescreen || writePrescreenFile(outprefix + ".prescreen", pairNumber, pairsScreenedOut, prescreenTimes));
+    return ok ? 0 : 1;
 }
 
 
-void loadClusters(std::string& filename, std::map<std::string, std::string>& refnameToCluster)
+// Returns true iff all went ok
+bool loadClusters(std::string& filename, std::map<std::string, std::string>& refnameToCluster)
 {
     std::ifstream ifs;
     std::string line;
@@ -236,7 +1641,7 @@ void loadClusters(std::string& filename, std::map<std::string, std::string>& ref
     if (!ifs.good())
     {
         std::cerr << "Error opening clusters file '" << filename << "'. Cannot continue" << std::endl;
-        exit(1);
+        return false;
     }
 
     while(getline(ifs, line))
@@ -248,7 +1653,7 @@ void loadClusters(std::string& filename, std::map<std::string, std::string>& ref
         if (cluster.size() == 0)
         {
             std::cerr << "Error reading clusters file at the following line\n" << line << std::endl;
-            exit(1);
+            return false;
         }
 
         while (getline(ss, seqname, '\t'))
@@ -258,21 +1663,57 @@ void loadClusters(std::string& filename, std::map<std::string, std::string>& ref
     }
 
     ifs.close();
+    return true;
+}
+
+
+void makeClusterIndexes(const mm_idx_t *mi, const std::map<std::string, std::string>& refnameToCluster, ClusterIndexes& indexes)
+{
+    // reference sequences not in the clusters file go in a cluster with an empty name
+    std::vector<std::pair<std::string, uint32_t> > refnames;
+    std::vector<std::string> ridClusterNames;
+    std::set<std::string> clusterNames;
+    for (uint32_t rid = 0; rid < mi->n; rid++)
+    {
+        indexes.refnames.push_back(mi->name[rid]);
+        refnames.push_back(std::make_pair(indexes.refnames.back(), rid));
+        std::map<std::string, std::string>::const_iterator iter = refnameToCluster.find(refnames.back().first);
+        ridClusterNames.push_back(iter == refnameToCluster.end() ? "" : iter->second);
+        clusterNames.insert(ridClusterNames.back());
+    }
+
+    indexes.clusterNames.assign(clusterNames.begin(), clusterNames.end());
+    indexes.ridToCluster.resize(mi->n);
+    for (uint32_t rid = 0; rid < mi->n; rid++)
+    {
+        indexes.ridToCluster[rid] = std::lower_bound(indexes.clusterNames.begin(), indexes.clusterNames.end(), ridClusterNames[rid]) - indexes.clusterNames.begin();
+    }
+
+    std::sort(refnames.begin(), refnames.end());
+    indexes.rankToRid.resize(mi->n);
+    indexes.ridToRank.resize(mi->n);
+    for (uint32_t rank = 0; rank < mi->n; rank++)
+    {
+        indexes.rankToRid[rank] = refnames[rank].second;
+        indexes.ridToRank[refnames[rank].second] = rank;
+    }
 }
 
 
-void chooseCluster(std::string outfile, std::map<std::string, uint64_t>& refnameToScore, std::map<std::string, std::string>& refnameToCluster)
+// For each cluster, writes the reference sequence with the highest score.
+// Ties are broken by taking the first sequence in name order.
+// Returns true iff all went ok
+bool chooseCluster(std::string outfile, const std::vector<uint64_t>& refScores, const ClusterIndexes& indexes)
 {
-    std::map<std::string, uint64_t> bestClusterScore;
-    std::map<std::string, std::string> bestCluster;
-    std::map<std::string, uint64_t>::iterator iter;
-    for (iter = refnameToScore.begin(); iter != refnameToScore.end(); iter++)
+    std::vector<uint64_t> bestClusterScore(indexes.clusterNames.size(), 0);
+    std::vector<uint32_t> bestCluster(indexes.clusterNames.size(), 0);
+    for (std::vector<uint32_t>::const_iterator iter = indexes.rankToRid.begin(); iter != indexes.rankToRid.end(); iter++)
     {
-        std::string cluster = refnameToCluster[iter->first];
-        if (bestClusterScore.find(cluster) == bestClusterScore.end() || bestClusterScore[cluster] < iter->second)
+        uint32_t cluster = indexes.ridToCluster[*iter];
+        if (bestClusterScore[cluster] < refScores[*iter])
         {
-            bestClusterScore[cluster] = iter->second;
-            bestCluster[cluster] = iter->first;
+            bestClusterScore[cluster] = refScores[*iter];
+            bestCluster[cluster] = *iter;
         }
     }
 
@@ -281,50 +1722,55 @@ void chooseCluster(std::string outfile, std::map<std::string, uint64_t>& refname
     if (!ofs.good())
     {
         std::cerr << "Error opening output best cluster file '" << outfile << "'. Cannot continue" << std::endl;
-        exit(1);
+        return false;
     }
 
-    for (iter = bestClusterScore.begin(); iter != bestClusterScore.end(); iter++)
+    for (size_t i = 0; i < indexes.clusterNames.size(); i++)
     {
-        ofs << iter->first << '\t' << bestCluster[iter->first] << '\n';
+        if (bestClusterScore[i] > 0)
+        {
+            ofs << indexes.clusterNames[i] << '\t' << indexes.refnames[bestCluster[i]] << '\n';
+        }
     }
 
     ofs.close();
+    return !ofs.fail();
 }
 
 
-void writeClusterCountsFile(std::string outfile, const std::map<std::string, uint64_t>& readCounters, const std::map<std::string, uint64_t>& baseCounters)
+// Returns true iff all went ok
+bool writeClusterCountsFile(std::string outfile, const std::vector<std::string>& clusterNames, const std::vector<uint64_t>& readCounters, const std::vector<uint64_t>& baseCounters)
 {
     std::ofstream ofs;
     ofs.open(outfile.c_str());
     if (!ofs.good())
     {
         std::cerr << "Error opening output cluster reads/bases counts file '" << outfile << "'. Cannot continue" << std::endl;
-        exit(1);
+        return false;
     }
 
-    for (std::map<std::string, uint64_t>::const_iterator iter = readCounters.begin(); iter != readCounters.end(); iter++)
+    for (size_t i = 0; i < clusterNames.size(); i++)
     {
-        if (baseCounters.find(iter->first) == baseCounters.end())
+        if (readCounters[i] > 0)
         {
-            std::cerr << "Error writing cluster counts file" << std::endl;
-            exit(1);
+            ofs << clusterNames[i] << '\t' << readCounters[i] << '\t' << baseCounters[i] << '\n';
         }
-        ofs << iter->first << '\t' << iter->second << '\t' << baseCounters.find(iter->first)->second << '\n';
     }
 
     ofs.close();
+    return !ofs.fail();
 }
 
 
-void writeInsertHistogramFile(std::string outfile, const std::map<uint32_t, uint32_t>& insertHist)
+// Returns true iff all went ok
+bool writeInsertHistogramFile(std::string outfile, const std::map<uint32_t, uint32_t>& insertHist)
 {
     std::ofstream ofs;
     ofs.open(outfile.c_str());
     if (!ofs.good())
     {
         std::cerr << "Error opening output insert histogram file '" << outfile << "'. Cannot continue" << std::endl;
-        exit(1);
+        return false;
     }
 
     for (std::map<uint32_t, uint32_t>::const_iterator iter = insertHist.begin(); iter != insertHist.end(); iter++)
@@ -333,19 +1779,280 @@ void writeInsertHistogramFile(std::string outfile, const std::map<uint32_t, uint
     }
 
     ofs.close();
+    return !ofs.fail();
 }
 
 
-void writeProperPairsFile(std::string outfile, uint32_t properPairs)
+// Returns true iff all went ok
+bool writeProperPairsFile(std::string outfile, uint32_t properPairs)
 {
     std::ofstream ofs;
     ofs.open(outfile.c_str());
     if (!ofs.good())
     {
         std::cerr << "Error opening output proper pairs count file '" << outfile << "'. Cannot continue" << std::endl;
-        exit(1);
+        return false;
     }
 
     ofs << properPairs << '\n';
     ofs.close();
+    return !ofs.fail();
+}
+
+
+// Writes counts of read pairs, and timings summed over all threads.
+// The time saved is estimated from the mean time taken to map the
+// sample of screened out pairs, less the time spent prescreening
+// and mapping the sample. Returns true iff all went ok
+bool writePrescreenFile(std::string outfile, uint64_t readPairs, uint64_t screenedOut, const std::vector<PrescreenTimes>& times)
+{
+    PrescreenTimes total;
+    for (std::vector<PrescreenTimes>::const_iterator iter = times.begin(); iter != times.end(); iter++)
+    {
+        total.prescreen += iter->prescreen;
+        total.sampledMapping += iter->sampledMapping;
+        total.pairsSampled += iter->pairsSampled;
+    }
+
+    double mappingSecondsSaved = total.pairsSampled > 0 ? (screenedOut - total.pairsSampled) * total.sampledMapping / total.pairsSampled : 0;
+
+    std::ofstream ofs;
+    ofs.open(outfile.c_str());
+    if (!ofs.good())
+    {
+        std::cerr << "Error opening output prescreen file '" << outfile << "'. Cannot continue" << std::endl;
+        return false;
+    }
+
+    ofs << "read_pairs\t" << readPairs << '\n'
+        << "read_pairs_screened_out\t" << screenedOut << '\n'
+        << "prescreen_seconds\t" << total.prescreen << '\n'
+        << "estimated_seconds_saved\t" << mappingSecondsSaved - total.prescreen - total.sampledMapping << '\n';
+    ofs.close();
+    return !ofs.fail();
+}
+
+
+// Minimum score of a read alignment. Like bowtie2 --local (G,20,8), but
+// halved because the match score here is 1 instead of 2
+int minReadScore(int readLength)
+{
+    return (int) (10 + 4 * log(readLength));
+}
+
+
+// Aligns the (encoded) read to ref[windowStart..windowEnd). Adds the alignment
+// to read.alignments if it scores high enough
+void alignReadToWindow(MappedRead& read, std::vector<uint8_t>& qry, int rid, bool reverse, std::vector<uint8_t>& ref, int windowStart, int windowEnd)
+{
+    Hit hit;
+    if (!align(ref.data() + windowStart, windowEnd - windowStart, qry.data(), qry.size(), hit, READ_BAND_PADDING) || hit.score < minReadScore(qry.size()))
+    {
+        return;
+    }
+
+    ReadAlignment alignment;
+    alignment.rid = rid;
+    alignment.reverse = reverse;
+    alignment.pos = windowStart + hit.refStart;
+    alignment.score = hit.score;
+
+    for (std::vector<ReadAlignment>::iterator iter = read.alignments.begin(); iter != read.alignments.end(); iter++)
+    {
+        if (iter->rid == rid && iter->reverse == reverse && iter->pos == alignment.pos)
+        {
+            return;
+        }
+    }
+
+    if (hit.qryStart > 0)
+    {
+        alignment.ops.push_back('S');
+        alignment.opLengths.push_back(hit.qryStart);
+    }
+    alignment.ops.insert(alignment.ops.end(), hit.ops.begin(), hit.ops.end());
+    alignment.opLengths.insert(alignment.opLengths.end(), hit.opLengths.begin(), hit.opLengths.end());
+    if (hit.qryEnd < (int) qry.size() - 1)
+    {
+        alignment.ops.push_back('S');
+        alignment.opLengths.push_back(qry.size() - 1 - hit.qryEnd);
+    }
+
+    read.alignments.push_back(alignment);
+}
+
+
+bool compareReadAlignments(const ReadAlignment& a, const ReadAlignment& b)
+{
+    if (a.score != b.score)
+    {
+        return a.score > b.score;
+    }
+    if (a.rid != b.rid)
+    {
+        return a.rid < b.rid;
+    }
+    if (a.pos != b.pos)
+    {
+        return a.pos < b.pos;
+    }
+    return a.reverse < b.reverse;
+}
+
+
+void alignRead(void *data, long i, int threadId)
+{
+    ReadMappingBatch *batch = (ReadMappingBatch *) data;
+    MappedRead& read = (*batch->reads)[i];
+    std::vector<std::vector<uint8_t> >& refs = *batch->refs;
+    std::vector<uint8_t> strands[2];
+    const int readLength = read.seq.size();
+    int n_reg;
+
+    if (readLength == 0)
+    {
+        return;
+    }
+
+    encodeSequence(read.seq.c_str(), readLength, strands[0]);
+    strands[1].resize(readLength);
+    for (int j = 0; j < readLength; j++)
+    {
+        uint8_t base = strands[0][readLength - 1 - j];
+        strands[1][j] = base < 4 ? 3 - base : base;
+    }
+
+    const mm_reg1_t *reg = mm_map(batch->mi, readLength, read.seq.c_str(), &n_reg, (*batch->tbufs)[threadId], batch->opt, 0);
+    std::vector<mm_reg1_t> hits(reg, reg + n_reg);
+    std::sort(hits.begin(), hits.end(), [](const mm_reg1_t& a, const mm_reg1_t& b) { return a.cnt > b.cnt; });
+    if (batch->maxCandidates > 0 && hits.size() > (size_t) batch->maxCandidates)
+    {
+        hits.resize(batch->maxCandidates);
+    }
+
+    // the window is big enough for the whole read, whichever end the hit is at
+    for (std::vector<mm_reg1_t>::iterator hit = hits.begin(); hit != hits.end(); hit++)
+    {
+        std::vector<uint8_t>& ref = refs[hit->rid];
+        int windowStart = std::max(0, hit->rs - readLength - READ_BAND_PADDING);
+        int windowEnd = std::min((int) ref.size(), hit->re + readLength + READ_BAND_PADDING);
+        alignReadToWindow(read, strands[hit->rev], hit->rid, hit->rev, ref, windowStart, windowEnd);
+    }
+
+    if (read.alignments.size() == 0)
+    {
+        for (size_t rid = 0; rid < refs.size(); rid++)
+        {
+            for (int reverse = 0; reverse < 2; reverse++)
+            {
+                alignReadToWindow(read, strands[reverse], rid, reverse, refs[rid], 0, refs[rid].size());
+            }
+        }
+    }
+
+    std::sort(read.alignments.begin(), read.alignments.end(), compareReadAlignments);
+}
+
+
+void setReadName(const kseq_t *ks, std::string& name)
+{
+    name.assign(ks->name.s, ks->name.l);
+    if (name.size() > 2 && name[name.size() - 2] == '/' && (name.back() == '1' || name.back() == '2'))
+    {
+        name.resize(name.size() - 2);
+    }
+}
+
+
+int mapReads(const char *refFile, const char *readsFile1, const char *readsFile2, int threads, int maxCandidates, std::vector<std::string>& refNames, std::vector<std::vector<uint8_t> >& refs, std::vector<MappedRead>& reads)
+{
+    gzFile fp = gzopen(refFile, "r");
+    if (!fp)
+    {
+        std::cerr << "[ariba_minimap] Error opening file " << refFile << std::endl;
+        return 1;
+    }
+    kseq_t *ks = kseq_init(fp);
+    while (kseq_read(ks) >= 0)
+    {
+        refNames.push_back(std::string(ks->name.s, ks->name.l));
+        refs.push_back(std::vector<uint8_t>());
+        encodeSequence(ks->seq.s, ks->seq.l, refs.back());
+    }
+    kseq_destroy(ks);
+    gzclose(fp);
+
+    gzFile fp1 = gzopen(readsFile1, "r");
+    gzFile fp2 = gzopen(readsFile2, "r");
+    if (!fp1 || !fp2)
+    {
+        std::cerr << "[ariba_minimap] Error opening reads files " << readsFile1 << " " << readsFile2 << std::endl;
+        if (fp1) gzclose(fp1);
+        if (fp2) gzclose(fp2);
+        return 1;
+    }
+    kseq_t *ks1 = kseq_init(fp1);
+    kseq_t *ks2 = kseq_init(fp2);
+    bool matesOk = true;
+    while (kseq_read(ks1) >= 0)
+    {
+        if (kseq_read(ks2) < 0)
+        {
+            matesOk = false;
+            break;
+        }
+
+        for (kseq_t *readKs : {ks1, ks2})
+        {
+            reads.push_back(MappedRead());
+            MappedRead& read = reads.back();
+            setReadName(readKs, read.name);
+            read.seq.assign(readKs->seq.s, readKs->seq.l);
+            read.qual.assign(readKs->qual.l ? readKs->qual.s : "", readKs->qual.l);
+        }
+    }
+    matesOk = matesOk && kseq_read(ks2) < 0;
+    kseq_destroy(ks1);
+    kseq_destroy(ks2);
+    gzclose(fp1);
+    gzclose(fp2);
+
+    if (!matesOk)
+    {
+        std::cerr << "[ariba_minimap] Different number of reads in files " << readsFile1 << " " << readsFile2 << std::endl;
+        return 1;
+    }
+
+    if (refs.size() == 0 || reads.size() == 0)
+    {
+        return 0;
+    }
+
+    // kt_for() uses at least one thread, which needs a thread buffer
+    threads = std::max(1, threads);
+    mm_verbose = 0;
+    mm_idx_t *mi = mm_idx_build(refFile, MINIMAP_W, MINIMAP_K, threads);
+    if (!mi)
+    {
+        std::cerr << "[ariba_minimap] Error indexing" << std::endl;
+        return 1;
+    }
+
+    mm_mapopt_t opt;
+    mm_mapopt_init(&opt);
+    std::vector<mm_tbuf_t *> tbufs;
+    for (int i = 0; i < threads; i++)
+    {
+        tbufs.push_back(mm_tbuf_init());
+    }
+
+    ReadMappingBatch batch = {mi, &opt, &tbufs, &refs, &reads, maxCandidates};
+    kt_for(threads, alignRead, &batch, reads.size());
+
+    for (std::vector<mm_tbuf_t *>::iterator iter = tbufs.begin(); iter != tbufs.end(); iter++)
+    {
+        mm_tbuf_destroy(*iter);
+    }
+    mm_idx_destroy(mi);
+    return 0;
 }
@@ -15,7 +15,6 @@ prog_to_default = {
     'cdhit': 'cd-hit-est',
     'cdhit2d': 'cd-hit-est-2d',
     #'gapfiller': 'GapFiller.pl',
-    'mash': 'mash',
     'nucmer' : 'nucmer',
     'samtools': 'samtools',
     #'spades': 'spades.py',
@@ -32,7 +31,6 @@ prog_to_version_cmd = {
     'cdhit': ('', re.compile('CD-HIT version ([0-9\.]+) \(')),
     'cdhit2d': ('', re.compile('CD-HIT version ([0-9\.]+) \(')),
     #'gapfiller': ('', re.compile('^Usage: .*pl \[GapFiller_(.*)\]')),
-    'mash': ('', re.compile('^Mash version (.*)$')),
     'nucmer': ('--version', re.compile('^NUCmer \(NUCleotide MUMmer\) version ([0-9\.]+)')),
     'samtools': ('', re.compile('^Version: ([0-9\.]+)')),
     #'spades': ('', re.compile('^SPAdes genome assembler v\.?([0-9\.]+)')),
@@ -45,7 +43,6 @@ min_versions = {
     'bowtie2': '2.1.0',
     'cdhit': '4.6',
     'cdhit2d': '4.6',
-    'mash': '1.0.2',
     'nucmer': '3.1',
     'samtools': '1.3',
     #'spades': '3.5.0',
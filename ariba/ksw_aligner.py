@@ -0,0 +1,265 @@
+import os
+import pyfastaq
+import pymummer
+import ksw_ariba
+
+class Error (Exception): pass
+
+aligners = ['nucmer', 'ksw']
+
+# Hits shorter than this are not reported. Same as nucmer's default
+# minimum cluster length (-c 65)
+min_hit_length = 65
+
+# Alignments are split into separate hits at gaps longer than this. Same as
+# nucmer's default maximum gap (-g 90)
+max_gap = 90
+
+
+class Hit:
+    def __init__(self, ref_name, ref_seq, qry_name, qry_seq, reverse, ref_start, qry_start, ops):
+        '''One alignment of the query (reverse complemented if reverse is
+           True) to the reference. Coords are zero-based, and the query coords
+           are of the sequence that was aligned. ops = list of (op, length)
+           from ksw_ariba.align()'''
+        self.ref_name = ref_name
+        self.ref_seq = ref_seq
+        self.qry_name = qry_name
+        self.qry_seq = qry_seq
+        self.reverse = reverse
+        self.ref_start = ref_start
+        self.qry_start = qry_start
+        self.ops = ops
+        self.ref_end = ref_start + sum([x[1] for x in ops if x[0] != 'I']) - 1
+        self.qry_end = qry_start + sum([x[1] for x in ops if x[0] != 'D']) - 1
+        self.variants = self._get_variants()
+        # Same as the %IDY of show-coords: each mismatch and each inserted or
+        # deleted base is one error, out of all columns of the alignment
+        columns = sum([x[1] for x in ops])
+        self.percent_identity = 100 * (columns - len(self.variants)) / columns
+
+
+    def _get_variants(self):
+        '''Returns list of (ref pos, ref base, qry base, qry pos), zero-based,
+           like show-snps: a deletion has the query position of the base
+           before it, and an insertion has the ref position of the base
+           before it'''
+        variants = []
+        ref_pos = self.ref_start
+        qry_pos = self.qry_start
+
+        for op, length in self.ops:
+            for i in range(length):
+                if op == 'M':
+                    if self.ref_seq[ref_pos] != self.qry_seq[qry_pos]:
+                        variants.append((ref_pos, self.ref_seq[ref_pos], self.qry_seq[qry_pos], qry_pos))
+                    ref_pos += 1
+                    qry_pos += 1
+                elif op == 'D':
+                    variants.append((ref_pos, self.ref_seq[ref_pos], '.', qry_pos - 1))
+                    ref_pos += 1
+                else:
+                    variants.append((ref_pos - 1, '.', self.qry_seq[qry_pos], qry_pos))
+                    qry_pos += 1
+
+        return variants
+
+
+    def qry_coord(self, pos):
+        '''Returns the position pos in the aligned query sequence, as a position
+           in the original (not reverse complemented) query sequence'''
+        return len(self.qry_seq) - pos - 1 if self.reverse else pos
+
+
+    def coords_line(self):
+        '''Returns line of the hit in the format of show-coords -dTlro, but
+           without the overlap annotation in the [TAGS] column from -o (eg
+           [CONTAINS]), which ariba does not use'''
+        return '\t'.join([str(x) for x in [
+            self.ref_start + 1,
+            self.ref_end + 1,
+            self.qry_coord(self.qry_start) + 1,
+            self.qry_coord(self.qry_end) + 1,
+            self.ref_end - self.ref_start + 1,
+            self.qry_end - self.qry_start + 1,
+            '{:.2f}'.format(self.percent_identity),
+            len(self.ref_seq),
+            len(self.qry_seq),
+            1,
+            -1 if self.reverse else 1,
+            self.ref_name,
+            self.qry_name,
+        ]])
+
+
+def _split_ops(ops):
+    '''Splits list of ops from ksw_ariba.align() at gaps longer than max_gap.
+       Returns list of tuples (ref offset, qry offset, ops)'''
+    pieces = []
+    ref_offset = qry_offset = 0
+    piece = (0, 0, [])
+
+    for op, length in ops:
+        if op != 'I':
+            ref_offset += length
+        if op != 'D':
+            qry_offset += length
+
+        if op != 'M' and length > max_gap:
+            pieces.append(piece)
+            piece = (ref_offset, qry_offset, [])
+        else:
+            piece[2].append((op, length))
+
+    pieces.append(piece)
+    return pieces
+
+
+def align_sequences(ref_name, ref_seq, qry_name, qry_seq, min_id=None, min_length=None):
+    '''Returns list of Hit objects, of the query aligned to the reference on
+       both strands. Once the best alignment is found, the parts of the query
+       either side of it are aligned again, to find more hits'''
+    hits = []
+    ref_seq = ref_seq.upper()
+    min_length = min_hit_length if min_length is None else max(min_length, min_hit_length)
+
+    for reverse in [False, True]:
+        qry = pyfastaq.sequences.Fasta('x', qry_seq.upper())
+        if reverse:
+            qry.revcomp()
+        to_align = [(0, len(qry))]
+
+        while len(to_align):
+            start, end = to_align.pop()
+            if end - start < min_length:
+                continue
+
+            got = ksw_ariba.align(ref_seq, qry.seq[start:end])
+            if got is None:
+                continue
+
+            ref_start, ref_end, qry_start, qry_end, ops = got
+            for ref_offset, qry_offset, piece_ops in _split_ops(ops):
+                hit = Hit(ref_name, ref_seq, qry_name, qry.seq, reverse, ref_start + ref_offset, start + qry_start + qry_offset, piece_ops)
+                if hit.ref_end - hit.ref_start + 1 >= min_length and hit.qry_end - hit.qry_start + 1 >= min_length \
+                  and (min_id is None or hit.percent_identity >= min_id):
+                    hits.append(hit)
+
+            to_align.append((start, start + qry_start))
+            to_align.append((start + qry_end + 1, end))
+
+    return hits
+
+
+def _count_other_hits(hit, hits, ref_pos, qry_pos):
+    '''Returns tuple (number of other hits that contain the ref position,
+       number that contain the query position), like the R and Q columns of
+       show-snps'''
+    qry_pos = hit.qry_coord(qry_pos)
+    ref_count = qry_count = 0
+    for other in hits:
+        if other is hit:
+            continue
+        if other.ref_name == hit.ref_name and other.ref_start <= ref_pos <= other.ref_end:
+            ref_count += 1
+        if other.qry_name == hit.qry_name and min(other.qry_coord(other.qry_start), other.qry_coord(other.qry_end)) <= qry_pos <= max(other.qry_coord(other.qry_start), other.qry_coord(other.qry_end)):
+            qry_count += 1
+    return ref_count, qry_count
+
+
+def snps_lines(hits):
+    '''Returns list of lines of variants in the hits, in the format of
+       show-snps -TClr. Like -C, variants in regions covered by more than one
+       hit are not reported, and so there are no [R] and [Q] columns'''
+    lines = []
+
+    for hit in hits:
+        variant_ref_positions = [x[0] for x in hit.variants]
+
+        for i, (ref_pos, ref_base, qry_base, qry_pos) in enumerate(hit.variants):
+            if _count_other_hits(hit, hits, ref_pos, qry_pos) != (0, 0):
+                continue
+
+            others = variant_ref_positions[:i] + variant_ref_positions[i+1:]
+            buff = min([abs(ref_pos - x) for x in others] + [ref_pos - hit.ref_start + 1, hit.ref_end - ref_pos + 1])
+            forward_qry_pos = hit.qry_coord(qry_pos)
+            dist = min(ref_pos + 1, len(hit.ref_seq) - ref_pos, forward_qry_pos + 1, len(hit.qry_seq) - forward_qry_pos)
+            lines.append(((hit.ref_name, ref_pos), '\t'.join([str(x) for x in [
+                ref_pos + 1,
+                ref_base,
+                qry_base,
+                forward_qry_pos + 1,
+                buff,
+                dist,
+                len(hit.ref_seq),
+                len(hit.qry_seq),
+                1,
+                -1 if hit.reverse else 1,
+                hit.ref_name,
+                hit.qry_name,
+            ]])))
+
+    lines.sort(key=lambda x: x[0])
+    return [x[1] for x in lines]
+
+
+class Runner:
+    def __init__(self,
+      ref,
+      query,
+      outfile,
+      min_id=None,
+      min_length=None,
+      breaklen=None,
+      maxmatch=False,
+      show_snps=False,
+    ):
+        '''In-process replacement for pymummer.nucmer.Runner, with the options
+           used by ariba. Aligns every query sequence to every reference
+           sequence with ksw_ariba, and writes outfile (and outfile.snps if
+           show_snps is True) in the same format as the nucmer Runner.
+           breaklen and maxmatch are accepted to match nucmer Runner, but
+           have no effect: they change how nucmer chains and extends its
+           exact match seeds, and ksw_ariba has no seeds because it aligns
+           the whole sequences'''
+        self.ref = os.path.abspath(ref)
+        self.query = os.path.abspath(query)
+        self.outfile = outfile
+        self.min_id = min_id
+        self.min_length = min_length
+        self.show_snps = show_snps
+
+
+    def run(self):
+        ref_seqs = {}
+        pyfastaq.tasks.file_to_dict(self.ref, ref_seqs)
+        hits = []
+
+        for qry in pyfastaq.sequences.file_reader(self.query):
+            for ref_name in sorted(ref_seqs):
+                hits.extend(align_sequences(ref_name, ref_seqs[ref_name].seq, qry.id, qry.seq, min_id=self.min_id, min_length=self.min_length))
+
+        hits.sort(key=lambda x: (x.ref_name, x.ref_start, x.ref_end))
+        header = [self.ref + ' ' + self.query, 'NUCMER', '']
+
+        with open(self.outfile, 'w') as f:
+            print(*header, sep='\n', file=f)
+            print('[S1]', '[E1]', '[S2]', '[E2]', '[LEN 1]', '[LEN 2]', '[% IDY]', '[LEN R]', '[LEN Q]', '[FRM]', '[TAGS]', sep='\t', file=f)
+            for hit in hits:
+                print(hit.coords_line(), file=f)
+
+        if self.show_snps:
+            with open(self.outfile + '.snps', 'w') as f:
+                print(*header, sep='\n', file=f)
+                print('[P1]', '[SUB]', '[SUB]', '[P2]', '[BUFF]', '[DIST]', '[LEN R]', '[LEN Q]', '[FRM]', '[TAGS]', sep='\t', file=f)
+                for line in snps_lines(hits):
+                    print(line, file=f)
+
+
+def runner(aligner):
+    '''Returns the class to use instead of pymummer.nucmer.Runner, for the
+       aligner (one of aligners)'''
+    if aligner not in aligners:
+        raise Error('Unknown contig aligner "' + str(aligner) + '". Must be one of: ' + ', '.join(aligners))
+
+    return Runner if aligner == 'ksw' else pymummer.nucmer.Runner
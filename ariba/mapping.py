@@ -1,13 +1,19 @@
 import os
 import sys
+import math
 import pysam
 import pyfastaq
+import minimap_ariba
 from ariba import common
 
 class Error (Exception): pass
 
 bowtie2_index_extensions = [x + '.bt2' for x in ['1', '2', '3', '4', 'rev.1', 'rev.2']]
 
+# programs that can map reads to an assembly: bowtie2 (run_bowtie2), or
+# minimap_ariba within this process (run_minimap)
+mappers = ['bowtie2', 'minimap']
+
 def bowtie2_index(ref_fa, outprefix, bowtie2='bowtie2', verbose=False, verbose_filehandle=sys.stdout):
     expected_files = [outprefix + '.' + x + '.bt2' for x in ['1', '2', '3', '4', 'rev.1', 'rev.2']]
     file_missing = False
@@ -118,6 +124,172 @@ def run_bowtie2(
         os.unlink(fname)
 
 
+def _alignment_end(alignment):
+    '''Returns zero-based end position in the reference of an alignment
+       from minimap_ariba.map_reads()'''
+    return alignment[2] + sum([x[1] for x in alignment[4] if x[0] in 'MD']) - 1
+
+
+def _alignments_to_insert(alignment1, alignment2):
+    '''Returns insert size of a pair of alignments from minimap_ariba.map_reads(),
+       as long as their orientation is "innies". Otherwise returns None.
+       Same as sam_pair_to_insert()'''
+    if alignment1[0] != alignment2[0] or alignment1[1] == alignment2[1]:
+        return None
+
+    forward, reverse = (alignment2, alignment1) if alignment1[1] else (alignment1, alignment2)
+    start = forward[2]
+    end = _alignment_end(reverse)
+    return end - start + 1 if start < end else None
+
+
+def _choose_pair_alignments(alignments1, alignments2, max_insert):
+    '''Returns tuple (alignment of read 1, alignment of read 2, is proper pair),
+       where an alignment is None if the read is unmapped. Like bowtie2, a pair
+       of alignments with insert size at most max_insert is used if there is one'''
+    best = None
+    for alignment1 in alignments1:
+        for alignment2 in alignments2:
+            insert = _alignments_to_insert(alignment1, alignment2)
+            if insert is not None and insert <= max_insert and (best is None or alignment1[3] + alignment2[3] > best[0][3] + best[1][3]):
+                best = (alignment1, alignment2)
+
+    if best is not None:
+        return best[0], best[1], True
+
+    return (alignments1[0] if len(alignments1) else None), (alignments2[0] if len(alignments2) else None), False
+
+
+def _min_read_score(read_length):
+    '''Returns the minimum score of an alignment of a read from
+       minimap_ariba.map_reads(). Same as minReadScore() in minimap_ariba'''
+    return int(10 + 4 * math.log(read_length))
+
+
+def _mapping_quality(alignment, alignments, read_length):
+    '''Returns mapping quality of alignment, which is one of alignments (all the
+       alignments of the read). Like bowtie2, it is made from how far the score is
+       above the minimum score and, if there are other alignments, above the next
+       best score. Both are scaled by the range from the minimum score to a
+       perfect score (the read length, because a match scores 1)'''
+    min_score = _min_read_score(read_length)
+    margin = alignment[3] - min_score
+    other_scores = [x[3] for x in alignments if x is not alignment]
+    if len(other_scores):
+        margin = min(margin, alignment[3] - max(other_scores))
+    return max(0, min(60, int(60 * margin / max(1, read_length - min_score))))
+
+
+def _read_to_sam(read, alignment, mate_alignment, is_read1, proper_pair):
+    '''Returns pysam.AlignedSegment of a read from minimap_ariba.map_reads().
+       alignment and mate_alignment are from _choose_pair_alignments()'''
+    name, seq, qual, alignments = read
+    sam = pysam.AlignedSegment()
+    sam.query_name = name
+    sam.flag = 1 + (64 if is_read1 else 128) + (2 if proper_pair else 0)
+
+    if alignment is None:
+        sam.flag += 4
+    elif alignment[1]:
+        sam.flag += 16
+        seq = pyfastaq.sequences.Fasta('x', seq)
+        seq.revcomp()
+        seq = seq.seq
+        qual = qual[::-1]
+
+    if mate_alignment is None:
+        sam.flag += 8
+    elif mate_alignment[1]:
+        sam.flag += 32
+
+    sam.query_sequence = seq
+    if len(qual):
+        sam.query_qualities = pysam.qualitystring_to_array(qual)
+
+    # unmapped reads are put in the same place as their mate, like samtools fixmate
+    placed = alignment if alignment is not None else mate_alignment
+    if placed is not None:
+        sam.reference_id = placed[0]
+        sam.reference_start = placed[2]
+    placed = mate_alignment if mate_alignment is not None else alignment
+    if placed is not None:
+        sam.next_reference_id = placed[0]
+        sam.next_reference_start = placed[2]
+
+    if alignment is not None:
+        sam.mapping_quality = _mapping_quality(alignment, alignments, len(seq))
+        sam.cigartuples = [('MIDNS'.index(op), length) for op, length in alignment[4]]
+        sam.set_tag('AS', alignment[3])
+        if mate_alignment is not None and alignment[0] == mate_alignment[0]:
+            start = min(alignment[2], mate_alignment[2])
+            end = max(_alignment_end(alignment), _alignment_end(mate_alignment))
+            is_leftmost = alignment[2] < mate_alignment[2] or (alignment[2] == mate_alignment[2] and is_read1)
+            sam.template_length = (end - start + 1) * (1 if is_leftmost else -1)
+
+    return sam
+
+
+def run_minimap(
+      reads_fwd,
+      reads_rev,
+      ref_fa,
+      out_prefix,
+      threads=1,
+      max_insert=1000,
+      verbose=False,
+      verbose_filehandle=sys.stdout,
+    ):
+    '''Maps reads to ref_fa within this process using minimap_ariba, instead of
+       bowtie2 and samtools. Writes sorted and indexed BAM file out_prefix.bam,
+       like run_bowtie2(..., sort=True)'''
+    if verbose:
+        print('Mapping reads', reads_fwd, reads_rev, 'to', ref_fa, 'with minimap_ariba', file=verbose_filehandle)
+
+    try:
+        refs, reads = minimap_ariba.map_reads(ref_fa, reads_fwd, reads_rev, threads)
+    except ValueError as error:
+        raise Error(str(error))
+
+    sams = []
+    for i in range(0, len(reads), 2):
+        alignment1, alignment2, proper_pair = _choose_pair_alignments(reads[i][3], reads[i + 1][3], max_insert)
+        sams.append(_read_to_sam(reads[i], alignment1, alignment2, True, proper_pair))
+        sams.append(_read_to_sam(reads[i + 1], alignment2, alignment1, False, proper_pair))
+
+    # sort is stable, so reads at the same position stay in input order
+    sams.sort(key=lambda x: (x.reference_id if x.reference_id >= 0 else len(refs), x.reference_start))
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': name, 'LN': length} for name, length in refs]}
+    final_bam = out_prefix + '.bam'
+    with pysam.AlignmentFile(final_bam, 'wb', header=header) as f:
+        for sam in sams:
+            f.write(sam)
+
+    pysam.index(final_bam)
+
+
+def get_total_alignment_scores(reads_fwd, reads_rev, ref_fa, threads=1, max_insert=1000):
+    '''Returns dict of sequence name -> total alignment score of the reads,
+       for every sequence in ref_fa, in the same order as the file. The reads
+       are mapped once, to all the sequences. The score of each sequence is
+       the score that the reads would get if it was the only sequence, like
+       get_total_alignment_score() of a BAM made by mapping to just that sequence'''
+    try:
+        refs, reads = minimap_ariba.map_reads(ref_fa, reads_fwd, reads_rev, threads, 0)
+    except ValueError as error:
+        raise Error(str(error))
+
+    scores = [0] * len(refs)
+
+    for i in range(0, len(reads), 2):
+        alignments1 = reads[i][3]
+        alignments2 = reads[i + 1][3]
+        for ref_index in {x[0] for x in alignments1 + alignments2}:
+            alignment1, alignment2, proper_pair = _choose_pair_alignments([x for x in alignments1 if x[0] == ref_index], [x for x in alignments2 if x[0] == ref_index], max_insert)
+            scores[ref_index] += sum([x[3] for x in [alignment1, alignment2] if x is not None])
+
+    return {refs[i][0]: scores[i] for i in range(len(refs))}
+
+
 def get_total_alignment_score(bam):
     '''Returns total of AS: tags in the input BAM'''
     sam_reader = pysam.Samfile(bam, "rb")
@@ -1,67 +1,166 @@
 import sys
 import os
-from ariba import common, external_progs
+import re
+import math
+import array
+import pickle
+import hashlib
+import pyfastaq
+
+class Error (Exception): pass
+
+# Same as mash sketch, with the "-s 100000" that ariba used.
+# Differences from mash: kmers are hashed with blake2b (from hashlib)
+# instead of MurmurHash3, so the sketches are different samples of the
+# kmers and distances are not exactly the same as from mash dist, but are
+# estimates of the same thing. The distances file has no p-value column
+kmer_length = 21
+sketch_size = 100000
+
+complement = str.maketrans('ACGT', 'TGCA')
+non_acgt_regex = re.compile('[^ACGT]+')
+
+
+def _hash(kmer):
+    return int.from_bytes(hashlib.blake2b(kmer.encode(), digest_size=8).digest(), 'little')
+
+
+def canonical_kmers(seq, kmers=None):
+    '''Returns set of the canonical kmers of seq (ie the smaller of each kmer
+       and its reverse complement), ignoring case. Kmers that contain anything
+       other than ACGT are skipped, as in mash. If kmers is given, the kmers
+       are added to it and it is returned'''
+    if kmers is None:
+        kmers = set()
+
+    for chunk in non_acgt_regex.split(seq.upper()):
+        chunk_revcomp = chunk.translate(complement)[::-1]
+        end = len(chunk)
+        for i in range(end - kmer_length + 1):
+            forward = chunk[i:i + kmer_length]
+            reverse = chunk_revcomp[end - i - kmer_length:end - i]
+            kmers.add(forward if forward <= reverse else reverse)
+
+    return kmers
+
+
+def sketch_kmers(kmers):
+    '''Returns the sketch of a set of kmers: an array of the smallest
+       sketch_size kmer hashes, sorted'''
+    return array.array('Q', sorted([_hash(x) for x in kmers])[:sketch_size])
+
+
+def sketch_fasta(infile, individual):
+    '''If individual is True, returns dict of sequence name -> sketch of
+       each sequence in infile (like "mash sketch -i"). Otherwise, returns
+       one sketch of all the sequences together'''
+    if individual:
+        return {seq.id.split()[0]: sketch_kmers(canonical_kmers(seq.seq)) for seq in pyfastaq.sequences.file_reader(infile)}
+
+    kmers = set()
+    for seq in pyfastaq.sequences.file_reader(infile):
+        canonical_kmers(seq.seq, kmers=kmers)
+    return sketch_kmers(kmers)
+
+
+def distance(ref_sketch, qry_sketch):
+    '''Returns tuple (mash distance, number of shared hashes, total hashes),
+       calculated in the same way as mash dist'''
+    i = j = common = denom = 0
+    while denom < sketch_size and i < len(ref_sketch) and j < len(qry_sketch):
+        if ref_sketch[i] < qry_sketch[j]:
+            i += 1
+        elif qry_sketch[j] < ref_sketch[i]:
+            j += 1
+        else:
+            i += 1
+            j += 1
+            common += 1
+        denom += 1
+
+    if denom < sketch_size:
+        denom = min(sketch_size, denom + len(ref_sketch) - i + len(qry_sketch) - j)
+
+    if common == denom:
+        dist = 0
+    elif common == 0:
+        dist = 1
+    else:
+        jaccard = common / denom
+        dist = min(1, -math.log(2 * jaccard / (1 + jaccard)) / kmer_length)
+
+    return dist, common, denom
+
+
+def save_sketches(sketches, outfile):
+    '''Writes dict of name -> sketch returned by sketch_fasta() to a file'''
+    with open(outfile, 'wb') as f:
+        pickle.dump({'kmer_length': kmer_length, 'sketch_size': sketch_size, 'sketches': sketches}, f)
+
+
+def load_sketches(infile):
+    '''Returns dict of name -> sketch written by save_sketches(). Returns None
+       if the file does not exist or was made with different sketch options'''
+    if not os.path.exists(infile):
+        return None
+
+    with open(infile, 'rb') as f:
+        data = pickle.load(f)
+
+    if data['kmer_length'] != kmer_length or data['sketch_size'] != sketch_size:
+        return None
+
+    return data['sketches']
+
 
 class Masher:
     def __init__(self,
         reference_fa,
         query_fa,
         log_fh=sys.stdout,
-        extern_progs=None,
+        ref_sketches=None,
     ):
+        '''Finds the sequence in reference_fa closest to the sequences in
+           query_fa, like "mash dist" of the individual reference sketches
+           against the query sketch. ref_sketches = dict of name -> sketch,
+           from sketch_fasta(). Sketches of the reference sequences found
+           in ref_sketches are not made again'''
         self.reference_fa = reference_fa
         self.query_fa = query_fa
         self.log_fh = log_fh
-
-        if extern_progs is None:
-            self.extern_progs = external_progs.ExternalProgs()
-        else:
-            self.extern_progs = extern_progs
-
-
-    def _sketch(self, infile, individual):
-        cmd_list = [
-            self.extern_progs.exe('mash'),
-            'sketch',
-            '-s 100000'
-        ]
-
-        if individual:
-            cmd_list.append('-i')
-
-        cmd_list.append(infile)
-        common.syscall(' '.join(cmd_list), verbose=True, verbose_filehandle=self.log_fh)
+        self.ref_sketches = {} if ref_sketches is None else ref_sketches
 
 
-    def _dist(self, outfile):
-        cmd = ' '.join([
-            self.extern_progs.exe('mash'),
-            'dist',
-            self.reference_fa + '.msh',
-            self.query_fa + '.msh',
-            '| sort -k3n >', outfile
-        ])
-        common.syscall(cmd, verbose=True, verbose_filehandle=self.log_fh)
+    def _reference_sketches(self):
+        sketches = {}
+        for seq in pyfastaq.sequences.file_reader(self.reference_fa):
+            name = seq.id.split()[0]
+            if name in self.ref_sketches:
+                sketches[name] = self.ref_sketches[name]
+            else:
+                sketches[name] = sketch_kmers(canonical_kmers(seq.seq))
+        return sketches
 
 
     def run(self, outfile):
-        self._sketch(self.reference_fa, True)
-        self._sketch(self.query_fa, False)
-        self._dist(outfile)
-        if os.path.getsize(outfile) == 0:
+        '''Writes distances to outfile, closest first, and returns the name
+           of the closest reference sequence, or None if it has no kmers in
+           common with the query. Columns of outfile are the same as mash
+           dist, except there is no p-value: reference, query, distance,
+           shared hashes'''
+        qry_sketch = sketch_fasta(self.query_fa, False)
+        distances = [(name,) + distance(sketch, qry_sketch) for name, sketch in self._reference_sketches().items()]
+        if len(distances) == 0:
             return None
 
-        try:
-            with open(outfile) as f:
-                line = f.readline().rstrip()
-                print('best mash match:\t', line, file=self.log_fh)
-                matching_hashes = int(line.split()[-1].split('/')[0])
-                if matching_hashes == 0:
-                    best_seq = None
-                else:
-                    best_seq = line.split()[0]
-        except:
-            best_seq = None
+        # Same order as "mash dist | sort -k3n": mash prints distances to 6
+        # significant figures, and sort breaks ties using the whole line
+        distances.sort(key=lambda x: (float('{:g}'.format(x[1])), x[0] + '\t'))
+        lines = ['\t'.join([name, self.query_fa, '{:g}'.format(dist), str(common) + '/' + str(denom)]) for name, dist, common, denom in distances]
 
-        return best_seq
+        with open(outfile, 'w') as f:
+            print(*lines, sep='\n', file=f)
 
+        print('best mash match:\t', lines[0], file=self.log_fh)
+        name, dist, common, denom = distances[0]
+        return None if common == 0 else name
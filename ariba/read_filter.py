@@ -1,11 +1,117 @@
 import os
+import math
+import collections
 import tempfile
 import shutil
+import pyfastaq
 
 from ariba import common, external_progs
 
 class Error (Exception): pass
 
+filter_engines = ['kmer', 'cdhit']
+complement = str.maketrans('ACGT', 'TGCA')
+
+
+class KmerReadMatcher:
+    '''In-process version of the rule used by cd-hit-est-2d -G 0 -aS 0.95 to
+       filter reads: a read is kept if it aligns to one of the references, on
+       either strand, with at least min_identity identity (identical bases
+       divided by alignment length), and the alignment covers at least
+       min_read_coverage of the read. Candidate alignments are found from
+       diagonals of k-mers shared with the references'''
+    def __init__(self, references_fa, kmer=10, min_identity=0.9, min_read_coverage=0.95, max_candidates=3, band=10):
+        self.kmer = kmer
+        self.min_identity = min_identity
+        self.min_read_coverage = min_read_coverage
+        self.max_candidates = max_candidates
+        self.band = band
+        self.refs = [x.seq.upper() for x in pyfastaq.sequences.file_reader(references_fa)]
+        self.kmer_index = {}
+
+        for ref_id, ref in enumerate(self.refs):
+            for position in range(len(ref) - self.kmer + 1):
+                self.kmer_index.setdefault(ref[position:position + self.kmer], []).append((ref_id, position))
+
+
+    def _ungapped_match(self, read, ref, diagonal):
+        start = max(0, -diagonal)
+        end = min(len(read), len(ref) - diagonal)
+        min_length = math.ceil(self.min_read_coverage * len(read))
+        if end - start < min_length:
+            return False
+
+        mismatches = [i for i in range(start, end) if read[i] != ref[i + diagonal]]
+
+        # A local alignment can leave out mismatches at the ends of the
+        # read, as long as enough of the read is still covered
+        for left in range(len(mismatches) + 1):
+            segment_start = start if left == 0 else mismatches[left - 1] + 1
+            for right in range(len(mismatches) - left + 1):
+                segment_end = end if right == 0 else mismatches[-right]
+                length = segment_end - segment_start
+                if length < min_length:
+                    break
+                if length - (len(mismatches) - left - right) >= self.min_identity * length:
+                    return True
+
+        return False
+
+
+    def _gapped_match(self, read, ref, diagonal):
+        '''Banded alignment of the whole read to the reference around the
+           given diagonal. Each cell is (edits, alignment length), so the
+           alignment with fewest edits is chosen, then the shortest'''
+        infinity = (len(read) + len(ref) + 1, 0)
+        ref_start = max(0, diagonal - self.band)
+        ref_end = min(len(ref), diagonal + len(read) + self.band)
+        offset = diagonal - ref_start
+        previous = [(0, 0)] * (ref_end - ref_start + 1)
+
+        for i in range(1, len(read) + 1):
+            current = [infinity] * len(previous)
+            lo = max(1, i + offset - self.band)
+            hi = min(len(previous) - 1, i + offset + self.band)
+            if lo == 1:
+                current[0] = (i, i)
+            for j in range(lo, hi + 1):
+                cost = 0 if read[i - 1] == ref[ref_start + j - 1] else 1
+                d = previous[j - 1]
+                best = (d[0] + cost, d[1] + 1)
+                for edits, length in (previous[j], current[j - 1]):
+                    if (edits + 1, length + 1) < best:
+                        best = (edits + 1, length + 1)
+                current[j] = best
+            previous = current
+
+        edits, length = min(previous)
+        return length > 0 and length - edits >= self.min_identity * length
+
+
+    def matches(self, seq):
+        seq = seq.upper()
+        if len(seq) < self.kmer:
+            return False
+
+        for read in (seq, seq.translate(complement)[::-1]):
+            votes = collections.Counter()
+            for i in range(len(read) - self.kmer + 1):
+                for ref_id, position in self.kmer_index.get(read[i:i + self.kmer], []):
+                    votes[(ref_id, position - i)] += 1
+
+            candidates = votes.most_common(self.max_candidates)
+            for (ref_id, diagonal), count in candidates:
+                if self._ungapped_match(read, self.refs[ref_id], diagonal):
+                    return True
+
+            # Banded alignment is slow, so skip it for chance single k-mer hits
+            for (ref_id, diagonal), count in candidates:
+                if count > 1 and self._gapped_match(read, self.refs[ref_id], diagonal):
+                    return True
+
+        return False
+
+
 class ReadFilter:
     def __init__(self,
         readstore_obj,
@@ -13,11 +119,15 @@ class ReadFilter:
         cluster_name,
         log_fh,
         extern_progs=None,
+        engine='cdhit',
     ):
         self.readstore = readstore_obj
         self.references_fa = references_fa
         self.cluster_name = cluster_name
         self.log_fh = log_fh
+        if engine not in filter_engines:
+            raise Error('Unknown read filter engine "' + str(engine) + '". Must be one of: ' + ', '.join(filter_engines))
+        self.engine = engine
 
         if extern_progs is None:
             self.extern_progs = external_progs.ExternalProgs()
@@ -56,10 +166,23 @@ class ReadFilter:
         return reads
 
 
-    def run(self, reads_out1, reads_out2):
+    def _kmer_wanted_read_ids(self, batch):
+        if self.log_fh is not None:
+            print('Filtering reads for', self.cluster_name, 'by k-mer matching to', self.references_fa, file=self.log_fh, flush=True)
+        matcher = KmerReadMatcher(self.references_fa)
+        wanted_read_ids = set()
+
+        for number, seq in zip(batch.numbers, batch.seqs):
+            if matcher.matches(seq):
+                wanted_read_ids.add(number if number % 2 else number - 1)
+
+        return wanted_read_ids
+
+
+    def _cdhit_wanted_read_ids(self, batch):
         tmpdir = tempfile.mkdtemp(prefix='tmp.filter_reads.', dir=os.getcwd())
         all_reads_fasta = os.path.join(tmpdir, 'all_reads_for_cdhit.fa')
-        self.readstore.get_reads(self.cluster_name, all_reads_fasta, fasta=True, log_fh=self.log_fh)
+        batch.write(all_reads_fasta, fasta=True)
         cdhit_out = os.path.join(tmpdir, 'cdhit')
         ReadFilter._run_cdhit_est_2d(
             self.references_fa,
@@ -71,13 +194,21 @@ class ReadFilter:
         )
 
         wanted_read_ids = ReadFilter._cdhit_clstr_to_reads(cdhit_out + '.clstr')
-        total_reads, total_bases = self.readstore.get_reads(
-            self.cluster_name,
-            reads_out1,
-            out2=reads_out2,
-            log_fh=self.log_fh,
-            wanted_ids=wanted_read_ids
-        )
-
         shutil.rmtree(tmpdir)
-        return total_reads, total_bases
+        return wanted_read_ids
+
+
+    def run(self, reads_out1, reads_out2, batch=None):
+        '''Writes the reads that match the references to reads_out1 and
+           reads_out2. batch = the ReadBatch of reads in the cluster, which is
+           fetched from the read store if not given.
+           Returns tuple (number of reads, number of bases) written'''
+        if batch is None:
+            batch = self.readstore.get_batch(self.cluster_name, log_fh=self.log_fh)
+
+        if self.engine == 'kmer':
+            wanted_read_ids = self._kmer_wanted_read_ids(batch)
+        else:
+            wanted_read_ids = self._cdhit_wanted_read_ids(batch)
+
+        return batch.write(reads_out1, out2=reads_out2, wanted_ids=wanted_read_ids)
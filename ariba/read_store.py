@@ -1,23 +1,47 @@
 import pyfastaq
 import os
+import struct
+import zlib
 import pysam
 from ariba import common
 
 class Error (Exception): pass
 
+store_formats = ['native', 'tabix']
+native_magic = b'ARIBARS1'
+
+
 class ReadStore:
-    def __init__(self, infile, outprefix, log_fh=None):
+    def __init__(self, infile, outprefix, log_fh=None, store_format='tabix'):
+        '''infile is the reads file made by minimap_ariba. store_format
+           must be "tabix" (infile is the text .reads file, which gets sorted,
+           bgzipped and indexed) or "native" (infile is the .readStore file,
+           which is ready to use and is renamed).
+           If infile is None, the store already made with the same outprefix
+           and store_format is used'''
         assert infile != outprefix
-        self.infile = os.path.abspath(infile)
+        if store_format not in store_formats:
+            raise Error('Unknown read store format "' + str(store_format) + '". Must be one of: ' + ', '.join(store_formats))
+
+        self.infile = None if infile is None else os.path.abspath(infile)
         self.outprefix = os.path.abspath(outprefix)
-        self.outfile = os.path.abspath(outprefix) + '.gz'
+        self.store_format = store_format
+        self.outfile = self.outprefix + ('.gz' if self.store_format == 'tabix' else '.bin')
 
-        if not os.path.exists(self.infile):
+        if self.infile is None:
+            if not os.path.exists(self.outfile):
+                raise Error('Read store file not found ' + self.outfile + '. Cannot continue')
+        elif not os.path.exists(self.infile):
             raise Error('File not found ' + self.infile + '. Cannot continue')
+        elif self.store_format == 'tabix':
+            self._sort_file(self.infile, self.outprefix, log_fh)
+            self._compress_and_index_file(self.outprefix, log_fh)
+            os.unlink(self.outprefix)
+        else:
+            os.rename(self.infile, self.outfile)
 
-        self._sort_file(self.infile, self.outprefix, log_fh)
-        self._compress_and_index_file(self.outprefix, log_fh)
-        os.unlink(self.outprefix)
+        if self.store_format == 'native':
+            self.native_index = self._load_native_index(self.outfile)
 
 
     @staticmethod
@@ -35,49 +59,140 @@ class ReadStore:
         pysam.tabix_index(infile + '.gz', seq_col=0, start_col=1, end_col=1)
 
 
-    def get_reads(self, cluster_name, out1, out2=None, fasta=False, log_fh=None, wanted_ids=None):
-        total_reads = 0
-        total_bases = 0
+    @staticmethod
+    def _load_native_index(infile):
+        '''Returns dictionary of cluster name -> (offset, length, reads, bases),
+           from the offset table of a native read store file'''
+        footer_length = 16 + len(native_magic)
 
-        if log_fh is not None:
-            print('Getting reads for', cluster_name, 'from', self.outfile, file=log_fh)
-        tabix_file = pysam.TabixFile(self.outfile)
-        f_out1 = pyfastaq.utils.open_file_write(out1)
-        if out2 is None:
-            f_out2 = f_out1
-        else:
-            f_out2 = pyfastaq.utils.open_file_write(out2)
+        with open(infile, 'rb') as f:
+            if f.read(len(native_magic)) != native_magic:
+                raise Error('Error reading read store file ' + infile + '. Not in the expected format')
+
+            f.seek(-footer_length, os.SEEK_END)
+            table_offset, table_length, magic = struct.unpack('<QQ8s', f.read(footer_length))
+            if magic != native_magic:
+                raise Error('Error reading read store file ' + infile + '. Looks truncated')
+
+            f.seek(table_offset)
+            table = f.read(table_length).decode()
 
+        index = {}
+
+        for line in table.splitlines():
+            cluster, offset, length, reads, bases = line.split('\t')
+            index[cluster] = (int(offset), int(length), int(reads), int(bases))
+
+        return index
+
+
+    def _native_records(self, cluster_name):
+        if cluster_name not in self.native_index:
+            return
+
+        offset, length = self.native_index[cluster_name][:2]
+        with open(self.outfile, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+
+        position = 0
+        while position < length:
+            uncompressed_length, compressed_length = struct.unpack_from('<II', data, position)
+            position += 8
+            block = zlib.decompress(data[position:position + compressed_length])
+            position += compressed_length
+
+            for line in block.decode().splitlines():
+                number, seq, qual = line.split('\t')
+                yield int(number), seq, qual
+
+
+    def _tabix_records(self, cluster_name):
+        tabix_file = pysam.TabixFile(self.outfile)
         for line in tabix_file.fetch(reference=cluster_name):
             cluster, number, seq, qual = line.rstrip().split()
-            number = int(number)
-            if wanted_ids is not None:
-                new_number = number if number % 2 else number - 1
-                if new_number not in wanted_ids:
-                    continue
-
-            if number % 2 == 0:
-                if fasta:
-                    print('>' + str(number - 1) + '/2', seq, sep='\n', file=f_out2)
-                else:
-                    print('@' + str(number - 1) + '/2', seq, '+', qual, sep='\n', file=f_out2)
-            else:
-                if fasta:
-                    print('>' + str(number) + '/1', seq, sep='\n', file=f_out1)
-                else:
-                    print('@' + str(number) + '/1', seq, '+', qual, sep='\n', file=f_out1)
+            yield int(number), seq, qual
 
-            total_reads += 1
-            total_bases += len(qual)
 
-        pyfastaq.utils.close(f_out1)
-        if out2 is not None:
-            pyfastaq.utils.close(f_out2)
+    def records(self, cluster_name):
+        '''Yields tuples (read number, sequence, quality string) of all reads in the cluster'''
+        if self.store_format == 'tabix':
+            return self._tabix_records(cluster_name)
+        else:
+            return self._native_records(cluster_name)
+
+
+    def get_batch(self, cluster_name, log_fh=None):
+        '''Returns a ReadBatch of all reads in the cluster'''
+        if log_fh is not None:
+            print('Getting reads for', cluster_name, 'from', self.outfile, file=log_fh)
+        batch = ReadBatch(self.records(cluster_name))
         if log_fh is not None:
             print('Finished getting reads for', cluster_name, 'from', self.outfile, file=log_fh)
+        return batch
+
+
+    def get_reads(self, cluster_name, out1, out2=None, fasta=False, log_fh=None, wanted_ids=None):
+        batch = self.get_batch(cluster_name, log_fh=log_fh)
+        return batch.write(out1, out2=out2, fasta=fasta, wanted_ids=wanted_ids)
 
-        return total_reads, total_bases
 
     def clean(self):
         os.unlink(self.outfile)
-        os.unlink(self.outfile + '.tbi')
+        if self.store_format == 'tabix':
+            os.unlink(self.outfile + '.tbi')
+
+
+class ReadBatch:
+    def __init__(self, records):
+        '''records = iterable of (read number, sequence, quality string),
+           as made by ReadStore.records(). Odd numbers are first reads of
+           pairs, and even numbers are their mates'''
+        self.numbers = []
+        self.seqs = []
+        self.quals = []
+
+        for number, seq, qual in records:
+            self.numbers.append(number)
+            self.seqs.append(seq)
+            self.quals.append(qual)
+
+
+    def __len__(self):
+        return len(self.numbers)
+
+
+    def write(self, out1, out2=None, fasta=False, wanted_ids=None):
+        '''Writes reads to out1 (first of each pair) and out2 (mates), or all to
+           out1 if out2 is None. If wanted_ids is given, only writes
+           pairs whose first read number is in wanted_ids.
+           Returns tuple (number of reads, number of bases) written'''
+        lines1 = []
+        lines2 = lines1 if out2 is None else []
+        total_reads = 0
+        total_bases = 0
+
+        for number, seq, qual in zip(self.numbers, self.seqs, self.quals):
+            pair_number = number if number % 2 else number - 1
+            if wanted_ids is not None and pair_number not in wanted_ids:
+                continue
+
+            lines = lines1 if number % 2 else lines2
+            name = str(pair_number) + ('/1' if number % 2 else '/2')
+            if fasta:
+                lines.extend(('>' + name, seq))
+            else:
+                lines.extend(('@' + name, seq, '+', qual))
+
+            total_reads += 1
+            total_bases += len(qual)
+
+        for filename, lines in ((out1, lines1), (out2, lines2)):
+            if filename is None:
+                continue
+            f = pyfastaq.utils.open_file_write(filename)
+            if len(lines):
+                f.write('\n'.join(lines) + '\n')
+            pyfastaq.utils.close(f)
+
+        return total_reads, total_bases
@@ -2,7 +2,8 @@ import sys
 import os
 import pickle
 import pyfastaq
-from ariba import reference_data
+import minimap_ariba
+from ariba import mash, reference_data
 
 class Error (Exception): pass
 
@@ -191,3 +192,22 @@ class RefPreparer:
         with open(clusters_pickle_file, 'wb') as f:
             pickle.dump(clusters, f)
 
+        if self.verbose:
+            print('\nMaking minimap index of reference sequences', flush=True)
+
+        got = minimap_ariba.build_index(cdhit_outprefix + '.all.fa', cdhit_outprefix + '.all.mmi', self.threads)
+        if got != 0:
+            raise Error('Error making minimap index of reference sequences. Cannot continue')
+
+        if self.verbose:
+            print('\nMaking k-mer prescreen filter of reference sequences', flush=True)
+
+        got = minimap_ariba.build_kmer_filter(cdhit_outprefix + '.all.fa', cdhit_outprefix + '.all.kmers')
+        if got != 0:
+            raise Error('Error making k-mer prescreen filter of reference sequences. Cannot continue')
+
+        if self.verbose:
+            print('\nMaking mash sketches of reference sequences', flush=True)
+
+        mash.save_sketches(mash.sketch_fasta(cdhit_outprefix + '.all.fa', True), cdhit_outprefix + '.all.sketches.pickle')
+
@@ -150,7 +150,7 @@ def _report_lines_for_one_contig(cluster, contig_name, ref_cov_per_contig, pymum
         cluster.is_gene,
         cluster.is_variant_only,
         str(cluster.status_flag),
-        str(cluster.total_reads),
+        str(cluster.uncapped_total_reads),
         cluster.name,
         str(len(cluster.ref_sequence)),
         str(ref_cov),
@@ -276,11 +276,11 @@ def _report_lines_for_one_contig(cluster, contig_name, ref_cov_per_contig, pymum
 
 def report_lines(cluster):
     if cluster.status_flag.has('ref_seq_choose_fail'):
-        fields = ['.', '.', '.', str(cluster.status_flag), str(cluster.total_reads), cluster.name] + ['.'] * (len(columns) - 6)
+        fields = ['.', '.', '.', str(cluster.status_flag), str(cluster.uncapped_total_reads), cluster.name] + ['.'] * (len(columns) - 6)
         assert len(fields) == len(columns)
         return ['\t'.join(fields)]
     elif cluster.status_flag.has('assembly_fail'):
-        fields = ['.', '.', '.', str(cluster.status_flag), str(cluster.total_reads), cluster.name] + ['.'] * (len(columns) - 6)
+        fields = ['.', '.', '.', str(cluster.status_flag), str(cluster.uncapped_total_reads), cluster.name] + ['.'] * (len(columns) - 6)
         assert len(fields) == len(columns)
         return ['\t'.join(fields)]
 
@@ -7,6 +7,75 @@ from ariba import common
 class Error (Exception): pass
 
 
+class ReadDepths:
+    def __init__(self, read_depths_file):
+        '''Loads the file of read depths made by SamtoolsVariants into memory,
+           so that lookups do not need to open the file each time'''
+        self.read_depths_file = read_depths_file
+        self.depths = {} # contig name -> list, with (ref base, alt base, total depth, alt depths) at each position
+        self.total_depths = {} # contig name -> sum of depths in all lines of the file
+        rows = {} # (contig name, position) -> list of rows at that position
+
+        f = pyfastaq.utils.open_file_read(read_depths_file)
+        for line in f:
+            try:
+                name, pos, ref_base, alt_base, depth, alt_depths = line.rstrip().split('\t')
+                pos = int(pos) - 1
+                depth = int(depth)
+            except:
+                pyfastaq.utils.close(f)
+                raise Error('Error getting read depth from he following line of file ' + read_depths_file + ':\n' + line)
+
+            self.total_depths[name] = self.total_depths.get(name, 0) + depth
+            rows.setdefault((name, pos), []).append((ref_base, alt_base, depth, alt_depths))
+
+        pyfastaq.utils.close(f)
+
+        for (name, pos), position_rows in rows.items():
+            if name not in self.depths:
+                self.depths[name] = []
+            contig_depths = self.depths[name]
+            if len(contig_depths) <= pos:
+                contig_depths.extend([None] * (pos + 1 - len(contig_depths)))
+            contig_depths[pos] = ReadDepths._choose_row(position_rows)
+
+
+    @staticmethod
+    def _choose_row(rows):
+        if len(rows) > 1: # which happens with indels, mutiple lines for same base of reference
+            test_rows = [x for x in rows if x[1] != '.']
+            if len(test_rows) == 1:
+                return test_rows[0]
+        return rows[-1]
+
+
+    def get(self, sequence_name, position):
+        '''Returns tuple (ref base, alt base, total depth, alt depths) at the
+           given 0-based position, or None if not in the file'''
+        contig_depths = self.depths.get(sequence_name)
+        if contig_depths is None or not 0 <= position < len(contig_depths):
+            return None
+        return contig_depths[position]
+
+
+    def get_many(self, positions):
+        '''positions = list of (contig name, position) tuples.
+           Returns dict of contig name -> position -> depths tuple, for those
+           positions that are in the file'''
+        found = {}
+
+        for name, position in positions:
+            depths = self.get(name, position)
+            if depths is not None:
+                found.setdefault(name, {})[position] = depths
+
+        return found
+
+
+    def total_depth_per_contig(self):
+        return dict(self.total_depths)
+
+
 class SamtoolsVariants:
     def __init__(self,
       ref_fa,
@@ -33,6 +102,7 @@ class SamtoolsVariants:
 
         self.vcf_file = self.outprefix + '.vcf'
         self.read_depths_file = self.outprefix + '.read_depths.gz'
+        self.read_depths = None
 
 
     def _make_vcf_and_read_depths_files(self):
@@ -83,25 +153,7 @@ class SamtoolsVariants:
     def _get_read_depths(cls, read_depths_file, sequence_name, position):
         '''Returns total read depth and depth of reads supporting alternative (if present)'''
         assert os.path.exists(read_depths_file)
-        assert os.path.exists(read_depths_file + '.tbi')
-        tbx = pysam.TabixFile(read_depths_file)
-        try:
-            rows = [x for x in tbx.fetch(sequence_name, position, position + 1)]
-        except:
-            return None
-
-        if len(rows) > 1: # which happens with indels, mutiple lines for same base of reference
-            test_rows = [x for x in rows if x.rstrip().split()[3] != '.']
-            if len(test_rows) != 1:
-                rows = [rows[-1]]
-            else:
-                rows = test_rows
-
-        if len(rows) == 1:
-            r, p, ref_base, alt_base, ref_counts, alt_counts = rows[0].rstrip().split()
-            return ref_base, alt_base, int(ref_counts), alt_counts
-        else:
-            return None
+        return ReadDepths(read_depths_file).get(sequence_name, position)
 
 
     @classmethod
@@ -116,41 +168,23 @@ class SamtoolsVariants:
 
 
     @staticmethod
-    def _get_variants(vcf_file, read_depths_file, positions=None):
+    def _get_variants(vcf_file, read_depths_file, positions=None, read_depths=None):
+        '''read_depths = ReadDepths object loaded from read_depths_file, which
+           is made from the file if not given'''
         if positions is None:
             positions = SamtoolsVariants._get_variant_positions_from_vcf(vcf_file)
-        variants = {}
         if len(positions) == 0:
-            return variants
+            return {}
         if not (os.path.exists(vcf_file) and os.path.exists(read_depths_file)):
-            return variants
-        for t in positions:
-            name, pos = t[0], t[1]
-            depths = SamtoolsVariants._get_read_depths(read_depths_file, name, pos)
-            if depths is None:
-                continue
-            if name not in variants:
-                variants[name] = {}
-            variants[name][t[1]] = depths
-        return variants
+            return {}
+        if read_depths is None:
+            read_depths = ReadDepths(read_depths_file)
+        return read_depths.get_many(positions)
 
 
     @staticmethod
     def total_depth_per_contig(read_depths_file):
-        f = pyfastaq.utils.open_file_read(read_depths_file)
-        depths = {}
-        for line in f:
-            try:
-                name, pos, base, var, depth, depth2 = line.rstrip().split('\t')
-                depth = int(depth)
-            except:
-                pyfastaq.utils.close(f)
-                raise Error('Error getting read depth from he following line of file ' + read_depths_file + ':\n' + line)
-
-            depths[name] = depths.get(name, 0) + depth
-
-        pyfastaq.utils.close(f)
-        return depths
+        return ReadDepths(read_depths_file).total_depth_per_contig()
 
 
     @staticmethod
@@ -179,14 +213,31 @@ class SamtoolsVariants:
         return found_variants
 
 
+    def read_depths_lookup(self):
+        '''Returns ReadDepths object of the read depths file, only loading the file the first time'''
+        if self.read_depths is None:
+            self.read_depths = ReadDepths(self.read_depths_file)
+        return self.read_depths
+
+
     def get_depths_at_position(self, seq_name, position):
-        d = self._get_variants(self.vcf_file, self.read_depths_file, [(seq_name, position)])
+        if not (os.path.exists(self.vcf_file) and os.path.exists(self.read_depths_file)):
+            return 'ND', 'ND', 'ND', 'ND'
+        d = self._get_variants(self.vcf_file, self.read_depths_file, [(seq_name, position)], read_depths=self.read_depths_lookup())
         if seq_name in d and position in d[seq_name]:
             return d[seq_name][position]
         else:
             return 'ND', 'ND', 'ND', 'ND'
 
 
+    def __getstate__(self):
+        # The depths are only needed while making the report, so do not
+        # copy them when the cluster is returned from a worker process
+        state = self.__dict__.copy()
+        state['read_depths'] = None
+        return state
+
+
     def run(self):
         self._make_vcf_and_read_depths_files()
         # This is to make this object picklable, to keep multithreading happy
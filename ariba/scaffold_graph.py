@@ -1,51 +1,89 @@
+import numpy
 import pyfastaq
 from ariba import link
 
 class Error (Exception): pass
 
+# fields of each read passed to Graph.update_from_reads(). Also the keys of
+# Graph.partial_links
+read_fields = ['name', 'is_read1', 'ref', 'reverse', 'pos']
+
 class Graph:
     def __init__(self, ref_lengths):
-        self.links = {}
-        self.partial_links = {}
+        '''Links between reference sequences, made from read pairs with the
+           mates mapped to different sequences. Links are stored as arrays, one
+           element per link, with the sequences as indexes of self.ref_names'''
         self.ref_lengths = ref_lengths
-
-
-    def update_from_sam(self, sam, sam_reader):
-        '''Updates graph info from a pysam.AlignedSegment object'''
-        if sam.is_unmapped \
-          or sam.mate_is_unmapped \
-          or (sam.reference_id == sam.next_reference_id):
-            return
-
-        new_link = link.Link(sam, sam_reader, self.ref_lengths)
-        read_name = sam.query_name
-
-        if read_name in self.partial_links:
-            new_link.merge(self.partial_links[read_name])
-            del self.partial_links[read_name]
-            key = tuple(sorted((new_link.refnames[0], new_link.refnames[1])))
-            if key not in self.links:
-                self.links[key] = []
-            new_link.sort()
-            self.links[key].append(new_link)
-        else:
-            self.partial_links[read_name] = new_link
+        self.ref_names = sorted(ref_lengths)
+        self.ref_index = {name: i for i, name in enumerate(self.ref_names)}
+        self.lengths = numpy.array([ref_lengths[x] for x in self.ref_names], dtype=numpy.int64)
+        self.links = {x: numpy.zeros(0, dtype=numpy.int64) for x in ['ref1', 'ref2', 'reverse1', 'reverse2', 'pos1', 'pos2']}
+        self.partial_links = {x: numpy.zeros(0, dtype=numpy.int64) for x in read_fields}
+
+
+    def add_links(self, ref1, reverse1, pos1, ref2, reverse2, pos2):
+        '''Adds links. Each argument is a list or array with one element per
+           link. ref1, ref2 = indexes of the sequences in self.ref_names.
+           reverse1, reverse2 = whether the read is on the reverse strand.
+           pos1, pos2 = zero-based position of the outer end of the read'''
+        new_links = {x: numpy.asarray(y, dtype=numpy.int64) for x, y in zip(['ref1', 'reverse1', 'pos1', 'ref2', 'reverse2', 'pos2'], [ref1, reverse1, pos1, ref2, reverse2, pos2])}
+
+        # each link has the first sequence in sorted order first, like Link.sort()
+        swap = new_links['ref2'] < new_links['ref1']
+        for field in ['ref', 'reverse', 'pos']:
+            one = numpy.where(swap, new_links[field + '2'], new_links[field + '1'])
+            two = numpy.where(swap, new_links[field + '1'], new_links[field + '2'])
+            new_links[field + '1'], new_links[field + '2'] = one, two
+
+        for field in self.links:
+            self.links[field] = numpy.concatenate([self.links[field], new_links[field]])
+
+
+    def update_from_reads(self, name, is_read1, ref, reverse, pos):
+        '''Updates graph from mapped reads whose mates are mapped to a different
+           sequence. Each argument is an array with one element per read.
+           name = integer ID of the read pair. ref = index of sequence in
+           self.ref_names. pos = position of the outer end of the read.
+           Reads whose mate has not been seen yet are kept in
+           self.partial_links, to be paired up by a later call'''
+        reads = {x: numpy.concatenate([self.partial_links[x], numpy.asarray(y, dtype=numpy.int64)]) for x, y in zip(read_fields, [name, is_read1, ref, reverse, pos])}
+        order = numpy.lexsort((1 - reads['is_read1'], reads['name']))
+        reads = {x: reads[x][order] for x in reads}
+        paired = (reads['name'][:-1] == reads['name'][1:]) & (reads['is_read1'][:-1] == 1) & (reads['is_read1'][1:] == 0)
+        first = numpy.flatnonzero(paired)
+        second = first + 1
+        self.add_links(reads['ref'][first], reads['reverse'][first], reads['pos'][first], reads['ref'][second], reads['reverse'][second], reads['pos'][second])
+        unpaired = numpy.ones(len(reads['name']), dtype=bool)
+        unpaired[first] = False
+        unpaired[second] = False
+        self.partial_links = {x: reads[x][unpaired] for x in reads}
+
+
+    def _insert_sizes(self):
+        '''Returns array of insert size of each link: distance between the
+           outer edges of the reads, assuming a gap length of zero'''
+        sizes = numpy.zeros(len(self.links['pos1']), dtype=numpy.int64)
+        for i in ['1', '2']:
+            pos = self.links['pos' + i]
+            sizes += numpy.where(self.links['reverse' + i] == 1, pos, self.lengths[self.links['ref' + i]] - pos - 1)
+        return sizes
 
 
     def _make_graph(self, max_insert):
         '''helper function to construct graph from current state of object'''
-        if len(self.partial_links) != 0:
+        if len(self.partial_links['name']) != 0:
             raise Error('Error in _make_graph(). Cannot continue because there are partial links')
-        
+
         self.contig_links = {}
-        for key in self.links:
-            for l in self.links[key]:
-                insert_size = l.insert_size()
-                if insert_size <= max_insert:
-                    if key not in self.contig_links:
-                        self.contig_links[key] = {}
-                    dirs = ''.join(l.dirs)
-                    self.contig_links[key][dirs] = self.contig_links[key].get(dirs, 0) + 1
+        keep = self._insert_sizes() <= max_insert
+        columns = numpy.array([self.links[x][keep] for x in ['ref1', 'ref2', 'reverse1', 'reverse2']]).T
+        rows, row_counts = numpy.unique(columns, axis=0, return_counts=True)
+        for (ref1, ref2, reverse1, reverse2), count in zip(rows, row_counts):
+            key = (self.ref_names[ref1], self.ref_names[ref2])
+            if key not in self.contig_links:
+                self.contig_links[key] = {}
+            dirs = ('L' if reverse1 else 'R') + ('L' if reverse2 else 'R')
+            self.contig_links[key][dirs] = int(count)
 
 
     def _remove_low_cov_links(self, min_coverage):
@@ -92,12 +130,37 @@ class Graph:
         return self._contig_graph_is_consistent()
 
 
+    def _link_fields(self, i):
+        '''Returns list of fields of link number i, in the same order as the
+           string of a link.Link object'''
+        fields = []
+        for j in ['1', '2']:
+            ref = self.links['ref' + j][i]
+            fields += [
+                self.ref_names[ref],
+                self.lengths[ref],
+                'L' if self.links['reverse' + j][i] else 'R',
+                self.links['pos' + j][i],
+            ]
+        return fields
+
+
+    def get_links(self):
+        '''Returns dict of (name1, name2) -> list of link.Link objects, in the
+           order the links were added'''
+        links = {}
+        for i in range(len(self.links['ref1'])):
+            l = link.Link(None, None, None, s='\t'.join([str(x) for x in self._link_fields(i)]))
+            key = tuple(l.refnames)
+            if key not in links:
+                links[key] = []
+            links[key].append(l)
+        return links
+
+
     def write_all_links_to_file(self, filename):
         f = pyfastaq.utils.open_file_write(filename)
-        for key in sorted(self.links):
-            to_write = list(self.links[key])
-            to_write.sort()
-            for l in to_write:
-                print(l, file=f)
+        order = numpy.lexsort(tuple(self.links[x] for x in ['pos2', 'pos1', 'ref2', 'ref1']))
+        for i in order:
+            print(*self._link_fields(i), sep='\t', file=f)
         pyfastaq.utils.close(f)
-
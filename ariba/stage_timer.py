@@ -0,0 +1,152 @@
+import time
+import resource
+import contextlib
+
+columns = [
+    'wall_seconds',
+    'cpu_seconds',
+    'children_cpu_seconds',
+    'max_rss_kb',
+    'children_max_rss_kb',
+    'read_bytes',
+    'write_bytes',
+]
+
+
+def _proc_io():
+    '''Returns (bytes read, bytes written) by this process, from /proc/self/io,
+       or (0, 0) if not available'''
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(line.rstrip().split(': ') for line in f)
+        return int(values['rchar']), int(values['wchar'])
+    except:
+        return 0, 0
+
+
+def _reset_peak_rss():
+    '''Resets the peak RSS of this process (Linux only), so that the peak
+       of each stage can be measured. Returns True if it worked'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            print('5', file=f)
+        return True
+    except:
+        return False
+
+
+def _peak_rss_kb(since_reset):
+    if since_reset:
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except:
+            pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _snapshot():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = _proc_io()
+    return {
+        'wall': time.perf_counter(),
+        'cpu': self_usage.ru_utime + self_usage.ru_stime,
+        'children_cpu': children_usage.ru_utime + children_usage.ru_stime,
+        'children_max_rss': children_usage.ru_maxrss,
+        'read': read_bytes + 512 * children_usage.ru_inblock,
+        'write': write_bytes + 512 * children_usage.ru_oublock,
+    }
+
+
+class StageTimer:
+    def __init__(self):
+        '''Records the resources used by each stage of running a cluster.
+           Child processes (eg from common.syscall) are counted using
+           resource.RUSAGE_CHILDREN, which includes all child processes that
+           have finished. Bytes read/written are those of this process
+           (from /proc/self/io) plus block I/O of child processes.
+           children_max_rss_kb is the largest peak RSS of any child
+           process so far, because the OS does not report it per stage.
+           Stages can be nested. The max_rss_kb of a stage includes
+           the peaks of the stages nested inside it'''
+        self.stages = [] # list of tuples (stage name, dict of column -> value)
+        self._open_peaks = [] # peak RSS so far of each stage still running, outermost first
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Use as: "with timer.stage(name): ...". The stage is recorded even
+           if an exception is raised'''
+        # Resetting the peak RSS would lose the peak so far of any enclosing
+        # stages, so save it first
+        if len(self._open_peaks):
+            peak = _peak_rss_kb(True)
+            self._open_peaks = [max(x, peak) for x in self._open_peaks]
+
+        since_reset = _reset_peak_rss()
+        self._open_peaks.append(0)
+        start = _snapshot()
+        try:
+            yield
+        finally:
+            end = _snapshot()
+            max_rss_kb = max(self._open_peaks.pop(), _peak_rss_kb(since_reset))
+            self.stages.append((name, {
+                'wall_seconds': end['wall'] - start['wall'],
+                'cpu_seconds': end['cpu'] - start['cpu'],
+                'children_cpu_seconds': end['children_cpu'] - start['children_cpu'],
+                'max_rss_kb': max_rss_kb,
+                'children_max_rss_kb': end['children_max_rss'],
+                'read_bytes': end['read'] - start['read'],
+                'write_bytes': end['write'] - start['write'],
+            }))
+
+
+def rollup(stages):
+    '''Input is list of (stage name, values dict), as in StageTimer.stages.
+       Returns list of (stage name, values dict), with one entry per stage
+       name, in order of first appearance. Values are summed, except
+       RSS, where the maximum is taken'''
+    totals = {}
+
+    for name, values in stages:
+        if name not in totals:
+            totals[name] = dict(values)
+        else:
+            for column in columns:
+                if column.endswith('rss_kb'):
+                    totals[name][column] = max(totals[name][column], values[column])
+                else:
+                    totals[name][column] += values[column]
+
+    return list(totals.items())
+
+
+def write_tsv(cluster_stages, run_stages, outfile):
+    '''cluster_stages = dict of cluster name -> list of (stage name, values dict).
+       run_stages = list of (stage name, values dict), for stages of the
+       whole run (not in any cluster). Writes one line per cluster and stage,
+       then the total of each stage over all clusters (cluster name "ALL"),
+       then the run stages (cluster name ".")'''
+    def format_values(values):
+        return [str(round(values[x], 3)) if x.endswith('seconds') else str(values[x]) for x in columns]
+
+    all_stages = []
+
+    with open(outfile, 'w') as f:
+        print('#cluster', 'stage', *columns, sep='\t', file=f)
+
+        for cluster_name in sorted(cluster_stages):
+            for name, values in cluster_stages[cluster_name]:
+                print(cluster_name, name, *format_values(values), sep='\t', file=f)
+                all_stages.append((name, values))
+
+        for name, values in rollup(all_stages):
+            print('ALL', name, *format_values(values), sep='\t', file=f)
+
+        for name, values in run_stages:
+            print('.', name, *format_values(values), sep='\t', file=f)
@@ -6,6 +6,7 @@ __all__ = [
     'refquery',
     'reportfilter',
     'run',
+    'run_batch',
     'summary',
     'test',
     'version',
@@ -27,7 +27,7 @@ def run(options):
         print('Input directory', options.prepareref_dir, 'not found. Cannot continue', file=sys.stderr)
         sys.exit(1)
 
-    if os.path.exists(options.outdir):
+    if os.path.exists(options.outdir) and not options.resume:
         print('Output directory already exists. ARIBA makes the output directory. Cannot continue.', file=sys.stderr)
         sys.exit(1)
 
@@ -42,19 +42,35 @@ def run(options):
           options.outdir,
           extern_progs,
           version_report_lines=version_report_lines,
-          assembly_coverage=options.assembly_cov,
-          assembler='fermilite',
           threads=options.threads,
           verbose=options.verbose,
-          min_scaff_depth=options.min_scaff_depth,
-          nucmer_min_id=options.nucmer_min_id,
-          nucmer_min_len=options.nucmer_min_len,
-          nucmer_breaklen=options.nucmer_breaklen,
-          assembled_threshold=options.assembled_threshold,
-          unique_threshold=options.unique_threshold,
-          max_gene_nt_extend=options.gene_nt_extend,
           clean=(not options.noclean),
-          tmp_dir=options.tmp_dir,
+          resume=options.resume,
+          **clusters_options(options)
         )
     c.run()
 
+
+def clusters_options(options):
+    '''Returns dict of keyword arguments for ariba.clusters.Clusters made
+       from the command line options, except those that are given
+       separately by run and run_batch'''
+    return {
+        'assembly_coverage': options.assembly_cov,
+        'assembler': 'fermilite',
+        'min_scaff_depth': options.min_scaff_depth,
+        'nucmer_min_id': options.nucmer_min_id,
+        'nucmer_min_len': options.nucmer_min_len,
+        'nucmer_breaklen': options.nucmer_breaklen,
+        'assembled_threshold': options.assembled_threshold,
+        'unique_threshold': options.unique_threshold,
+        'max_gene_nt_extend': options.gene_nt_extend,
+        'tmp_dir': options.tmp_dir,
+        'read_store_format': options.read_store,
+        'kmer_prescreen': not options.no_kmer_prescreen,
+        'cluster_read_cap': options.cluster_read_cap,
+        'read_filter_engine': options.read_filter,
+        'contig_aligner': options.contig_aligner,
+        'assembly_mapper': options.assembly_mapper,
+        'ref_chooser': options.ref_chooser,
+    }
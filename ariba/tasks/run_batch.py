@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+import ariba
+
+
+def run(options):
+    if not os.path.exists(options.samples_tsv):
+        print('Samples file', options.samples_tsv, 'not found. Cannot continue', file=sys.stderr)
+        sys.exit(1)
+
+    samples = ariba.batch_runner.load_samples_file(options.samples_tsv)
+    if len(samples) == 0:
+        print('No samples found in file', options.samples_tsv, '. Cannot continue', file=sys.stderr)
+        sys.exit(1)
+
+    reads_not_found = []
+
+    for sample_name, reads_1, reads_2 in samples:
+        for filename in [reads_1, reads_2]:
+            if not os.path.exists(filename):
+                reads_not_found.append(filename)
+            elif options.verbose:
+                print('Found reads file:', filename)
+
+        if reads_1 == reads_2:
+            print('Same file provided for forwards and reverse reads of sample', sample_name, '. Cannot continue', file=sys.stderr)
+            sys.exit(1)
+
+    if len(reads_not_found):
+        print('\nThe following reads file(s) were not found:', file=sys.stderr)
+        print(*reads_not_found, sep='\n', file=sys.stderr)
+        print('Cannot continue', file=sys.stderr)
+        sys.exit(1)
+
+    if not os.path.exists(options.prepareref_dir):
+        print('Input directory', options.prepareref_dir, 'not found. Cannot continue', file=sys.stderr)
+        sys.exit(1)
+
+    if os.path.exists(options.outdir) and not options.resume:
+        print('Output directory already exists. ARIBA makes the output directory. Cannot continue.', file=sys.stderr)
+        sys.exit(1)
+
+    extern_progs, version_report_lines = ariba.versions.get_all_versions()
+    if options.verbose:
+        print(*version_report_lines, sep='\n')
+
+    runner = ariba.batch_runner.BatchRunner(
+        options.prepareref_dir,
+        samples,
+        options.outdir,
+        extern_progs,
+        version_report_lines=version_report_lines,
+        threads=options.threads,
+        verbose=options.verbose,
+        clean=(not options.noclean),
+        resume=options.resume,
+        clusters_options=ariba.tasks.run.clusters_options(options),
+    )
+    runner.run()
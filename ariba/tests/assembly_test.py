@@ -4,6 +4,7 @@ import os
 import shutil
 import filecmp
 import pyfastaq
+import fermilite_ariba
 from ariba import assembly
 
 modules_dir = os.path.dirname(os.path.abspath(assembly.__file__))
@@ -58,6 +59,51 @@ class TestAssembly(unittest.TestCase):
         os.unlink(tmp_log)
 
 
+    def test_fermilite_assemble_reads(self):
+        '''test fermilite_ariba.assemble_reads gives same results as from files, with any number of threads'''
+        for reads_prefix, expected_prefix in [('assembly_run_fermilite', 'assembly_run_fermilite'), ('assembly_run_fermilite_fail', 'assembly_run_fermilite_fails')]:
+            reads = [(x.seq, x.qual) for x in pyfastaq.sequences.file_reader(os.path.join(data_dir, reads_prefix + '.reads.fq'))]
+            seqs = ''.join([x[0] + '\n' for x in reads]).encode()
+            quals = ''.join([x[1] + '\n' for x in reads]).encode()
+            with open(os.path.join(data_dir, expected_prefix + '.expected.log')) as f:
+                expected_log = f.read()
+            expected_fa = os.path.join(data_dir, expected_prefix + '.expected.fa')
+            if os.path.exists(expected_fa):
+                expected_contigs = [x.seq for x in pyfastaq.sequences.file_reader(expected_fa)]
+            else:
+                expected_contigs = []
+
+            for threads in 1, 3, 10:
+                contigs, got_log = fermilite_ariba.assemble_reads(seqs, memoryview(quals), threads)
+                self.assertEqual(expected_log, got_log)
+                self.assertEqual(expected_contigs, contigs)
+
+        with self.assertRaises(ValueError):
+            fermilite_ariba.assemble_reads(b'ACGT\nACGT\n', b'IIII\nIII\n')
+
+
+    def test_load_fermilite_reads(self):
+        '''test _load_fermilite_reads'''
+        reads1 = os.path.join(data_dir, 'assembly_assemble_with_fermilite.reads_1.fq')
+        reads2 = os.path.join(data_dir, 'assembly_assemble_with_fermilite.reads_2.fq')
+        tmp_fq = 'tmp.test_load_fermilite_reads.fq'
+        pyfastaq.tasks.interleave(reads1, reads2, tmp_fq)
+        reads = [(x.seq, x.qual) for x in pyfastaq.sequences.file_reader(tmp_fq)]
+        os.unlink(tmp_fq)
+        expected = (
+            ''.join([x[0] + '\n' for x in reads]).encode(),
+            ''.join([x[1] + '\n' for x in reads]).encode(),
+        )
+        self.assertEqual(expected, assembly.Assembly._load_fermilite_reads(reads1, reads2))
+
+        reads_fa = os.path.join(data_dir, 'assembly_test_load_fermilite_reads.fa')
+        got = assembly.Assembly._load_fermilite_reads(reads_fa, reads_fa)
+        self.assertEqual((b'ACGT\nACGT\nCCGG\nCCGG\n', b''), got)
+
+        with self.assertRaises(assembly.Error):
+            assembly.Assembly._load_fermilite_reads(reads1, reads_fa)
+
+
     def test_assemble_with_fermilite(self):
         '''test _assemble_with_fermilite'''
         reads1 = os.path.join(data_dir, 'assembly_assemble_with_fermilite.reads_1.fq')
@@ -182,6 +228,17 @@ class TestAssembly(unittest.TestCase):
         shutil.rmtree(tmp_dir)
 
 
+    def test_reverse_queries_in_nucmer_file(self):
+        '''test _reverse_queries_in_nucmer_file'''
+        for suffix in ['coords', 'coords.snps']:
+            infile = os.path.join(data_dir, 'assembly_test_reverse_queries_in_nucmer_file.in.' + suffix)
+            expected = os.path.join(data_dir, 'assembly_test_reverse_queries_in_nucmer_file.out.' + suffix)
+            tmp_out = 'tmp.assembly_test_reverse_queries_in_nucmer_file.' + suffix
+            assembly.Assembly._reverse_queries_in_nucmer_file(infile, tmp_out, {'contig2'}, 'assembly.fa')
+            self.assertTrue(filecmp.cmp(expected, tmp_out, shallow=False))
+            os.unlink(tmp_out)
+
+
     def test_fix_contig_orientation(self):
         '''test _fix_contig_orientation'''
         scaffs_in = os.path.join(data_dir, 'assembly_test_fix_contig_orientation.in.fa')
@@ -195,6 +252,12 @@ class TestAssembly(unittest.TestCase):
         os.unlink(tmp_out)
 
 
+    def test_read_names(self):
+        '''test _read_names'''
+        reads = os.path.join(data_dir, 'assembly_test_read_names.fq')
+        self.assertEqual({'1', '2', 'read3'}, assembly.Assembly._read_names(reads))
+
+
     def test_parse_bam(self):
         '''test _parse_bam'''
         bam = os.path.join(data_dir, 'assembly_test_parse_assembly_bam.bam')
@@ -206,3 +269,7 @@ class TestAssembly(unittest.TestCase):
         os.unlink(bam + '.unmapped_mates')
         os.unlink(bam + '.scaff')
 
+        self.assertTrue(assembly.Assembly._parse_bam(assembly_seqs, bam, 10, 1000, write_files=False))
+        for suffix in ['soft_clipped', 'unmapped_mates', 'scaff']:
+            self.assertFalse(os.path.exists(bam + '.' + suffix))
+
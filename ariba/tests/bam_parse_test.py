@@ -39,49 +39,63 @@ class TestBamParse(unittest.TestCase):
 
             i += 1
 
-    def test_update_soft_clipped_from_sam(self):
-        '''test _update_soft_clipped_from_sam'''
+    def test_alignment_fields(self):
+        '''test _alignment_fields'''
+        ref_seqs = {}
+        ref_fasta = os.path.join(data_dir, 'bam_parse_test_parse.ref.fa')
+        bam = os.path.join(data_dir, 'bam_parse_test_parse.bam')
+        pyfastaq.tasks.file_to_dict(ref_fasta, ref_seqs)
+        bp = bam_parse.Parser(bam, ref_seqs)
+        fields = bp._alignment_fields()
+        sam_reader = pysam.Samfile(bam, "rb")
+        expected = [sam for sam in sam_reader.fetch(until_eof=True) if not sam.is_unmapped]
+        self.assertEqual([x.reference_id for x in expected], list(fields['ref']))
+        self.assertEqual([x.flag for x in expected], list(fields['flag']))
+        self.assertEqual([x.reference_start for x in expected], list(fields['start']))
+        self.assertEqual([x.reference_end for x in expected], list(fields['end']))
+        self.assertEqual([bp._sam_to_soft_clipped(x) for x in expected], list(zip(fields['left_clip'], fields['right_clip'])))
+        link_names = [x.query_name for x in expected if x.next_reference_id != x.reference_id and not x.mate_is_unmapped]
+        self.assertEqual(len(link_names), sum(fields['name'] != -1))
+        self.assertEqual(len(set(link_names)), len(set(fields['name'][fields['name'] != -1])))
+
+
+    def test_update_soft_clipped(self):
+        '''test _update_soft_clipped'''
         ref_seqs = {}
         ref_fasta = os.path.join(data_dir, 'bam_parse_test_update_soft_clipped_from_sam.ref.fa')
         bam = os.path.join(data_dir, 'bam_parse_test_update_soft_clipped_from_sam.bam')
         pyfastaq.tasks.file_to_dict(ref_fasta, ref_seqs)
         bp = bam_parse.Parser(bam, ref_seqs)
-        expected = [
-            {},
-            {'ref1': {61: [1, 0]}},
-            {'ref1': {61: [2, 0], 118: [0, 1]}},
-        ]
-        i = 0
-        sam_reader = pysam.Samfile(bam, "rb")
-        for sam in sam_reader.fetch(until_eof=True):
-            bp._update_soft_clipped_from_sam(sam)
-            self.assertEqual(expected[i], bp.soft_clipped)
-            i += 1
+        bp._update_soft_clipped(bp._alignment_fields())
+        self.assertEqual({'ref1': {61: [2, 0], 118: [0, 1]}}, bp.soft_clipped)
 
 
-    def test_update_unmapped_mates_from_sam(self):
-        '''test _update_unmapped_mates_from_sam'''
+    def test_update_unmapped_mates(self):
+        '''test _update_unmapped_mates'''
         ref_seqs = {}
         ref_fasta = os.path.join(data_dir, 'bam_parse_test_update_unmapped_mates_from_sam.ref.fa')
         bam = os.path.join(data_dir, 'bam_parse_test_update_unmapped_mates_from_sam.bam')
         pyfastaq.tasks.file_to_dict(ref_fasta, ref_seqs)
         bp = bam_parse.Parser(bam, ref_seqs)
-        expected = [
-            {},
-            {'ref': {240: 1}},
-            {'ref': {240: 1, 360: 1}},
-            {'ref': {240: 1, 360: 1}},
-            {'ref': {240: 1, 360: 1}},
-            {'ref': {240: 1, 360: 1}},
-            {'ref': {240: 1, 360: 1}},
-            {'ref': {240: 1, 360: 1}},
-        ]
-        i = 0
-        sam_reader = pysam.Samfile(bam, "rb")
-        for sam in sam_reader.fetch(until_eof=True):
-            bp._update_unmapped_mates_from_sam(sam)
-            self.assertEqual(expected[i], bp.unmapped_mates)
-            i += 1
+        bp._update_unmapped_mates(bp._alignment_fields())
+        self.assertEqual({'ref': {240: 1, 360: 1}}, bp.unmapped_mates)
+
+
+    def test_update_scaff_graph(self):
+        '''test _update_scaff_graph'''
+        ref_seqs = {}
+        ref_fasta = os.path.join(data_dir, 'graph_test_update_from_sam.ref.fa')
+        bam = os.path.join(data_dir, 'graph_test_update_from_sam.bam')
+        pyfastaq.tasks.file_to_dict(ref_fasta, ref_seqs)
+        bp = bam_parse.Parser(bam, ref_seqs)
+        bp._update_scaff_graph(bp._alignment_fields())
+        self.assertEqual(0, len(bp.scaff_graph.partial_links['name']))
+        expected_links = [link.Link(None, None, None, s='\t'.join(['ref1', '506', 'R', '300', 'ref2', '500', 'L', '359']))]
+        self.assertEqual({('ref1', 'ref2'): expected_links}, bp.scaff_graph.get_links())
+
+        bp = bam_parse.Parser(bam, {'ref1': ref_seqs['ref1']})
+        with self.assertRaises(bam_parse.Error):
+            bp._update_scaff_graph(bp._alignment_fields())
 
 
     def test_parse(self):
@@ -98,9 +112,30 @@ class TestBamParse(unittest.TestCase):
         expected_link_keys = [('ref1', 'ref2')]
         self.assertEqual(expected_soft_clipped, bp.soft_clipped)
         self.assertEqual(expected_unmapped_mates, bp.unmapped_mates)
-        self.assertEqual(list(bp.scaff_graph.links.keys()), expected_link_keys)
-        self.assertEqual(len(bp.scaff_graph.links[expected_link_keys[0]]), 1)
-        self.assertEqual(bp.scaff_graph.links[expected_link_keys[0]][0], l)
+        links = bp.scaff_graph.get_links()
+        self.assertEqual(list(links.keys()), expected_link_keys)
+        self.assertEqual(len(links[expected_link_keys[0]]), 1)
+        self.assertEqual(links[expected_link_keys[0]][0], l)
+
+        bp = bam_parse.Parser(bam, ref_seqs, diagnostics=False)
+        bp.parse()
+        self.assertEqual({}, bp.soft_clipped)
+        self.assertEqual({}, bp.unmapped_mates)
+        self.assertEqual({expected_link_keys[0]: [l]}, bp.scaff_graph.get_links())
+        with self.assertRaises(bam_parse.Error):
+            bp.write_files('tmp.bam_parse_test_parse')
+
+        bp = bam_parse.Parser(bam, ref_seqs, read_names={'read3'})
+        bp.parse()
+        self.assertEqual({}, bp.soft_clipped)
+        self.assertEqual({}, bp.unmapped_mates)
+        self.assertEqual(expected_link_keys, list(bp.scaff_graph.get_links().keys()))
+
+        bp = bam_parse.Parser(bam, ref_seqs, read_names={'read1', 'read2'})
+        bp.parse()
+        self.assertEqual(expected_soft_clipped, bp.soft_clipped)
+        self.assertEqual(expected_unmapped_mates, bp.unmapped_mates)
+        self.assertEqual({}, bp.scaff_graph.get_links())
 
 
     def test_write_soft_clipped_to_file(self):
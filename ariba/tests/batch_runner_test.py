@@ -0,0 +1,97 @@
+import unittest
+import os
+import shutil
+import filecmp
+import pickle
+from ariba import batch_runner, clusters, external_progs
+
+modules_dir = os.path.dirname(os.path.abspath(batch_runner.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+extern_progs = external_progs.ExternalProgs()
+
+
+def make_dummy_refdata_dir(refdata_dir):
+    os.mkdir(refdata_dir)
+    shutil.copyfile(os.path.join(data_dir, 'clusters_test_dummy_db.fa'), os.path.join(refdata_dir, '02.cdhit.all.fa'))
+    shutil.copyfile(os.path.join(data_dir, 'clusters_test_dummy_db.tsv'), os.path.join(refdata_dir, '01.filter.check_metadata.tsv'))
+    with open(os.path.join(refdata_dir, '00.info.txt'), 'w') as f:
+        print('genetic_code\t11', file=f)
+    with open(os.path.join(refdata_dir, '02.cdhit.clusters.tsv'), 'w') as f:
+        print('0\tx', file=f)
+    with open(os.path.join(refdata_dir, '02.cdhit.clusters.pickle'), 'wb') as f:
+        pickle.dump({'0': {'x'}}, f)
+
+
+class TestBatchRunner(unittest.TestCase):
+    def test_load_samples_file(self):
+        '''test load_samples_file'''
+        infile = os.path.join(data_dir, 'batch_runner_test_load_samples_file.tsv')
+        expected = [
+            ('sample1', 'reads1_1.fq', 'reads1_2.fq'),
+            ('sample2', 'reads2_1.fq.gz', 'reads2_2.fq.gz'),
+        ]
+        self.assertEqual(expected, batch_runner.load_samples_file(infile))
+
+        tmp_file = 'tmp.batch_runner_test_load_samples_file.tsv'
+        bad_lines = [
+            'sample1\treads_1.fq\n',
+            'sample1/x\treads_1.fq\treads_2.fq\n',
+            'sample1\treads_1.fq\treads_2.fq\nsample1\treads_3.fq\treads_4.fq\n',
+        ]
+        for lines in bad_lines:
+            with open(tmp_file, 'w') as f:
+                print(lines, end='', file=f)
+            with self.assertRaises(batch_runner.Error):
+                batch_runner.load_samples_file(tmp_file)
+        os.unlink(tmp_file)
+
+
+    def test_run(self):
+        '''test run'''
+        refdata_dir = 'tmp.batch_runner_test_run.refdata'
+        make_dummy_refdata_dir(refdata_dir)
+        reads1 = os.path.join(data_dir, 'clusters_test_dummy_reads_1.fq')
+        reads2 = os.path.join(data_dir, 'clusters_test_dummy_reads_2.fq')
+        tmp_single = 'tmp.batch_runner_test_run.single'
+        c = clusters.Clusters(refdata_dir, reads1, reads2, tmp_single, extern_progs)
+        c.run()
+
+        tmp_batch = 'tmp.batch_runner_test_run.batch'
+        samples = [('sample1', reads1, reads2), ('sample2', reads1, reads2)]
+        runner = batch_runner.BatchRunner(refdata_dir, samples, tmp_batch, extern_progs, threads=2)
+        runner.run()
+
+        for sample in ['sample1', 'sample2']:
+            for filename in ['report.tsv', 'report.all.tsv']:
+                self.assertTrue(filecmp.cmp(os.path.join(tmp_single, filename), os.path.join(tmp_batch, sample, filename), shallow=False))
+
+        shutil.rmtree(refdata_dir)
+        shutil.rmtree(tmp_single)
+        shutil.rmtree(tmp_batch)
+
+
+    def test_run_sample_fails(self):
+        '''test run carries on when a sample fails with an error that is not a clusters.Error'''
+        refdata_dir = 'tmp.batch_runner_test_run_sample_fails.refdata'
+        make_dummy_refdata_dir(refdata_dir)
+        reads1 = os.path.join(data_dir, 'clusters_test_dummy_reads_1.fq')
+        reads2 = os.path.join(data_dir, 'clusters_test_dummy_reads_2.fq')
+        tmp_batch = 'tmp.batch_runner_test_run_sample_fails.batch'
+
+        # version_info.txt cannot be written, so sample1 fails with IsADirectoryError
+        os.makedirs(os.path.join(tmp_batch, 'sample1', 'version_info.txt'))
+        samples = [('sample1', reads1, reads2), ('sample2', reads1, reads2)]
+        runner = batch_runner.BatchRunner(refdata_dir, samples, tmp_batch, extern_progs, threads=2, resume=True)
+        with self.assertRaises(batch_runner.Error):
+            runner.run()
+
+        self.assertEqual(['sample1'], runner.failed_samples)
+        self.assertTrue(os.path.exists(os.path.join(tmp_batch, 'sample2', 'report.tsv')))
+        with open(runner.summary_file) as f:
+            lines = [x.rstrip('\n').split('\t') for x in f]
+        self.assertEqual(['sample', 'status', 'error'], lines[0])
+        self.assertEqual(['sample1', 'failed'], lines[1][:2])
+        self.assertTrue(lines[1][2].startswith('IsADirectoryError: '))
+        self.assertEqual(['sample2', 'finished', '.'], lines[2])
+        shutil.rmtree(refdata_dir)
+        shutil.rmtree(tmp_batch)
@@ -31,15 +31,20 @@ class TestBestSeqChooser(unittest.TestCase):
         reads1 = os.path.join(data_dir, 'best_seq_chooser_get_best_seq_by_alignment_score_reads_1.fq')
         reads2 = os.path.join(data_dir, 'best_seq_chooser_get_best_seq_by_alignment_score_reads_2.fq')
         ref = os.path.join(data_dir, 'best_seq_chooser_get_best_seq_by_alignment_score_ref.fa')
-        chooser = best_seq_chooser.BestSeqChooser(
-            reads1,
-            reads2,
-            ref,
-            sys.stdout,
-            samtools_exe=extern_progs.exe('samtools'),
-            bowtie2_exe=extern_progs.exe('bowtie2'),
-        )
-        self.assertEqual('1', chooser._get_best_seq_by_alignment_score())
+        for scorer in best_seq_chooser.scorers:
+            chooser = best_seq_chooser.BestSeqChooser(
+                reads1,
+                reads2,
+                ref,
+                sys.stdout,
+                samtools_exe=extern_progs.exe('samtools'),
+                bowtie2_exe=extern_progs.exe('bowtie2'),
+                scorer=scorer,
+            )
+            self.assertEqual('1', chooser._get_best_seq_by_alignment_score())
+
+        with self.assertRaises(best_seq_chooser.Error):
+            best_seq_chooser.BestSeqChooser(reads1, reads2, ref, sys.stdout, scorer='notascorer')
 
 
     def test_best_seq(self):
@@ -49,6 +49,20 @@ class TestCluster(unittest.TestCase):
             shutil.rmtree(tmpdir)
 
 
+    def test_uncapped_read_count(self):
+        '''Test _uncapped_read_count'''
+        tests = [
+            (10, 20, None, 10),
+            (10, 20, 20, 10),
+            (10, 0, 100, 10),
+            (10, 20, 100, 50),
+            (10, 30, 100, 34),
+        ]
+
+        for filtered, stored, before_cap, expected in tests:
+            self.assertEqual(expected, cluster.Cluster._uncapped_read_count(filtered, stored, before_cap))
+
+
     def test_number_of_reads_for_assembly(self):
         '''Test _number_of_reads_for_assembly'''
         tests = [
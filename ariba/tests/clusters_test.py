@@ -4,7 +4,8 @@ import os
 import pickle
 import pyfastaq
 import filecmp
-from ariba import clusters, external_progs, histogram, sequence_metadata
+import minimap_ariba
+from ariba import cluster, clusters, external_progs, histogram, read_store, sequence_metadata
 
 modules_dir = os.path.dirname(os.path.abspath(clusters.__file__))
 data_dir = os.path.join(modules_dir, 'tests', 'data')
@@ -18,6 +19,24 @@ def file_to_list(infile):
     return lines
 
 
+def stderr_of(function, *args, **kwargs):
+    '''Runs function(*args, **kwargs) and returns what was written to
+       file descriptor 2, which includes the output of the C extensions'''
+    tmp_file = 'tmp.clusters_test.stderr'
+    saved_fd = os.dup(2)
+    with open(tmp_file, 'w') as f:
+        os.dup2(f.fileno(), 2)
+        try:
+            function(*args, **kwargs)
+        finally:
+            os.dup2(saved_fd, 2)
+            os.close(saved_fd)
+    with open(tmp_file) as f:
+        stderr = f.read()
+    os.unlink(tmp_file)
+    return stderr
+
+
 class TestClusters(unittest.TestCase):
     def setUp(self):
         self.cluster_dir = 'tmp.Cluster'
@@ -52,7 +71,7 @@ class TestClusters(unittest.TestCase):
     def test_load_ref_data_from_dir(self):
         '''test _load_reference_data_from_dir'''
         indir = os.path.join(data_dir, 'clusters_load_ref_data_from_dir')
-        got_refdata, got_clusters = clusters.Clusters._load_reference_data_from_dir(indir)
+        got_refdata, got_clusters, got_sketches = clusters.Clusters._load_reference_data_from_dir(indir)
         expected_seq_dict = {
             'variants_only1': pyfastaq.sequences.Fasta('variants_only1', 'atggcgtgcgatgaataa'),
             'presabs1': pyfastaq.sequences.Fasta('presabs1', 'atgatgatgagcccggcgatggaaggcggctag'),
@@ -88,6 +107,7 @@ class TestClusters(unittest.TestCase):
 
         expected_clusters = {'0': {'presabs1'}, '1': {'variants_only1'}, '2': {'noncoding1'}}
         self.assertEqual(expected_clusters, got_clusters)
+        self.assertEqual(None, got_sketches)
 
 
     def test_minimap_reads_to_all_ref_seqs(self):
@@ -117,6 +137,310 @@ class TestClusters(unittest.TestCase):
         os.unlink(tmp_outprefix + '.reads')
 
 
+    def test_minimap_reads_to_all_ref_seqs_threads(self):
+        '''test test_minimap_reads_to_all_ref_seqs gives same output with more than one thread'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_outprefix1 = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_threads.1'
+        tmp_outprefix3 = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_threads.3'
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix1, threads=1)
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix3, threads=3)
+
+        for suffix in ['reads', 'cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+            self.assertTrue(filecmp.cmp(tmp_outprefix1 + '.' + suffix, tmp_outprefix3 + '.' + suffix, shallow=False))
+            os.unlink(tmp_outprefix1 + '.' + suffix)
+            os.unlink(tmp_outprefix3 + '.' + suffix)
+
+
+    def test_minimap_reads_to_all_ref_seqs_with_index(self):
+        '''test test_minimap_reads_to_all_ref_seqs using prebuilt index'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_index = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_with_index.mmi'
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_with_index'
+        self.assertEqual(0, minimap_ariba.build_index(ref_fasta, tmp_index))
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix, index_file=tmp_index)
+        expected_cluster2rep = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr2rep')
+        expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
+        expected_proper_pairs = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.pairs')
+        expected_insert_hist = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.hist')
+        self.assertTrue(filecmp.cmp(expected_cluster2rep, tmp_outprefix + '.cluster2representative', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_cluster_counts, tmp_outprefix + '.clusterCounts', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_proper_pairs, tmp_outprefix + '.properPairs', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_insert_hist, tmp_outprefix + '.insertHistogram', shallow=False))
+
+        for suffix in ['reads', 'cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+            os.unlink(tmp_outprefix + '.' + suffix)
+        os.unlink(tmp_index)
+
+
+    def test_minimap_reads_to_all_ref_seqs_with_index_of_changed_ref(self):
+        '''test test_minimap_reads_to_all_ref_seqs does not use index made from reference file before it was changed'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_ref = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_with_index_of_changed_ref.fa'
+        tmp_index = tmp_ref + '.mmi'
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_with_index_of_changed_ref'
+        tmp_outprefix_no_index = tmp_outprefix + '.no_index'
+        shutil.copyfile(ref_fasta, tmp_ref)
+        self.assertEqual(0, minimap_ariba.build_index(tmp_ref, tmp_index))
+
+        # reverse every sequence, keeping the file size and modification time
+        ref_stat = os.stat(tmp_ref)
+        with open(tmp_ref) as f:
+            lines = [x.rstrip() for x in f]
+        with open(tmp_ref, 'w') as f:
+            for line in lines:
+                print(line if line.startswith('>') else line[::-1], file=f)
+        os.utime(tmp_ref, ns=(ref_stat.st_atime_ns, ref_stat.st_mtime_ns))
+        self.assertEqual(ref_stat.st_size, os.path.getsize(tmp_ref))
+
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, tmp_ref, reads_1, reads_2, tmp_outprefix, index_file=tmp_index)
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, tmp_ref, reads_1, reads_2, tmp_outprefix_no_index)
+        expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
+        self.assertFalse(filecmp.cmp(expected_cluster_counts, tmp_outprefix + '.clusterCounts', shallow=False))
+
+        for suffix in ['cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+            self.assertTrue(filecmp.cmp(tmp_outprefix_no_index + '.' + suffix, tmp_outprefix + '.' + suffix, shallow=False))
+
+        for outprefix in tmp_outprefix, tmp_outprefix_no_index:
+            for suffix in ['reads', 'cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+                os.unlink(outprefix + '.' + suffix)
+        os.unlink(tmp_index)
+        os.unlink(tmp_ref)
+
+
+    def test_minimap_reads_to_all_ref_seqs_with_index_of_copied_ref(self):
+        '''test test_minimap_reads_to_all_ref_seqs uses index when it and the reference file are copied without keeping timestamps'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_index = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_with_index_of_copied_ref.mmi'
+        tmp_ref_copy = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_with_index_of_copied_ref.copy.fa'
+        tmp_index_copy = tmp_ref_copy + '.mmi'
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_with_index_of_copied_ref'
+        self.assertEqual(0, minimap_ariba.build_index(ref_fasta, tmp_index))
+        shutil.copyfile(ref_fasta, tmp_ref_copy)
+        shutil.copyfile(tmp_index, tmp_index_copy)
+        ref_stat = os.stat(ref_fasta)
+        os.utime(tmp_ref_copy, ns=(ref_stat.st_atime_ns, ref_stat.st_mtime_ns + 10**10))
+
+        stderr = stderr_of(clusters.Clusters._minimap_reads_to_all_ref_seqs, clusters_tsv, tmp_ref_copy, reads_1, reads_2, tmp_outprefix, index_file=tmp_index_copy)
+        self.assertNotIn('does not match', stderr)
+        expected_cluster2rep = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr2rep')
+        expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
+        self.assertTrue(filecmp.cmp(expected_cluster2rep, tmp_outprefix + '.cluster2representative', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_cluster_counts, tmp_outprefix + '.clusterCounts', shallow=False))
+
+        for suffix in ['reads', 'cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+            os.unlink(tmp_outprefix + '.' + suffix)
+        for filename in [tmp_index, tmp_ref_copy, tmp_index_copy]:
+            os.unlink(filename)
+
+
+    def test_minimap_reads_to_all_ref_seqs_kmer_prescreen(self):
+        '''test test_minimap_reads_to_all_ref_seqs gives same output with k-mer prescreen'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_filter = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_kmer_prescreen.kmers'
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_kmer_prescreen'
+        tmp_outprefix_no_filter_file = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_kmer_prescreen.no_filter_file'
+        self.assertEqual(0, minimap_ariba.build_kmer_filter(ref_fasta, tmp_filter))
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix, kmer_prescreen=True, kmer_filter_file=tmp_filter)
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix_no_filter_file, kmer_prescreen=True)
+        expected_cluster2rep = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr2rep')
+        expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
+        expected_proper_pairs = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.pairs')
+        expected_insert_hist = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.hist')
+
+        for outprefix in tmp_outprefix, tmp_outprefix_no_filter_file:
+            self.assertTrue(filecmp.cmp(expected_cluster2rep, outprefix + '.cluster2representative', shallow=False))
+            self.assertTrue(filecmp.cmp(expected_cluster_counts, outprefix + '.clusterCounts', shallow=False))
+            self.assertTrue(filecmp.cmp(expected_proper_pairs, outprefix + '.properPairs', shallow=False))
+            self.assertTrue(filecmp.cmp(expected_insert_hist, outprefix + '.insertHistogram', shallow=False))
+            stats = clusters.Clusters._load_minimap_prescreen_stats(outprefix + '.prescreen')
+            self.assertEqual(1471, stats['read_pairs'])
+            self.assertTrue(0 <= stats['read_pairs_screened_out'] <= stats['read_pairs'])
+
+            for suffix in ['reads', 'cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram', 'prescreen']:
+                os.unlink(outprefix + '.' + suffix)
+
+        os.unlink(tmp_filter)
+
+
+    def test_minimap_reads_to_all_ref_seqs_kmer_filter_of_changed_ref(self):
+        '''test test_minimap_reads_to_all_ref_seqs does not use k-mer filter made from reference file before it was changed'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_ref = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_kmer_filter_of_changed_ref.fa'
+        tmp_filter = tmp_ref + '.kmers'
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_kmer_filter_of_changed_ref'
+
+        # make the filter from every sequence reversed, then put the original
+        # sequences back, keeping the file size and modification time
+        with open(ref_fasta) as f:
+            lines = [x.rstrip() for x in f]
+        with open(tmp_ref, 'w') as f:
+            for line in lines:
+                print(line if line.startswith('>') else line[::-1], file=f)
+        self.assertEqual(0, minimap_ariba.build_kmer_filter(tmp_ref, tmp_filter))
+        ref_stat = os.stat(tmp_ref)
+        shutil.copyfile(ref_fasta, tmp_ref)
+        os.utime(tmp_ref, ns=(ref_stat.st_atime_ns, ref_stat.st_mtime_ns))
+        self.assertEqual(ref_stat.st_size, os.path.getsize(tmp_ref))
+
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, tmp_ref, reads_1, reads_2, tmp_outprefix, kmer_prescreen=True, kmer_filter_file=tmp_filter)
+        expected_cluster2rep = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr2rep')
+        expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
+        self.assertTrue(filecmp.cmp(expected_cluster2rep, tmp_outprefix + '.cluster2representative', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_cluster_counts, tmp_outprefix + '.clusterCounts', shallow=False))
+
+        for suffix in ['reads', 'cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram', 'prescreen']:
+            os.unlink(tmp_outprefix + '.' + suffix)
+        os.unlink(tmp_filter)
+        os.unlink(tmp_ref)
+
+
+    def test_minimap_reads_to_all_ref_seqs_kmer_filter_of_copied_ref(self):
+        '''test test_minimap_reads_to_all_ref_seqs uses k-mer filter when it and the reference file are copied without keeping timestamps'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_filter = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_kmer_filter_of_copied_ref.kmers'
+        tmp_ref_copy = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_kmer_filter_of_copied_ref.copy.fa'
+        tmp_filter_copy = tmp_ref_copy + '.kmers'
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_kmer_filter_of_copied_ref'
+        self.assertEqual(0, minimap_ariba.build_kmer_filter(ref_fasta, tmp_filter))
+        shutil.copyfile(ref_fasta, tmp_ref_copy)
+        shutil.copyfile(tmp_filter, tmp_filter_copy)
+        ref_stat = os.stat(ref_fasta)
+        os.utime(tmp_ref_copy, ns=(ref_stat.st_atime_ns, ref_stat.st_mtime_ns + 10**10))
+
+        stderr = stderr_of(clusters.Clusters._minimap_reads_to_all_ref_seqs, clusters_tsv, tmp_ref_copy, reads_1, reads_2, tmp_outprefix, kmer_prescreen=True, kmer_filter_file=tmp_filter_copy)
+        self.assertNotIn('does not match', stderr)
+        expected_cluster2rep = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr2rep')
+        expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
+        self.assertTrue(filecmp.cmp(expected_cluster2rep, tmp_outprefix + '.cluster2representative', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_cluster_counts, tmp_outprefix + '.clusterCounts', shallow=False))
+
+        for suffix in ['reads', 'cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram', 'prescreen']:
+            os.unlink(tmp_outprefix + '.' + suffix)
+        for filename in [tmp_filter, tmp_ref_copy, tmp_filter_copy]:
+            os.unlink(filename)
+
+
+    def test_minimap_reads_to_all_ref_seqs_keep_index(self):
+        '''test test_minimap_reads_to_all_ref_seqs gives same output when index is kept between calls'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_keep_index'
+        tmp_outprefixes = [tmp_outprefix + '.' + str(i) for i in range(3)]
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix, kmer_prescreen=True)
+        for outprefix in tmp_outprefixes:
+            clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, outprefix, kmer_prescreen=True, keep_index=True)
+        minimap_ariba.clear_reference_cache()
+
+        for outprefix in tmp_outprefixes:
+            for suffix in ['reads', 'cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+                self.assertTrue(filecmp.cmp(tmp_outprefix + '.' + suffix, outprefix + '.' + suffix, shallow=False))
+
+        for outprefix in [tmp_outprefix] + tmp_outprefixes:
+            for suffix in ['reads', 'cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram', 'prescreen']:
+                os.unlink(outprefix + '.' + suffix)
+
+
+    def test_minimap_reads_to_all_ref_seqs_read_cap(self):
+        '''test test_minimap_reads_to_all_ref_seqs with read cap'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_read_cap'
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix, native_read_store=True, read_cap_coverage=5)
+        expected_cluster2rep = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr2rep')
+        expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
+        expected_proper_pairs = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.pairs')
+        expected_insert_hist = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.hist')
+        self.assertTrue(filecmp.cmp(expected_cluster2rep, tmp_outprefix + '.cluster2representative', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_cluster_counts, tmp_outprefix + '.clusterCounts', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_proper_pairs, tmp_outprefix + '.properPairs', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_insert_hist, tmp_outprefix + '.insertHistogram', shallow=False))
+
+        # counts file has all reads, but the read store only has the capped reads
+        expected_read_counts, expected_base_counts = clusters.Clusters._load_minimap_out_cluster_counts(expected_cluster_counts)
+        store = read_store.ReadStore(tmp_outprefix + '.readStore', tmp_outprefix + '.store', store_format='native')
+        self.assertEqual(set(expected_read_counts), set(store.native_index))
+        for cluster_name, (offset, length, reads, bases) in store.native_index.items():
+            self.assertTrue(0 < reads < expected_read_counts[cluster_name])
+            self.assertEqual(0, reads % 2)
+
+        store.clean()
+        for suffix in ['cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+            os.unlink(tmp_outprefix + '.' + suffix)
+
+
+    def test_minimap_reads_to_all_ref_seqs_errors(self):
+        '''test test_minimap_reads_to_all_ref_seqs raises error instead of exiting when something goes wrong'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_errors'
+
+        with self.assertRaises(clusters.Error):
+            clusters.Clusters._minimap_reads_to_all_ref_seqs('notafile', ref_fasta, reads_1, reads_2, tmp_outprefix)
+        with self.assertRaises(clusters.Error):
+            clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, 'notafile', reads_2, tmp_outprefix, native_read_store=True)
+        self.assertFalse(os.path.exists(tmp_outprefix + '.readStore.tmp'))
+
+        # output files cannot be written when the prefix is a directory
+        os.mkdir(tmp_outprefix + '.cluster2representative')
+        with self.assertRaises(clusters.Error):
+            clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix)
+        os.rmdir(tmp_outprefix + '.cluster2representative')
+        os.unlink(tmp_outprefix + '.reads')
+
+
+    def test_minimap_reads_to_all_ref_seqs_default_no_read_cap(self):
+        '''test the reads are not capped by default, so that the report is the same as without a cap'''
+        self.assertEqual(0, self.clusters.cluster_read_cap)
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_default_no_read_cap'
+        read_cap_coverage = self.clusters.cluster_read_cap * self.clusters.assembly_coverage
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix, native_read_store=True, read_cap_coverage=read_cap_coverage)
+        expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
+        self.assertTrue(filecmp.cmp(expected_cluster_counts, tmp_outprefix + '.clusterCounts', shallow=False))
+
+        # every read is in the read store, so read counts and depths in the report are made from all the reads
+        expected_read_counts, expected_base_counts = clusters.Clusters._load_minimap_out_cluster_counts(expected_cluster_counts)
+        store = read_store.ReadStore(tmp_outprefix + '.readStore', tmp_outprefix + '.store', store_format='native')
+        self.assertEqual(expected_read_counts, {x: store.native_index[x][2] for x in store.native_index})
+        self.assertEqual(expected_base_counts, {x: store.native_index[x][3] for x in store.native_index})
+        for cluster_name, (offset, length, reads, bases) in store.native_index.items():
+            self.assertEqual(reads, cluster.Cluster._uncapped_read_count(reads, reads, expected_read_counts[cluster_name]))
+
+        store.clean()
+        for suffix in ['cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+            os.unlink(tmp_outprefix + '.' + suffix)
+
+
     def test_load_minimap_out_cluster2representative(self):
         '''test _load_minimap_out_cluster2representative'''
         infile = os.path.join(data_dir, 'clusters_test_load_minimap_out_cluster2representative.in')
@@ -125,6 +449,19 @@ class TestClusters(unittest.TestCase):
         self.assertEqual(expected, got)
 
 
+    def test_load_minimap_prescreen_stats(self):
+        '''test _load_minimap_prescreen_stats'''
+        infile = os.path.join(data_dir, 'clusters_test_load_minimap_prescreen_stats.in')
+        got = clusters.Clusters._load_minimap_prescreen_stats(infile)
+        expected = {
+            'read_pairs': 100,
+            'read_pairs_screened_out': 90,
+            'prescreen_seconds': 0.5,
+            'estimated_seconds_saved': 1.25,
+        }
+        self.assertEqual(expected, got)
+
+
     def test_load_minimap_out_cluster_counts(self):
         '''test _load_minimap_out_cluster_counts'''
         infile = os.path.join(data_dir, 'clusters_test_load_minimap_out_cluster_counts.in')
@@ -186,6 +523,143 @@ class TestClusters(unittest.TestCase):
         self.assertEqual(self.clusters.insert_sspace_sd, 0.91)
 
 
+    def test_resume_init(self):
+        '''test init with resume=True uses existing output directory'''
+        reads1 = os.path.join(data_dir, 'clusters_test_dummy_reads_1.fq')
+        reads2 = os.path.join(data_dir, 'clusters_test_dummy_reads_2.fq')
+        with self.assertRaises(clusters.Error):
+            clusters.Clusters(self.refdata_dir, reads1, reads2, self.cluster_dir, extern_progs, clean=False)
+
+        open(os.path.join(self.clusters.fails_dir, 'cluster1'), 'w').close()
+        c = clusters.Clusters(self.refdata_dir, reads1, reads2, self.cluster_dir, extern_progs, clean=False, resume=True)
+        self.assertTrue(os.path.exists(c.checkpoint_dir))
+        self.assertEqual([], os.listdir(c.fails_dir))
+        self.assertEqual(self.clusters._checkpoint_options(), c._checkpoint_options())
+
+
+    def test_checkpoints_written_without_resume(self):
+        '''test checkpoints are written by a run that did not use resume'''
+        class FakeCluster:
+            def __init__(self, name):
+                self.name = name
+                self.logfile = None
+                self.run_seconds = 1.0
+                self.assembly_compare = None
+
+        self.assertFalse(self.clusters.resume)
+        self.assertTrue(os.path.exists(self.clusters.checkpoint_dir))
+        self.clusters._store_cluster_result(clusters.ClusterResult(FakeCluster('cluster1'), ran_ok=True))
+        self.clusters._store_cluster_result(clusters.ClusterResult(FakeCluster('cluster2'), ran_ok=False))
+        self.assertEqual({'cluster1'}, set(clusters.Clusters._load_cluster_checkpoints(self.clusters.checkpoint_dir)))
+
+
+    def test_different_options(self):
+        '''test _different_options'''
+        reads1 = os.path.join(data_dir, 'clusters_test_dummy_reads_1.fq')
+        reads2 = os.path.join(data_dir, 'clusters_test_dummy_reads_2.fq')
+        options = self.clusters._checkpoint_options()
+        self.assertEqual([], clusters.Clusters._different_options(options, options))
+        for option, value in [('nucmer_min_id', 95), ('contig_aligner', 'ksw'), ('assembly_mapper', 'minimap'), ('read_filter_engine', 'kmer'), ('ref_chooser', 'alignment'), ('assembled_threshold', 0.9)]:
+            c = clusters.Clusters(self.refdata_dir, reads1, reads2, self.cluster_dir, extern_progs, clean=False, resume=True, **{option: value})
+            self.assertEqual([option], clusters.Clusters._different_options(options, c._checkpoint_options()))
+
+        earlier_options = dict(options)
+        del earlier_options['ref_chooser']
+        self.assertEqual(['ref_chooser'], clusters.Clusters._different_options(earlier_options, options))
+
+
+    def test_write_and_load_checkpoints(self):
+        '''test _write_checkpoint and _load_cluster_checkpoints'''
+        class FakeCluster:
+            def __init__(self, name):
+                self.name = name
+                self.logfile = None
+                self.run_seconds = 1.0
+                self.assembly_compare = None
+                self.report_lines = [name + '\tline']
+
+        tmp_dir = 'tmp.test_write_and_load_checkpoints'
+        os.mkdir(tmp_dir)
+        for name in ['cluster1', 'cluster2']:
+            result = clusters.ClusterResult(FakeCluster(name), ran_ok=True)
+            clusters.Clusters._write_checkpoint(result, os.path.join(tmp_dir, 'cluster.' + name + '.pickle'))
+        clusters.Clusters._write_checkpoint({'x': 1}, os.path.join(tmp_dir, 'mapping.pickle'))
+        with open(os.path.join(tmp_dir, 'cluster.cluster3.pickle.tmp'), 'w') as f:
+            print('incomplete', file=f)
+
+        got = clusters.Clusters._load_cluster_checkpoints(tmp_dir)
+        self.assertEqual({'cluster1', 'cluster2'}, set(got))
+        self.assertEqual(['cluster2\tline'], got['cluster2'].report_lines)
+        self.assertTrue(got['cluster1'].ran_ok)
+        self.assertEqual({'x': 1}, clusters.Clusters._load_checkpoint(os.path.join(tmp_dir, 'mapping.pickle')))
+        shutil.rmtree(tmp_dir)
+
+
+    def test_run_cluster(self):
+        '''test _run_cluster returns ClusterResult'''
+        class FakeCluster:
+            def __init__(self, name, fail):
+                self.name = name
+                self.root_dir = 'tmp.test_run_cluster.' + name
+                self.logfile = name + '.log'
+                self.run_seconds = None
+                self.assembly_compare = None
+                self.fail = fail
+
+            def run(self):
+                if self.fail:
+                    raise Exception('Failed!')
+                self.report_lines = [self.name + '\tline']
+
+        result = clusters._run_cluster(FakeCluster('cluster1', False), False, False, self.clusters.fails_dir)
+        self.assertIsInstance(result, clusters.ClusterResult)
+        self.assertEqual('cluster1', result.name)
+        self.assertEqual('cluster1.log', result.logfile)
+        self.assertEqual(['cluster1\tline'], result.report_lines)
+        self.assertIsNotNone(result.run_seconds)
+        self.assertTrue(result.ran_ok)
+        self.assertIsNone(result.assembly_sequences)
+        self.assertIsNone(result.gene_matching_ref)
+
+        result = clusters._run_cluster(FakeCluster('cluster2', True), False, False, self.clusters.fails_dir)
+        self.assertFalse(result.ran_ok)
+        self.assertIsNone(result.report_lines)
+        self.assertEqual(['cluster2'], os.listdir(self.clusters.fails_dir))
+
+        result = clusters._run_cluster(FakeCluster('cluster3', False), False, False, self.clusters.fails_dir)
+        self.assertIsNone(result.report_lines)
+        self.assertIsNone(result.run_seconds)
+
+
+    def test_predicted_cluster_cost(self):
+        '''test _predicted_cluster_cost'''
+        overhead = clusters.cluster_cost_per_cluster
+        per_ref_base = clusters.cluster_cost_per_reference_base
+        self.assertEqual(overhead + 5000 + 300 * per_ref_base, clusters._predicted_cluster_cost(5000, [100, 200]))
+        self.assertEqual(overhead + 4000 + 300 * per_ref_base, clusters._predicted_cluster_cost(5000, [100, 200], read_cap_coverage=20))
+        self.assertEqual(overhead + 5000 + 300 * per_ref_base, clusters._predicted_cluster_cost(5000, [100, 200], read_cap_coverage=50))
+        self.assertTrue(clusters._predicted_cluster_cost(10, [1000]) > clusters._predicted_cluster_cost(10, [100]))
+
+
+    def test_write_cluster_costs(self):
+        '''test _write_cluster_costs'''
+        class FakeCluster:
+            def __init__(self, seconds):
+                self.run_seconds = seconds
+
+        clusters_dict = {
+            'gene1': FakeCluster(1.5),
+            'gene2': FakeCluster(None),
+            'gene3': FakeCluster(0.25),
+        }
+        costs = {'gene1': 2000000, 'gene2': 1000000, 'gene3': 3000000}
+        tmp_tsv = 'tmp.test_write_cluster_costs.tsv'
+        clusters.Clusters._write_cluster_costs(clusters_dict, costs, tmp_tsv)
+        expected = os.path.join(data_dir, 'clusters_test_write_cluster_costs.tsv')
+        self.assertTrue(filecmp.cmp(expected, tmp_tsv, shallow=False))
+        os.unlink(tmp_tsv)
+
+
     def test_write_report(self):
         class FakeCluster:
             def __init__(self, lines):
@@ -215,13 +689,17 @@ class TestClusters(unittest.TestCase):
                     self.sequences = {x.id: x for x in seqs}
 
         class FakeCluster:
-            def __init__(self, seqs):
+            def __init__(self, name, seqs):
+                self.name = name
+                self.logfile = None
+                self.run_seconds = None
                 self.assembly = FakeAssembly(seqs)
+                self.assembly_compare = None
 
         self.clusters.clusters = {
-            'cluster1': FakeCluster([seq1, seq2]),
-            'cluster2': FakeCluster([seq3]),
-            'cluster3': FakeCluster(None),
+            'cluster1': clusters.ClusterResult(FakeCluster('cluster1', [seq1, seq2])),
+            'cluster2': clusters.ClusterResult(FakeCluster('cluster2', [seq3])),
+            'cluster3': clusters.ClusterResult(FakeCluster('cluster3', None)),
         }
 
         tmp_file = 'tmp.test_write_catted_assemblies_fasta.fa'
@@ -238,17 +716,24 @@ class TestClusters(unittest.TestCase):
         seq3 = pyfastaq.sequences.Fasta('seq3', 'AAAA')
         class FakeAssemblyCompare:
             def __init__(self, assembled_seqs):
+                self.gene_matching_ref = None
+                self.gene_matching_ref_type = None
+                self.gene_start_bases_added = None
+                self.gene_end_bases_added = None
                 if assembled_seqs is not None:
                     self.assembled_reference_sequences = {x.id: x for x in assembled_seqs}
 
         class FakeCluster:
-            def __init__(self, assembled_seqs):
+            def __init__(self, name, assembled_seqs):
+                self.name = name
+                self.logfile = None
+                self.run_seconds = None
                 self.assembly_compare = FakeAssemblyCompare(assembled_seqs)
 
         self.clusters.clusters = {
-            'gene1': FakeCluster([seq1, seq2]),
-            'gene2': FakeCluster([seq3]),
-            'gene3': FakeCluster(None),
+            'gene1': clusters.ClusterResult(FakeCluster('gene1', [seq1, seq2])),
+            'gene2': clusters.ClusterResult(FakeCluster('gene2', [seq3])),
+            'gene3': clusters.ClusterResult(FakeCluster('gene3', None)),
         }
 
         tmp_file = 'tmp.test_write_catted_assembled_seqs_fasta.fa'
@@ -270,13 +755,16 @@ class TestClusters(unittest.TestCase):
                 self.gene_end_bases_added = end
 
         class FakeCluster:
-            def __init__(self, seq, seq_type, start, end):
+            def __init__(self, name, seq, seq_type, start, end):
+                self.name = name
+                self.logfile = None
+                self.run_seconds = None
                 self.assembly_compare = FakeAssemblyCompare(seq, seq_type, start, end)
 
         self.clusters.clusters = {
-            'gene1': FakeCluster(seq1, 'TYPE1', 1, 3),
-            'gene2': FakeCluster(None, None, None, None),
-            'gene3': FakeCluster(seq3, 'TYPE3', 4, 5),
+            'gene1': clusters.ClusterResult(FakeCluster('gene1', seq1, 'TYPE1', 1, 3)),
+            'gene2': clusters.ClusterResult(FakeCluster('gene2', None, None, None, None)),
+            'gene3': clusters.ClusterResult(FakeCluster('gene3', seq3, 'TYPE3', 4, 5)),
         }
 
         tmp_file = 'tmp.test_write_catted_genes_matching_refs_fasta.fa'
@@ -0,0 +1,84 @@
+import unittest
+import os
+import pymummer
+from ariba import ksw_aligner
+
+modules_dir = os.path.dirname(os.path.abspath(ksw_aligner.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestKswAligner(unittest.TestCase):
+    def test_split_ops(self):
+        '''test _split_ops'''
+        ops = [('M', 10), ('I', 2), ('M', 20), ('D', 91), ('M', 5), ('I', 100), ('M', 3)]
+        expected = [
+            (0, 0, [('M', 10), ('I', 2), ('M', 20)]),
+            (121, 32, [('M', 5)]),
+            (126, 137, [('M', 3)]),
+        ]
+        self.assertEqual(expected, ksw_aligner._split_ops(ops))
+
+
+    def test_align_sequences(self):
+        '''test align_sequences'''
+        ref = 'GCTAGCTTACGGATCGACTTAGCGATCGGATTACGAGCTAGGCTATCGACGGAATCGCTGACTAGCGGCATTACGAT'
+        qry = ref[:30] + 'A' + ref[31:50] + ref[51:]
+        hits = ksw_aligner.align_sequences('ref', ref, 'qry', qry, min_length=20)
+        self.assertEqual(1, len(hits))
+        hit = hits[0]
+        self.assertFalse(hit.reverse)
+        self.assertEqual((0, 76, 0, 75), (hit.ref_start, hit.ref_end, hit.qry_start, hit.qry_end))
+        self.assertEqual([(30, 'T', 'A', 30), (50, 'G', '.', 49)], hit.variants)
+
+        qry_revcomp = qry.translate(str.maketrans('ACGT', 'TGCA'))[::-1]
+        hits = ksw_aligner.align_sequences('ref', ref, 'qry', qry_revcomp, min_length=20)
+        self.assertEqual(1, len(hits))
+        self.assertTrue(hits[0].reverse)
+        self.assertEqual([(30, 'T', 'A', 30), (50, 'G', '.', 49)], hits[0].variants)
+        self.assertEqual(len(qry) - 30, hits[0].qry_coord(30) + 1)
+        self.assertEqual([], ksw_aligner.align_sequences('ref', ref, 'qry', qry[:40], min_length=50))
+
+
+    def test_runner(self):
+        '''test Runner makes the same files as nucmer'''
+        # expected files were made by nucmer, delta-filter, show-coords -dTlro
+        # and show-snps -TClr, in the same way as pymummer.nucmer.Runner
+        for name, show_snps in [('ksw_aligner_test_runner', True), ('ksw_aligner_test_runner_three_hits', False)]:
+            ref_fa = os.path.join(data_dir, name + '.ref.fa')
+            qry_fa = os.path.join(data_dir, name + '.qry.fa')
+            expected = os.path.join(data_dir, name + '.coords')
+            tmp_coords = 'tmp.' + name + '.coords'
+            ksw_aligner.Runner(ref_fa, qry_fa, tmp_coords, min_id=90, min_length=20, breaklen=200, maxmatch=True, show_snps=show_snps).run()
+            suffixes = ['', '.snps'] if show_snps else ['']
+
+            for suffix in suffixes:
+                with open(expected + suffix) as f:
+                    expected_lines = [x for x in f if x[0].isdigit()]
+                with open(tmp_coords + suffix) as f:
+                    got_lines = f.readlines()
+                self.assertEqual(os.path.abspath(ref_fa) + ' ' + os.path.abspath(qry_fa) + '\n', got_lines[0])
+                got_lines = [x for x in got_lines if x[0].isdigit()]
+                if suffix == '':
+                    # Runner does not write the overlap annotation of show-coords -o
+                    expected_lines = [x.rsplit('\t', 1)[0] + '\n' for x in expected_lines]
+                self.assertEqual(expected_lines, got_lines)
+
+            # check the files are read in the same way as the nucmer files
+            got_hits = [str(x) for x in pymummer.coords_file.reader(tmp_coords)]
+            expected_hits = [str(x) for x in pymummer.coords_file.reader(expected)]
+            self.assertEqual(expected_hits, got_hits)
+            if show_snps:
+                got_variants = pymummer.snp_file.get_all_variants(tmp_coords + '.snps')
+                expected_variants = pymummer.snp_file.get_all_variants(expected + '.snps')
+                self.assertEqual([str(x) for x in expected_variants], [str(x) for x in got_variants])
+
+            for suffix in suffixes:
+                os.unlink(tmp_coords + suffix)
+
+
+    def test_runner_choose_aligner(self):
+        '''test runner'''
+        self.assertEqual(ksw_aligner.Runner, ksw_aligner.runner('ksw'))
+        self.assertEqual(pymummer.nucmer.Runner, ksw_aligner.runner('nucmer'))
+        with self.assertRaises(ksw_aligner.Error):
+            ksw_aligner.runner('notanaligner')
@@ -107,6 +107,79 @@ class TestMapping(unittest.TestCase):
         os.unlink(out_prefix + '.bam.bai')
 
 
+    def test_alignments_to_insert(self):
+        '''test _alignments_to_insert'''
+        forward = (0, False, 10, 50, [('S', 2), ('M', 48)])
+        reverse = (0, True, 100, 50, [('M', 20), ('D', 2), ('M', 30)])
+        self.assertEqual(142, mapping._alignments_to_insert(forward, reverse))
+        self.assertEqual(142, mapping._alignments_to_insert(reverse, forward))
+        self.assertEqual(None, mapping._alignments_to_insert(forward, forward))
+        self.assertEqual(None, mapping._alignments_to_insert(forward, (1,) + reverse[1:]))
+        self.assertEqual(None, mapping._alignments_to_insert((0, False, 200, 50, [('M', 50)]), reverse))
+
+
+    def test_choose_pair_alignments(self):
+        '''test _choose_pair_alignments'''
+        forward_best = (0, False, 500, 50, [('M', 50)])
+        forward = (0, False, 10, 40, [('M', 50)])
+        reverse = (0, True, 100, 50, [('M', 50)])
+        self.assertEqual((None, None, False), mapping._choose_pair_alignments([], [], 1000))
+        self.assertEqual((forward, None, False), mapping._choose_pair_alignments([forward], [], 1000))
+        self.assertEqual((forward, reverse, True), mapping._choose_pair_alignments([forward_best, forward], [reverse], 1000))
+        self.assertEqual((forward, reverse, True), mapping._choose_pair_alignments([forward_best, forward], [reverse], 140))
+        self.assertEqual((reverse, forward, True), mapping._choose_pair_alignments([reverse], [forward, forward_best], 200))
+        self.assertEqual((forward_best, reverse, False), mapping._choose_pair_alignments([forward_best, forward], [reverse], 139))
+
+
+    def test_mapping_quality(self):
+        '''test _mapping_quality'''
+        alignment1 = (0, False, 10, 50, [('M', 50)])
+        alignment2 = (0, False, 100, 40, [('M', 50)])
+        alignment3 = (0, True, 100, 50, [('M', 50)])
+        # minimum score of a read of length 50 is 25
+        self.assertEqual(25, mapping._min_read_score(50))
+        self.assertEqual(60, mapping._mapping_quality(alignment1, [alignment1], 50))
+        self.assertEqual(36, mapping._mapping_quality(alignment2, [alignment2], 50))
+        self.assertEqual(0, mapping._mapping_quality((0, False, 10, 25, [('M', 25)]), [], 50))
+        self.assertEqual(24, mapping._mapping_quality(alignment1, [alignment1, alignment2], 50))
+        self.assertEqual(0, mapping._mapping_quality(alignment2, [alignment1, alignment2], 50))
+        self.assertEqual(0, mapping._mapping_quality(alignment1, [alignment1, alignment2, alignment3], 50))
+
+
+    def test_run_minimap(self):
+        '''Test run_minimap'''
+        ref = os.path.join(data_dir, 'mapping_test_bowtie2_ref.fa')
+        reads1 = os.path.join(data_dir, 'mapping_test_bowtie2_reads_1.fq')
+        reads2 = os.path.join(data_dir, 'mapping_test_bowtie2_reads_2.fq')
+        out_prefix = 'tmp.out.minimap'
+        mapping.run_minimap(reads1, reads2, ref, out_prefix)
+        self.assertTrue(os.path.exists(out_prefix + '.bam.bai'))
+        got = get_sam_columns(out_prefix + '.bam')
+        positions = [x[3] for x in got if x[3] >= 0]
+        self.assertEqual(sorted(positions), positions)
+
+        # Same as bowtie2, except that the first read of pair 1 and second
+        # read of pair 2 only match 20 of their 25 bases, which is below the
+        # minimum score, so are unmapped
+        expected = get_sam_columns(os.path.join(data_dir, 'mapping_test_bowtie2_sorted.bam'))
+        self.assertEqual(sorted([x for x in expected if x[0] not in {'1', '2'}]), sorted([x for x in got if x[0] not in {'1', '2'}]))
+        expected = [
+            ('1', 101, None, 30, []),
+            ('1', 153, 'ref', 30, [(0, 25)]),
+            ('2', 73, 'ref', 124, [(0, 25)]),
+            ('2', 133, None, 124, []),
+        ]
+        self.assertEqual(expected, [x[:5] for x in got if x[0] in {'1', '2'}])
+        os.unlink(out_prefix + '.bam')
+        os.unlink(out_prefix + '.bam.bai')
+
+        # threads less than 1 means use one thread
+        mapping.run_minimap(reads1, reads2, ref, out_prefix, threads=0)
+        self.assertEqual(got, get_sam_columns(out_prefix + '.bam'))
+        os.unlink(out_prefix + '.bam')
+        os.unlink(out_prefix + '.bam.bai')
+
+
     def test_get_total_alignment_score(self):
         '''Test get_total_alignment_score'''
         bam = os.path.join(data_dir, 'mapping_test_get_total_alignment_score.bam')
@@ -115,6 +188,17 @@ class TestMapping(unittest.TestCase):
         self.assertEqual(got, expected)
 
 
+    def test_get_total_alignment_scores(self):
+        '''Test get_total_alignment_scores'''
+        reads1 = os.path.join(data_dir, 'mapping_test_get_total_alignment_scores_reads_1.fq')
+        reads2 = os.path.join(data_dir, 'mapping_test_get_total_alignment_scores_reads_2.fq')
+        ref = os.path.join(data_dir, 'mapping_test_get_total_alignment_scores_ref.fa')
+        expected = {'1': 1500, '2': 1421, '3': 1340}
+        got = mapping.get_total_alignment_scores(reads1, reads2, ref)
+        self.assertEqual(expected, got)
+        self.assertEqual(['1', '2', '3'], list(got.keys()))
+
+
     def test_sam_to_fastq(self):
         '''test sam_to_fastq'''
         expected = [
@@ -7,15 +7,53 @@ data_dir = os.path.join(modules_dir, 'tests', 'data')
 
 
 class TestMash(unittest.TestCase):
+    def test_canonical_kmers(self):
+        '''test canonical_kmers'''
+        kmer = 'A' * 10 + 'C' * 11
+        revcomp = 'G' * 11 + 'T' * 10
+        self.assertEqual(set(), mash.canonical_kmers(kmer[:-1]))
+        self.assertEqual({kmer}, mash.canonical_kmers(kmer))
+        self.assertEqual({kmer}, mash.canonical_kmers(revcomp.lower()))
+        self.assertEqual({kmer}, mash.canonical_kmers(kmer + 'N' + kmer[1:]))
+        self.assertEqual({'A' + kmer[:-1], kmer, 'A' * 9 + 'C' * 11 + 'G'}, mash.canonical_kmers('A' + kmer + 'G'))
+
+
+    def test_distance(self):
+        '''test distance'''
+        self.assertEqual((0, 3, 3), mash.distance([1, 2, 3], [1, 2, 3]))
+        self.assertEqual((1, 0, 4), mash.distance([1, 2], [3, 4]))
+        dist, common, denom = mash.distance([1, 2, 3], [2, 3, 4, 5])
+        self.assertEqual((2, 5), (common, denom))
+        self.assertAlmostEqual(0.0266484, dist)
+
+
+    def test_save_and_load_sketches(self):
+        '''test save_sketches and load_sketches'''
+        ref_in = os.path.join(data_dir, 'mash_test_run.in.ref.fa')
+        sketches = mash.sketch_fasta(ref_in, True)
+        self.assertEqual(['ref1', 'ref2', 'ref3', 'ref4'], sorted(sketches))
+        tmp_file = 'tmp.mash_test_save_and_load_sketches.pickle'
+        mash.save_sketches(sketches, tmp_file)
+        self.assertEqual(sketches, mash.load_sketches(tmp_file))
+        os.unlink(tmp_file)
+        self.assertEqual(None, mash.load_sketches(tmp_file))
+
+
     def test_run(self):
         '''test run'''
         ref_in = os.path.join(data_dir, 'mash_test_run.in.ref.fa')
         qry_in = os.path.join(data_dir, 'mash_test_run.in.qry.fa')
-        masher = mash.Masher(ref_in, qry_in)
         tmp_out = 'tmp.mash_test_run.out'
+        masher = mash.Masher(ref_in, qry_in)
         got = masher.run(tmp_out)
         self.assertEqual('ref2', got)
-        os.unlink(tmp_out)
-        os.unlink(ref_in + '.msh')
-        os.unlink(qry_in + '.msh')
+        with open(tmp_out) as f:
+            self.assertEqual(['ref2', 'ref1', 'ref3', 'ref4'], [line.split()[0] for line in f])
 
+        # a cached sketch is used instead of the sequence in the fasta file
+        ref_sketches = mash.sketch_fasta(ref_in, True)
+        ref_sketches['ref3'] = mash.sketch_fasta(qry_in, False)
+        masher = mash.Masher(ref_in, qry_in, ref_sketches=ref_sketches)
+        got = masher.run(tmp_out)
+        self.assertEqual('ref3', got)
+        os.unlink(tmp_out)
@@ -2,6 +2,7 @@ import unittest
 import sys
 import os
 import filecmp
+import pyfastaq
 from ariba import read_filter, read_store, external_progs
 
 modules_dir = os.path.dirname(os.path.abspath(read_filter.__file__))
@@ -43,12 +44,45 @@ class TestReadFilter(unittest.TestCase):
         tmp_reads1 = 'tmp.filter_test_run.reads_1.fq'
         tmp_reads2 = 'tmp.filter_test_run.reads_2.fq'
         rstore = read_store.ReadStore(rstore_infile, tmp_rstore_prefix)
-        rfilter = read_filter.ReadFilter(rstore, ref_fasta, '1', sys.stdout)
-        got_reads, got_bases = rfilter.run(tmp_reads1, tmp_reads2)
-        self.assertEqual(12, got_reads)
-        self.assertEqual(912, got_bases)
-        self.assertTrue(filecmp.cmp(expected_reads1, tmp_reads1, shallow=False))
-        self.assertTrue(filecmp.cmp(expected_reads2, tmp_reads2, shallow=False))
-        os.unlink(tmp_reads1)
-        os.unlink(tmp_reads2)
+
+        for engine in read_filter.filter_engines:
+            rfilter = read_filter.ReadFilter(rstore, ref_fasta, '1', sys.stdout, engine=engine)
+            got_reads, got_bases = rfilter.run(tmp_reads1, tmp_reads2)
+            self.assertEqual(12, got_reads)
+            self.assertEqual(912, got_bases)
+            self.assertTrue(filecmp.cmp(expected_reads1, tmp_reads1, shallow=False))
+            self.assertTrue(filecmp.cmp(expected_reads2, tmp_reads2, shallow=False))
+            os.unlink(tmp_reads1)
+            os.unlink(tmp_reads2)
+
         rstore.clean()
+
+
+    def test_kmer_read_matcher(self):
+        '''test KmerReadMatcher matches the reads kept by cd-hit-est-2d'''
+        reads_in = os.path.join(data_dir, 'read_filter_test_run_cdhit_est_2d.reads.in.fa')
+        ref_in = os.path.join(data_dir, 'read_filter_test_run_cdhit_est_2d.ref.in.fa')
+        expected_clstr = os.path.join(data_dir, 'read_filter_test_run_cdhit_est_2d.expected.clstr')
+        with open(expected_clstr) as f:
+            expected = {line.split()[2][1:-3] for line in f if not (line.startswith('>') or line.endswith('*\n'))}
+
+        matcher = read_filter.KmerReadMatcher(ref_in)
+        got = {x.id for x in pyfastaq.sequences.file_reader(reads_in) if matcher.matches(x.seq)}
+        self.assertEqual(expected, got)
+
+        self.assertFalse(matcher.matches('ACGT'))
+        self.assertFalse(matcher.matches('N' * 76))
+
+
+    def test_kmer_read_matcher_concordance(self):
+        '''test KmerReadMatcher keeps the same reads as cd-hit-est-2d'''
+        reads_in = os.path.join(data_dir, 'read_filter_test_kmer_concordance.reads.fa')
+        ref_in = os.path.join(data_dir, 'read_filter_test_run_cdhit_est_2d.ref.in.fa')
+        tmp_out = 'tmp.test_kmer_read_matcher_concordance.out'
+        read_filter.ReadFilter._run_cdhit_est_2d(ref_in, reads_in, tmp_out, self.external_progs.exe('cdhit2d'))
+        expected = read_filter.ReadFilter._cdhit_clstr_to_reads(tmp_out + '.clstr')
+        os.unlink(tmp_out + '.clstr')
+
+        matcher = read_filter.KmerReadMatcher(ref_in)
+        got = {int(x.id.split('/')[0]) for x in pyfastaq.sequences.file_reader(reads_in) if matcher.matches(x.seq)}
+        self.assertEqual(expected, got)
@@ -3,6 +3,7 @@ import os
 import shutil
 import filecmp
 import pyfastaq
+import minimap_ariba
 from ariba import read_store
 
 modules_dir = os.path.dirname(os.path.abspath(read_store.__file__))
@@ -121,6 +122,103 @@ class TestReadStore(unittest.TestCase):
         os.unlink(reads2)
 
 
+    def test_get_batch(self):
+        '''Test get_batch'''
+        infile = os.path.join(data_dir, 'read_store_test_get_reads.in')
+        outprefix = 'tmp.read_store_test_get_batch'
+        rstore = read_store.ReadStore(infile, outprefix)
+        batch = rstore.get_batch('cluster1')
+        self.assertEqual(2, len(batch))
+        self.assertEqual([1, 2], batch.numbers)
+        self.assertEqual(['AAAA', 'CCCC'], batch.seqs)
+        self.assertEqual(['ABCD', 'IIII'], batch.quals)
+        tmpfile = outprefix + '.reads.fa'
+        self.assertEqual((2, 8), batch.write(tmpfile, fasta=True))
+        with open(tmpfile) as f:
+            self.assertEqual('>1/1\nAAAA\n>1/2\nCCCC\n', f.read())
+        os.unlink(tmpfile)
+        rstore.clean()
+
+
+    def test_get_reads_native(self):
+        '''Test get_reads from native store gives same as from tabix store'''
+        prefix = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs')
+        minimap_args = [prefix + x for x in ['.clstrs.tsv', '.ref.fa', '.reads_1.fq', '.reads_2.fq']]
+        tmp_prefix = 'tmp.read_store_test_get_reads_native'
+        self.assertEqual(0, minimap_ariba.minimap_ariba(*minimap_args, tmp_prefix + '.tabix', 1, '', 0))
+        self.assertEqual(0, minimap_ariba.minimap_ariba(*minimap_args, tmp_prefix + '.native', 1, '', 1))
+        tabix_store = read_store.ReadStore(tmp_prefix + '.tabix.reads', tmp_prefix + '.tabix.store')
+        native_store = read_store.ReadStore(tmp_prefix + '.native.readStore', tmp_prefix + '.native.store', store_format='native')
+        self.assertFalse(os.path.exists(tmp_prefix + '.native.readStore'))
+        self.assertEqual({'cluster1', 'cluster2'}, set(native_store.native_index))
+        tmp_tabix_reads = [tmp_prefix + '.tabix.reads_' + x + '.fq' for x in ['1', '2']]
+        tmp_native_reads = [tmp_prefix + '.native.reads_' + x + '.fq' for x in ['1', '2']]
+
+        for cluster in ['cluster1', 'cluster2']:
+            for options in [{}, {'fasta': True}, {'wanted_ids': {1, 5, 11}}]:
+                expected = tabix_store.get_reads(cluster, tmp_tabix_reads[0], out2=tmp_tabix_reads[1], **options)
+                got = native_store.get_reads(cluster, tmp_native_reads[0], out2=tmp_native_reads[1], **options)
+                self.assertEqual(expected, got)
+                self.assertTrue(filecmp.cmp(tmp_tabix_reads[0], tmp_native_reads[0], shallow=False))
+                self.assertTrue(filecmp.cmp(tmp_tabix_reads[1], tmp_native_reads[1], shallow=False))
+
+        tabix_store.clean()
+        native_store.clean()
+        os.unlink(tmp_prefix + '.tabix.reads')
+        self.assertFalse(os.path.exists(native_store.outfile))
+        for filename in tmp_tabix_reads + tmp_native_reads:
+            os.unlink(filename)
+        for suffix in ['cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+            os.unlink(tmp_prefix + '.tabix.' + suffix)
+            os.unlink(tmp_prefix + '.native.' + suffix)
+
+
+    def test_native_store_fasta_reads(self):
+        '''Test native store counts bases of reads that have no qualities'''
+        prefix = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs')
+        tmp_prefix = 'tmp.read_store_test_native_store_fasta_reads'
+        tmp_reads = [tmp_prefix + '.reads_' + x + '.fa' for x in ['1', '2']]
+        for i, filename in enumerate(tmp_reads):
+            pyfastaq.tasks.to_fasta(prefix + '.reads_' + str(i + 1) + '.fq', filename)
+
+        self.assertEqual(0, minimap_ariba.minimap_ariba(prefix + '.clstrs.tsv', prefix + '.ref.fa', tmp_reads[0], tmp_reads[1], tmp_prefix, 1, '', 1))
+        rstore = read_store.ReadStore(tmp_prefix + '.readStore', tmp_prefix + '.store', store_format='native')
+        with open(tmp_prefix + '.clusterCounts') as f:
+            expected = {x.split()[0]: (int(x.split()[1]), int(x.split()[2])) for x in f}
+        self.assertEqual(expected, {x: rstore.native_index[x][2:] for x in rstore.native_index})
+        rstore.clean()
+        for filename in tmp_reads:
+            os.unlink(filename)
+        for suffix in ['cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+            os.unlink(tmp_prefix + '.' + suffix)
+
+
+    def test_existing_store(self):
+        '''Test using store made earlier'''
+        infile = os.path.join(data_dir, 'read_store_test_get_reads.in')
+        outprefix = 'tmp.read_store_test_existing_store'
+        with self.assertRaises(read_store.Error):
+            read_store.ReadStore(None, outprefix)
+
+        rstore = read_store.ReadStore(infile, outprefix)
+        existing_store = read_store.ReadStore(None, outprefix)
+        self.assertEqual(rstore.outfile, existing_store.outfile)
+        self.assertEqual(rstore.get_batch('cluster2').seqs, existing_store.get_batch('cluster2').seqs)
+        existing_store.clean()
+        self.assertFalse(os.path.exists(outprefix + '.gz'))
+
+        prefix = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs')
+        minimap_args = [prefix + x for x in ['.clstrs.tsv', '.ref.fa', '.reads_1.fq', '.reads_2.fq']]
+        self.assertEqual(0, minimap_ariba.minimap_ariba(*minimap_args, outprefix, 1, '', 1))
+        rstore = read_store.ReadStore(outprefix + '.readStore', outprefix + '.store', store_format='native')
+        existing_store = read_store.ReadStore(None, outprefix + '.store', store_format='native')
+        self.assertEqual(rstore.native_index, existing_store.native_index)
+        self.assertEqual(rstore.get_batch('cluster1').seqs, existing_store.get_batch('cluster1').seqs)
+        existing_store.clean()
+        for suffix in ['cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+            os.unlink(outprefix + '.' + suffix)
+
+
     def test_clean(self):
         '''Test clean'''
         infile = os.path.join(data_dir, 'read_store_test_clean.in')
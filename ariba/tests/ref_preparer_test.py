@@ -112,6 +112,9 @@ class TestRefPreparer(unittest.TestCase):
             got = os.path.join(tmp_out, filename)
             self.assertTrue(filecmp.cmp(expected, got, shallow=False))
 
+        self.assertTrue(os.path.exists(os.path.join(tmp_out, '02.cdhit.all.mmi')))
+        self.assertTrue(os.path.exists(os.path.join(tmp_out, '02.cdhit.all.kmers')))
+        self.assertTrue(os.path.exists(os.path.join(tmp_out, '02.cdhit.all.sketches.pickle')))
         shutil.rmtree(tmp_out)
 
 
@@ -86,6 +86,22 @@ class TestSamtoolsVariants(unittest.TestCase):
             self.assertEqual(expected, samtools_variants.SamtoolsVariants._get_read_depths(read_depths_file, name, position))
 
 
+    def test_read_depths(self):
+        '''test ReadDepths'''
+        read_depths_file = os.path.join(data_dir, 'samtools_variants_test_get_read_depths.gz')
+        depths = samtools_variants.ReadDepths(read_depths_file)
+        self.assertEqual(None, depths.get('ref1', -1))
+        self.assertEqual(None, depths.get('ref1', 5))
+        self.assertEqual(None, depths.get('ref2', 0))
+        self.assertEqual(('A', '.', 2, '2'), depths.get('ref1', 1))
+        self.assertEqual(('C', 'AC', 41, '0,42'), depths.get('ref1', 4))
+
+        positions = [('ref1', 0), ('ref1', 3), ('ref1', 42), ('ref2', 1)]
+        expected = {'ref1': {0: ('G', '.', 1, '1'), 3: ('C', 'A,G', 42, '21,11,10')}}
+        self.assertEqual(expected, depths.get_many(positions))
+        self.assertEqual({'ref1': 131}, depths.total_depth_per_contig())
+
+
     def test_get_variant_positions_from_vcf(self):
         '''test _get_variant_positions_from_vcf'''
         vcf_file = os.path.join(data_dir, 'samtools_variants_test_get_variant_positions_from_vcf.vcf')
@@ -2,7 +2,6 @@ import unittest
 import os
 import filecmp
 import pyfastaq
-import pysam
 from ariba import link, scaffold_graph
 
 modules_dir = os.path.dirname(os.path.abspath(scaffold_graph.__file__))
@@ -10,22 +9,40 @@ data_dir = os.path.join(modules_dir, 'tests', 'data')
 
 
 class TestScaffoldGraph(unittest.TestCase):
-    def test_update_from_sam(self):
-        '''test update_from_sam'''
-        sam_reader = pysam.Samfile(os.path.join(data_dir, 'graph_test_update_from_sam.bam'), "rb")
-        ref_lengths = {}
-        pyfastaq.tasks.lengths_from_fai(os.path.join(data_dir, 'graph_test_update_from_sam.ref.fa.fai'), ref_lengths)
-        graph = scaffold_graph.Graph(ref_lengths)
+    def test_add_links(self):
+        '''test add_links'''
+        g = scaffold_graph.Graph({'ref1': 100, 'ref2': 200, 'ref3': 300})
+        g.add_links([0, 2], [0, 1], [50, 42], [1, 0], [1, 0], [10, 43])
+        expected = {
+            ('ref1', 'ref2'): [link.Link(None, None, None, s='\t'.join(['ref1', '100', 'R', '50', 'ref2', '200', 'L', '10']))],
+            ('ref1', 'ref3'): [link.Link(None, None, None, s='\t'.join(['ref1', '100', 'R', '43', 'ref3', '300', 'L', '42']))],
+        }
+        self.assertEqual(expected, g.get_links())
+
+
+    def test_update_from_reads(self):
+        '''test update_from_reads'''
+        g = scaffold_graph.Graph({'ref1': 506, 'ref2': 500})
+        g.update_from_reads([0, 1], [0, 1], [0, 0], [1, 0], [359, 100])
+        self.assertEqual({}, g.get_links())
+        self.assertEqual(2, len(g.partial_links['name']))
 
-        for sam in sam_reader.fetch(until_eof=True):
-            graph.update_from_sam(sam, sam_reader)
+        g.update_from_reads([0], [1], [1], [0], [300])
+        self.assertEqual(1, len(g.partial_links['name']))
+        expected_links = [link.Link(None, None, None, s='\t'.join(['ref1', '506', 'L', '359', 'ref2', '500', 'R', '300']))]
+        self.assertEqual({('ref1', 'ref2'): expected_links}, g.get_links())
 
-        self.assertEqual(len(graph.partial_links), 0)
-        self.assertEqual(len(graph.links), 1)
-        key = ('ref1', 'ref2')
-        self.assertTrue(key in graph.links)
-        expected_links = [link.Link(None, None, None, s='\t'.join(['ref1', '506', 'R', '300', 'ref2', '500', 'L', '359']))]
-        self.assertListEqual(graph.links[key], expected_links)
+        g.update_from_reads([1], [0], [1], [1], [42])
+        self.assertEqual(0, len(g.partial_links['name']))
+        expected_links.append(link.Link(None, None, None, s='\t'.join(['ref1', '506', 'R', '100', 'ref2', '500', 'L', '42'])))
+        self.assertEqual({('ref1', 'ref2'): expected_links}, g.get_links())
+
+
+    def test_insert_sizes(self):
+        '''test _insert_sizes'''
+        g = scaffold_graph.Graph({'ref1': 100, 'ref2': 200})
+        g.add_links([0, 0], [0, 1], [50, 50], [1, 1], [1, 0], [10, 10])
+        self.assertEqual([49 + 10, 50 + 189], list(g._insert_sizes()))
 
 
     def test_make_graph(self):
@@ -33,14 +50,12 @@ class TestScaffoldGraph(unittest.TestCase):
         ref_lengths = {'ref1':100, 'ref2':200, 'ref3':300}
         g = scaffold_graph.Graph(ref_lengths)
 
-        g.partial_links = {42:42}
+        g.update_from_reads([42], [1], [0], [0], [50])
         with self.assertRaises(scaffold_graph.Error):
             g._make_graph(1000)
-        g.partial_links = {}
+        g = scaffold_graph.Graph(ref_lengths)
 
-        g.links[('ref1', 'ref2')] = [
-            link.Link(None, None, None, '\t'.join(['ref1', '100', 'R', '50', 'ref2', '200', 'L', '10']))
-        ]
+        g.add_links([0], [0], [50], [1], [1], [10])
 
         g._make_graph(10)
         self.assertEqual(len(g.contig_links), 0)
@@ -52,8 +67,7 @@ class TestScaffoldGraph(unittest.TestCase):
         }
         self.assertDictEqual(g.contig_links, expected_contig_links)
 
-        g.links[('ref1', 'ref2')].append(link.Link(None, None, None, '\t'.join(['ref1', '100', 'R', '50', 'ref2', '200', 'L', '10'])))
-        g.links[('ref1', 'ref2')].append(link.Link(None, None, None, '\t'.join(['ref1', '100', 'L', '50', 'ref2', '200', 'R', '10'])))
+        g.add_links([0, 0], [0, 1], [50, 50], [1, 1], [1, 0], [10, 10])
         g._make_graph(1000)
         expected_contig_links = {
             ('ref1', 'ref2'): {'RL': 2, 'LR': 1}
@@ -107,20 +121,9 @@ class TestScaffoldGraph(unittest.TestCase):
 
     def test_write_all_links_to_file(self):
         '''test write_all_links_to_file'''
-        ref_lengths = {'ref1':100, 'ref2':200, 'ref3':300}
+        ref_lengths = {'ref1':100, 'ref2':200, 'ref3':100, 'ref4':200}
         g = scaffold_graph.Graph(ref_lengths)
-        g.links[('ref1', 'ref2')] = [
-            link.Link(None, None, None, '\t'.join(['ref1', '100', 'R', '50', 'ref2', '200', 'L', '10']))
-        ]
-
-
-        g.links[('ref1', 'ref2')].append(link.Link(None, None, None, '\t'.join(['ref1', '100', 'R', '50', 'ref2', '200', 'L', '10'])))
-        g.links[('ref1', 'ref2')].append(link.Link(None, None, None, '\t'.join(['ref1', '100', 'L', '50', 'ref2', '200', 'R', '10'])))
-
-
-        g.links[('ref3', 'ref4')] = [
-            link.Link(None, None, None, '\t'.join(['ref3', '100', 'R', '42', 'ref4', '200', 'L', '42']))
-        ]
+        g.add_links([2, 0, 0, 0], [0, 0, 0, 1], [42, 50, 50, 50], [3, 1, 1, 1], [1, 1, 1, 0], [42, 10, 10, 10])
 
         tmp_file = 'tmp.contig_links'
         g.write_all_links_to_file(tmp_file)
@@ -0,0 +1,88 @@
+import unittest
+import os
+from ariba import common, stage_timer
+
+modules_dir = os.path.dirname(os.path.abspath(stage_timer.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+def values(n):
+    return {x: n for x in stage_timer.columns}
+
+
+class TestStageTimer(unittest.TestCase):
+    def test_stage(self):
+        '''test stage'''
+        timer = stage_timer.StageTimer()
+        with timer.stage('stage1'):
+            common.syscall('sleep 0.1')
+
+        with self.assertRaises(ValueError):
+            with timer.stage('stage2'):
+                raise ValueError
+
+        self.assertEqual(['stage1', 'stage2'], [x[0] for x in timer.stages])
+        for name, got in timer.stages:
+            self.assertEqual(set(stage_timer.columns), set(got))
+            self.assertTrue(min(got.values()) >= 0)
+
+        stage1 = timer.stages[0][1]
+        self.assertTrue(stage1['wall_seconds'] >= 0.1)
+        self.assertTrue(stage1['max_rss_kb'] > 0)
+
+
+    def test_nested_stage(self):
+        '''test nested stage keeps the peak RSS of the outer stage'''
+        timer = stage_timer.StageTimer()
+        with timer.stage('outer'):
+            big = b'x' * (200 * 1024 * 1024)
+            del big
+            with timer.stage('inner'):
+                pass
+
+        self.assertEqual(['inner', 'outer'], [x[0] for x in timer.stages])
+        inner = timer.stages[0][1]
+        outer = timer.stages[1][1]
+        self.assertTrue(outer['max_rss_kb'] >= 200 * 1024)
+        if stage_timer._reset_peak_rss():
+            self.assertTrue(inner['max_rss_kb'] < outer['max_rss_kb'])
+
+
+    def test_rollup(self):
+        '''test rollup'''
+        stages = [
+            ('stage1', values(1)),
+            ('stage2', values(2)),
+            ('stage1', values(3)),
+        ]
+        expected_stage1 = values(4)
+        expected_stage1['max_rss_kb'] = 3
+        expected_stage1['children_max_rss_kb'] = 3
+        expected = [('stage1', expected_stage1), ('stage2', values(2))]
+        self.assertEqual(expected, stage_timer.rollup(stages))
+
+
+    def test_write_tsv(self):
+        '''test write_tsv'''
+        cluster_stages = {
+            'cluster2': [('stage1', values(3))],
+            'cluster1': [('stage1', values(1)), ('stage2', values(2))],
+        }
+        run_stages = [('run_clusters', values(10))]
+        tmp_file = 'tmp.stage_timer_test_write_tsv.tsv'
+        stage_timer.write_tsv(cluster_stages, run_stages, tmp_file)
+        with open(tmp_file) as f:
+            got = [line.rstrip('\n').split('\t') for line in f]
+        os.unlink(tmp_file)
+
+        self.assertEqual(['#cluster', 'stage'] + stage_timer.columns, got[0])
+        self.assertEqual([
+            ('cluster1', 'stage1'),
+            ('cluster1', 'stage2'),
+            ('cluster2', 'stage1'),
+            ('ALL', 'stage1'),
+            ('ALL', 'stage2'),
+            ('.', 'run_clusters'),
+        ], [tuple(x[:2]) for x in got[1:]])
+        self.assertEqual(['4'] * 3 + ['3'] * 2 + ['4'] * 2, got[4][2:])
+        self.assertEqual(['10'] * len(stage_timer.columns), got[6][2:])
@@ -0,0 +1,102 @@
+import unittest
+import time
+import multiprocessing
+from ariba import thread_budget
+
+
+def run_fake_cluster(seconds):
+    '''Returns list of (threads got, total threads in use) in each stage'''
+    budget = thread_budget._budget
+    got = []
+    with thread_budget.cluster_running():
+        for i in range(3):
+            with thread_budget.stage_threads() as threads:
+                with budget.condition:
+                    got.append((threads, budget.running.value + budget.lent.value))
+                time.sleep(seconds)
+    return got
+
+
+class TestThreadBudget(unittest.TestCase):
+    def test_stage_threads(self):
+        '''test stage_threads'''
+        budget = thread_budget.ThreadBudget(8)
+        budget.add_pending(4)
+        budget.cluster_skipped()
+
+        with budget.cluster_running():
+            # clusters waiting to start, so no threads lent
+            with budget.stage_threads() as threads:
+                self.assertEqual(1, threads)
+
+            with budget.cluster_running(), budget.cluster_running():
+                self.assertEqual(0, budget.pending.value)
+                self.assertEqual(3, budget.running.value)
+                with budget.stage_threads() as threads1, budget.stage_threads() as threads2, budget.stage_threads(2) as threads3:
+                    self.assertEqual([2, 2, 2], [threads1, threads2, threads3])
+                    self.assertEqual(2, budget.lent.value)
+                self.assertEqual(0, budget.lent.value)
+
+            with budget.stage_threads() as threads:
+                self.assertEqual(8, threads)
+
+        self.assertEqual(0, budget.running.value)
+
+
+    def test_stage_threads_no_budget(self):
+        '''test stage_threads when not using a budget'''
+        with thread_budget.cluster_running():
+            with thread_budget.stage_threads(3) as threads:
+                self.assertEqual(3, threads)
+
+
+    def test_reserve_threads(self):
+        '''test reserve_threads'''
+        budget = thread_budget.ThreadBudget(4)
+        budget.add_pending(2)
+        with budget.reserve_threads(8) as threads:
+            self.assertEqual(4, threads)
+
+        with budget.cluster_running():
+            with budget.reserve_threads(2) as threads:
+                self.assertEqual(2, threads)
+                with budget.reserve_threads(2) as threads2:
+                    self.assertEqual(1, threads2)
+                    self.assertEqual(4, budget.running.value + budget.lent.value)
+            self.assertEqual(0, budget.lent.value)
+
+
+    def test_pool_with_reserved_threads(self):
+        '''test threads reserved outside the pool are counted in the total'''
+        budget = thread_budget.ThreadBudget(4)
+        budget.add_pending(6)
+        pool = multiprocessing.Pool(4, thread_budget.use_budget, (budget,))
+        with budget.reserve_threads(3) as threads:
+            self.assertEqual(3, threads)
+            results = pool.map_async(run_fake_cluster, [0.05] * 6, chunksize=1)
+            time.sleep(0.3)
+            with budget.condition:
+                self.assertTrue(budget.running.value <= 1)
+        results = results.get()
+        pool.close()
+        pool.join()
+        stages = [x for result in results for x in result]
+        self.assertEqual(18, len(stages))
+        self.assertTrue(max([x[1] for x in stages]) <= 4)
+        self.assertEqual(0, budget.running.value + budget.lent.value + budget.pending.value)
+
+
+    def test_pool(self):
+        '''test total threads in use is never more than number of workers'''
+        budget = thread_budget.ThreadBudget(4)
+        budget.add_pending(6)
+        pool = multiprocessing.Pool(4, thread_budget.use_budget, (budget,))
+        results = pool.map(run_fake_cluster, [0.05, 0.05, 0.05, 0.05, 0.2, 0.2], chunksize=1)
+        pool.close()
+        pool.join()
+
+        stages = [x for result in results for x in result]
+        self.assertEqual(18, len(stages))
+        self.assertTrue(max([x[1] for x in stages]) <= 4)
+        self.assertTrue(max([x[0] for x in stages]) > 1)
+        self.assertEqual(0, budget.running.value + budget.lent.value + budget.pending.value)
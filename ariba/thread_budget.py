@@ -0,0 +1,125 @@
+import contextlib
+import multiprocessing
+
+# The ThreadBudget used by this process, if any. Set in each worker of a
+# multiprocessing.Pool by use_budget()
+_budget = None
+
+
+class ThreadBudget:
+    def __init__(self, total_threads):
+        '''Shares total_threads between clusters that run in parallel in a
+           multiprocessing.Pool with total_threads workers. Each running
+           cluster has one thread. When no more clusters are waiting to start
+           (eg at the end of a run, or when there are fewer clusters than
+           threads), the threads not used by running clusters are lent to
+           running clusters for their multi-threaded stages, at most an equal
+           share each. A cluster does not start until there is a thread free
+           for it. Work done outside the pool (eg ariba run-batch mapping the
+           reads of the next sample) must take its threads from
+           reserve_threads(). Then the total number of threads in use is
+           never more than total_threads'''
+        self.total_threads = total_threads
+        self.condition = multiprocessing.Condition()
+        self.pending = multiprocessing.RawValue('i', 0)
+        self.running = multiprocessing.RawValue('i', 0)
+        self.lent = multiprocessing.RawValue('i', 0)
+
+
+    def add_pending(self, clusters):
+        '''Call before sending clusters to the pool'''
+        with self.condition:
+            self.pending.value += clusters
+
+
+    def cluster_skipped(self):
+        with self.condition:
+            self.pending.value -= 1
+
+
+    @contextlib.contextmanager
+    def cluster_running(self):
+        with self.condition:
+            self.pending.value -= 1
+            while self.running.value + self.lent.value >= self.total_threads:
+                self.condition.wait()
+            self.running.value += 1
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.running.value -= 1
+                self.condition.notify_all()
+
+
+    @contextlib.contextmanager
+    def stage_threads(self, own_threads=1):
+        with self.condition:
+            extra = 0
+            if self.pending.value <= 0 and self.running.value > 0:
+                spare = self.total_threads - self.running.value - self.lent.value
+                extra = max(0, min(spare, self.total_threads // self.running.value - own_threads))
+                self.lent.value += extra
+
+        try:
+            yield own_threads + extra
+        finally:
+            if extra > 0:
+                with self.condition:
+                    self.lent.value -= extra
+                    self.condition.notify_all()
+
+
+    @contextlib.contextmanager
+    def reserve_threads(self, wanted):
+        '''For work outside the pool. Waits until at least one thread is
+           free, then takes up to wanted free threads. Clusters cannot use
+           them until they are given back at the end'''
+        with self.condition:
+            while self.running.value + self.lent.value >= self.total_threads:
+                self.condition.wait()
+            threads = min(wanted, self.total_threads - self.running.value - self.lent.value)
+            self.lent.value += threads
+
+        try:
+            yield threads
+        finally:
+            with self.condition:
+                self.lent.value -= threads
+                self.condition.notify_all()
+
+
+def use_budget(budget):
+    '''Sets the ThreadBudget used by this process. Use as the initializer
+       of a multiprocessing.Pool, because a ThreadBudget cannot be sent to
+       the workers with each task'''
+    global _budget
+    _budget = budget
+
+
+def cluster_skipped():
+    if _budget is not None:
+        _budget.cluster_skipped()
+
+
+@contextlib.contextmanager
+def cluster_running():
+    '''Use as: "with cluster_running(): ..." around running a cluster'''
+    if _budget is None:
+        yield
+    else:
+        with _budget.cluster_running():
+            yield
+
+
+@contextlib.contextmanager
+def stage_threads(own_threads=1):
+    '''Use as: "with stage_threads(n) as threads: ...", where n is the number
+       of threads of the cluster. threads is n plus any spare threads lent
+       for the stage, which are given back at the end of the stage'''
+    if _budget is None:
+        yield own_threads
+    else:
+        with _budget.stage_threads(own_threads) as threads:
+            yield threads
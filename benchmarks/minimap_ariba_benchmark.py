@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Times minimap_ariba, mapping the reads in ariba/test_run_data to the
+# reference sequences there, with the reads repeated many times over.
+# Random read pairs can be added, to mimic a real run where most read
+# pairs do not map to any reference sequence. Each reference sequence
+# is put in its own cluster, so that cd-hit is not needed. Run from the
+# root of the repository, after building the extension in place, eg:
+#   python3 setup.py build_ext --inplace
+#   python3 benchmarks/minimap_ariba_benchmark.py
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import pyfastaq
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+import minimap_ariba
+
+test_run_data = os.path.join(repo_root, 'ariba', 'test_run_data')
+
+
+def make_input_files(outdir, scale, unmapped_pairs):
+    ref_fasta = os.path.join(test_run_data, 'ref_seqs.fa')
+    clusters_tsv = os.path.join(outdir, 'clusters.tsv')
+    seq_reader = pyfastaq.sequences.file_reader(ref_fasta)
+    with open(clusters_tsv, 'w') as f:
+        for seq in seq_reader:
+            print(seq.id, seq.id, sep='\t', file=f)
+
+    reads_files = []
+    for i in ['1', '2']:
+        with open(os.path.join(test_run_data, 'reads_' + i + '.fq')) as f:
+            reads = f.read().rstrip().split('\n')
+
+        random.seed(i)
+        read_length = len(reads[1])
+        random_reads = ['@random\n' + ''.join(random.choices('ACGT', k=read_length)) + '\n+\n' + 'I' * read_length for j in range(10000)]
+        reads_files.append(os.path.join(outdir, 'reads_' + i + '.fq'))
+        with open(reads_files[-1], 'w') as f:
+            for j in range(scale):
+                for k in range(0, len(reads), 4):
+                    print(*reads[k:k+4], sep='\n', file=f)
+                    for l in range(unmapped_pairs):
+                        print(random.choice(random_reads), file=f)
+
+    return clusters_tsv, ref_fasta, reads_files[0], reads_files[1]
+
+
+parser = argparse.ArgumentParser(
+    description='Times minimap_ariba on the test_run_data reads, repeated many times',
+    usage='%(prog)s [options]',
+)
+parser.add_argument('--scale', type=int, help='Number of copies of the reads to map [%(default)s]', default=100, metavar='INT')
+parser.add_argument('--repeats', type=int, help='Number of times to run minimap_ariba. The fastest time is reported [%(default)s]', default=5, metavar='INT')
+parser.add_argument('--unmapped_pairs', type=int, help='Number of random read pairs to add after each read pair [%(default)s]', default=0, metavar='INT')
+parser.add_argument('--kmer_prescreen', action='store_true', help='Use the k-mer prescreen')
+parser.add_argument('--threads', type=int, help='Number of threads [%(default)s]', default=1, metavar='INT')
+parser.add_argument('--tmp_dir', help='Directory in which to make temporary files [%(default)s]', default=None, metavar='DIR')
+options = parser.parse_args()
+
+tmp_dir = tempfile.mkdtemp(prefix='minimap_ariba_benchmark.', dir=options.tmp_dir)
+clusters_tsv, ref_fasta, reads_1, reads_2 = make_input_files(tmp_dir, options.scale, options.unmapped_pairs)
+times = []
+
+for i in range(options.repeats):
+    start_time = time.perf_counter()
+    try:
+        minimap_ariba.minimap_ariba(clusters_tsv, ref_fasta, reads_1, reads_2, os.path.join(tmp_dir, 'out'), options.threads, '', 0, int(options.kmer_prescreen))
+    except ValueError as error:
+        shutil.rmtree(tmp_dir)
+        sys.exit('Error running minimap_ariba. ' + str(error))
+    times.append(time.perf_counter() - start_time)
+
+read_pairs = options.scale * (1 + options.unmapped_pairs) * sum(1 for x in pyfastaq.sequences.file_reader(os.path.join(test_run_data, 'reads_1.fq')))
+shutil.rmtree(tmp_dir)
+print('read_pairs', read_pairs, sep='\t')
+print('threads', options.threads, sep='\t')
+print('best_seconds', round(min(times), 3), sep='\t')
+print('read_pairs_per_second', round(read_pairs / min(times)), sep='\t')
@@ -7,14 +7,12 @@ start_dir=$(pwd)
 BCFTOOLS_VERSION=1.3
 BOWTIE2_VERSION=2.2.8
 CDHIT_VERSION=4.6.5
-MASH_VERSION=1.1
 SAMTOOLS_VERSION=1.3
 MUMMER_VERSION=3.23
 
 BCFTOOLS_DOWNLOAD_URL="https://github.com/samtools/bcftools/releases/download/1.3/bcftools-${BCFTOOLS_VERSION}.tar.bz2"
 BOWTIE2_DOWNLOAD_URL="http://downloads.sourceforge.net/project/bowtie-bio/bowtie2/${BOWTIE2_VERSION}/bowtie2-${BOWTIE2_VERSION}-linux-x86_64.zip"
 CDHIT_DOWNLOAD_URL="https://github.com/weizhongli/cdhit/archive/V${CDHIT_VERSION}.tar.gz"
-MASH_DOWNLOAD_URL="https://github.com/marbl/Mash/releases/download/v${MASH_VERSION}/mash-Linux64-v${MASH_VERSION}.tar.gz"
 SAMTOOLS_DOWNLOAD_URL="https://github.com/samtools/samtools/releases/download/${SAMTOOLS_VERSION}/samtools-${SAMTOOLS_VERSION}.tar.bz2"
 MUMMER_DOWNLOAD_URL="http://downloads.sourceforge.net/project/mummer/mummer/${MUMMER_VERSION}/MUMmer${MUMMER_VERSION}.tar.gz"
 
@@ -65,13 +63,6 @@ cd $cdhit_dir
 make
 
 
-# --------------- mash --------------------
-cd $build_dir
-download $MASH_DOWNLOAD_URL "mash-Linux64-v${MASH_VERSION}.tar.gz"
-mash_dir="$build_dir/mash-Linux64-v${MASH_VERSION}"
-tar zxf mash-Linux64-v${MASH_VERSION}.tar.gz
-
-
 # --------------- mummer ------------------
 cd $build_dir
 download $MUMMER_DOWNLOAD_URL "MUMmer${MUMMER_VERSION}.tar.gz"
@@ -103,6 +94,5 @@ update_path () {
 update_path ${bcftools_dir}
 update_path ${bowtie2_dir}
 update_path ${cdhit_dir}
-update_path ${mash_dir}
 update_path ${mummer_dir}
 update_path ${samtools_dir}
@@ -15,12 +15,13 @@ minimap_c_files = [
 ]
 
 minimap_c_files = [os.path.join('third_party', 'minimap-0.2', x) for x in minimap_c_files]
+minimap_c_files.append(os.path.join('third_party', 'fermi-lite-0.1', 'ksw.c'))
 minimap_c_files.append(os.path.join('ariba', 'ext', 'minimap_ariba.cpp'))
 minimap_mod = Extension(
     "minimap_ariba",
     minimap_c_files,
     extra_link_args=['-lz'],
-    include_dirs=[os.path.join('third_party', 'minimap-0.2')],
+    include_dirs=[os.path.join('third_party', 'minimap-0.2'), os.path.join('third_party', 'fermi-lite-0.1')],
 )
 
 fermilite_c_files = [
@@ -47,9 +48,15 @@ fermilite_mod = Extension(
     include_dirs=[os.path.join('third_party', 'fermi-lite-0.1')],
 )
 
+ksw_mod = Extension(
+    "ksw_ariba",
+    [os.path.join('third_party', 'fermi-lite-0.1', 'ksw.c'), os.path.join('ariba', 'ext', 'ksw_ariba.cpp')],
+    include_dirs=[os.path.join('third_party', 'fermi-lite-0.1')],
+)
+
 
 setup(
-    ext_modules=[minimap_mod, fermilite_mod],
+    ext_modules=[minimap_mod, fermilite_mod, ksw_mod],
     name='ariba',
     version='2.1.0',
     description='ARIBA: Antibiotic Resistance Identification By Assembly',
@@ -63,6 +70,7 @@ setup(
     tests_require=['nose >= 1.3'],
     install_requires=[
         'dendropy >= 4.1.0',
+        'numpy',
         'pyfastaq >= 3.12.0',
         'pysam >= 0.8.1',
         'pymummer>=0.6.1',